@@ -0,0 +1,5 @@
+from backend.asgi import create_asgi_app
+from run import app as flask_app
+
+# ASGI entry point for the same application as run.py: uvicorn asgi:app
+app = create_asgi_app(flask_app)
@@ -0,0 +1,493 @@
+"""ASGI serving mode.
+
+``create_asgi_app()`` wraps the Flask application in an ASGI app that serves
+the read-heavy staff endpoints natively on an async SQLAlchemy engine, so a
+single event loop can hold hundreds of requests waiting on the database or
+disk. Every other ``/api/*`` route (writes, uploads, mail, exports) is passed
+to the Flask app on a worker thread, so the HTTP contract is the same in both
+modes.
+
+Native handlers still run inside a Flask request context: the usual
+before/after request hooks (request id, access log, metrics, CORS) and JWT
+verification apply, and error responses come from the same handlers.
+
+``/api/staff/events`` is native too: a server-sent event stream waits on an
+asyncio queue rather than holding a worker thread for its whole life.
+
+Run with ``uvicorn asgi:app``.
+"""
+import os
+import io
+import re
+import sys
+import asyncio
+import logging
+import mimetypes
+import threading
+from urllib.parse import unquote
+
+from flask import current_app, jsonify, redirect, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from werkzeug.http import dump_options_header
+
+from . import create_app
+from .models import Staff
+from .services import StaffService, FACET_FIELDS
+from .storage import get_storage
+from .profiling import SKIP_ENVIRON_KEY
+from .embedded import configure_engine
+from .events import STREAM_HEADERS, TooManyStreams, astream, get_event_broker, too_many_streams
+
+logger = logging.getLogger(__name__)
+
+# Async drivers for the sync URLs the Flask app is configured with
+ASYNC_DRIVERS = {
+    'postgresql': ('postgresql+asyncpg', 'asyncpg'),
+    'sqlite': ('sqlite+aiosqlite', 'aiosqlite'),
+}
+
+FILE_CHUNK_SIZE = 64 * 1024
+# Response chunks buffered between a bridged Flask request and the client
+BRIDGE_QUEUE_SIZE = 8
+EVENTS_PATH = '/api/staff/events'
+
+
+def async_database_url(database_url):
+    """Translate the app's database URL to its async driver equivalent"""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f'ASGI mode does not support the {backend} database backend')
+    drivername, _ = ASYNC_DRIVERS[backend]
+    url = url.set(drivername=drivername)
+    # asyncpg takes ``ssl`` where libpq takes ``sslmode``
+    if backend == 'postgresql' and 'sslmode' in url.query:
+        sslmode = url.query['sslmode']
+        url = url.difference_update_query(['sslmode']).update_query_dict({'ssl': sslmode})
+    return url
+
+
+def create_async_engine_for(app):
+    """Async engine for the Flask app's database, with a clear error when the driver is missing"""
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = async_database_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    options = {'pool_pre_ping': True}
+    if url.get_backend_name() == 'postgresql':
+        options.update(pool_size=app.config['ASGI_DB_POOL_SIZE'], max_overflow=app.config['ASGI_DB_MAX_OVERFLOW'])
+    try:
+        engine = create_async_engine(url, **options)
+    except ImportError as e:
+        package = ASYNC_DRIVERS[url.get_backend_name()][1]
+        raise RuntimeError(f'ASGI mode needs the {package} package for this database: pip install {package}') from e
+    if url.get_backend_name() == 'sqlite':
+        configure_engine(engine.sync_engine, app.config)
+    return engine
+
+
+class FileBody:
+    """Native handler result that streams a file as an attachment"""
+
+    def __init__(self, path):
+        self.path = path
+
+
+# Native handlers: called with an AsyncSession and the verified boss id
+
+async def list_staff(session, boss_id):
+    result = await session.execute(select(Staff).where(Staff.boss_id == boss_id))
+    return jsonify({'staff': [staff.to_dict() for staff in result.scalars()]}), 200
+
+
+async def get_staff(session, boss_id, staff_id):
+    staff = await _get_staff(session, boss_id, staff_id)
+    if staff:
+        return jsonify({'staff': staff.to_dict()}), 200
+    return jsonify({'error': 'Staff not found'}), 404
+
+
+async def search_staff(session, boss_id):
+    try:
+        options = StaffService.search_args(request.args)
+    except ValueError:
+        return jsonify({'error': 'limit and offset must be numbers'}), 400
+
+    query, filters, limit = options['query'], options['filters'], options['limit']
+    statement = StaffService.search_page_statement(boss_id, query, filters, limit, options['offset'])
+    try:
+        if limit is None:
+            result = await session.execute(statement)
+            body = {'staff': [StaffService.staff_row(staff) for staff in result.scalars()]}
+        else:
+            rows = (await session.execute(statement)).all()
+            body = {'staff': [StaffService.staff_row(row[0]) for row in rows]}
+            if rows:
+                body['total'] = rows[0][1]
+            elif options['offset']:
+                conditions = StaffService.search_conditions(boss_id, query, filters=filters)
+                body['total'] = await session.scalar(select(func.count()).select_from(Staff).where(*conditions))
+            else:
+                body['total'] = 0
+        if options['facets']:
+            statement = StaffService.facet_statement(boss_id, query, filters, session.bind.dialect.name)
+            body['facets'] = StaffService.facet_counts(await session.execute(statement))
+    except Exception:
+        logger.exception('Search staff error')
+        body = {'staff': []}
+        if limit is not None:
+            body['total'] = 0
+        if options['facets']:
+            body['facets'] = {field: [] for field in FACET_FIELDS}
+    return jsonify(body), 200
+
+
+async def dashboard(session, boss_id):
+    result = await session.execute(select(Staff).where(Staff.boss_id == boss_id))
+    staff_list = [staff.to_dict() for staff in result.scalars()]
+    return jsonify(StaffService.build_dashboard(staff_list)), 200
+
+
+async def download_proof_of_id(session, boss_id, staff_id):
+    staff = await _get_staff(session, boss_id, staff_id)
+    if not staff or not staff.proof_of_id:
+        return jsonify({'error': 'File not found'}), 404
+
+    storage = get_storage()
+    if storage.direct:
+        # As FileService.get_download_url: nothing has been uploaded yet
+        if staff.proof_of_id == 'pending_upload':
+            return jsonify({'error': 'File not found'}), 404
+        # Signing is local computation; the client fetches the bytes from the store
+        ttl = current_app.config['STORAGE_URL_TTL']
+        return redirect(storage.presigned_download_url(staff.proof_of_id, staff.proof_of_id, ttl))
+
+    file_path = storage.local_path(staff.proof_of_id)
+    if await asyncio.to_thread(os.path.exists, file_path):
+        return FileBody(file_path)
+    return jsonify({'error': 'File not found on server'}), 404
+
+
+async def _get_staff(session, boss_id, staff_id):
+    result = await session.execute(select(Staff).where(Staff.id == staff_id, Staff.boss_id == boss_id))
+    return result.scalars().first()
+
+
+ROUTES = [
+    ('GET', re.compile(r'/api/staff'), list_staff),
+    ('GET', re.compile(r'/api/staff/search'), search_staff),
+    ('GET', re.compile(r'/api/staff/(?P<staff_id>\d+)'), get_staff),
+    ('GET', re.compile(r'/api/staff/(?P<staff_id>\d+)/download-id'), download_proof_of_id),
+    ('GET', re.compile(r'/api/dashboard'), dashboard),
+]
+
+
+def match_route(method, path):
+    for route_method, pattern, handler in ROUTES:
+        if method != route_method:
+            continue
+        match = pattern.fullmatch(path)
+        if match:
+            return handler, {key: int(value) for key, value in match.groupdict().items()}
+    return None, None
+
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        # The body is fully buffered, so it can be read to EOF without a Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class AsgiApp:
+    """ASGI application serving the Flask app's API"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.engine = None
+        self.session_factory = None
+        self._engine_lock = asyncio.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            path = unquote(scope['path'])
+            if scope['method'] == 'GET' and path == EVENTS_PATH:
+                await self._events(scope, receive, send)
+                return
+            handler, params = match_route(scope['method'], path)
+            if handler is None:
+                await self._bridge(scope, receive, send)
+            else:
+                await self._native(scope, send, handler, params)
+        else:
+            raise RuntimeError(f"Unsupported ASGI scope type {scope['type']}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.start()
+                except Exception as e:
+                    logger.exception('ASGI startup failed')
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def start(self):
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+
+        async with self._engine_lock:
+            if self.engine is None:
+                self.engine = create_async_engine_for(self.flask_app)
+                self.session_factory = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def stop(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    async def _native(self, scope, send, handler, params):
+        """Run an async handler inside a Flask request context and send its response"""
+        if self.engine is None:
+            # Servers without lifespan support
+            await self.start()
+
+        app = self.flask_app
+        environ = build_environ(scope, b'')
+        environ[SKIP_ENVIRON_KEY] = True
+        file_path = None
+
+        with app.request_context(environ):
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    # The revocation check may sync from or look the token up in the database;
+                    # the thread sees this request context through the copied contextvars
+                    await asyncio.to_thread(verify_jwt_in_request)
+                    boss_id = int(get_jwt_identity())
+                    async with self.session_factory() as session:
+                        rv = await handler(session, boss_id, **params)
+            except Exception as e:
+                rv = self._handle_exception(e)
+
+            if isinstance(rv, FileBody):
+                file_path = rv.path
+                try:
+                    rv = await self._file_response(file_path)
+                except OSError as e:
+                    file_path = None
+                    rv = self._handle_exception(e)
+
+            response = app.process_response(app.make_response(rv))
+            start = self._start_message(response)
+            if file_path is None:
+                body = response.get_data()
+
+        await send(start)
+        if file_path is None:
+            await send({'type': 'http.response.body', 'body': body})
+        else:
+            await self._send_file(send, file_path)
+
+    async def _events(self, scope, receive, send):
+        """Serve a staff event stream on the event loop until it ends or the client disconnects"""
+        app = self.flask_app
+        environ = build_environ(scope, b'')
+        environ[SKIP_ENVIRON_KEY] = True
+        broker = subscription = None
+
+        with app.request_context(environ):
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    await asyncio.to_thread(verify_jwt_in_request, locations=['headers', 'query_string'])
+                    broker = get_event_broker()
+                    try:
+                        subscription = broker.subscribe(int(get_jwt_identity()), loop=asyncio.get_running_loop())
+                        rv = app.response_class(b'', mimetype='text/event-stream', headers=STREAM_HEADERS)
+                    except TooManyStreams:
+                        rv = too_many_streams()
+            except Exception as e:
+                rv = self._handle_exception(e)
+
+            response = app.process_response(app.make_response(rv))
+            start = self._start_message(response)
+            body = response.get_data()
+            last_event_id = request.headers.get('Last-Event-ID')
+            heartbeat = app.config['EVENTS_HEARTBEAT_SECONDS']
+            max_seconds = app.config['EVENTS_STREAM_SECONDS']
+
+        if subscription is None:
+            await send(start)
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            subscription.close()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            start['headers'] = [header for header in start['headers'] if header[0] != b'content-length']
+            await send(start)
+            async for chunk in astream(broker, subscription, last_event_id, heartbeat, max_seconds):
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            # Client went away mid-send
+            pass
+        finally:
+            watcher.cancel()
+            broker.unsubscribe(subscription)
+
+    def _handle_exception(self, error):
+        app = self.flask_app
+        try:
+            return app.handle_user_exception(error)
+        except Exception as unhandled:
+            return app.handle_exception(unhandled)
+
+    async def _file_response(self, file_path):
+        size = await asyncio.to_thread(os.path.getsize, file_path)
+        filename = os.path.basename(file_path)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = self.flask_app.response_class(b'', mimetype=mimetype)
+        response.headers['Content-Length'] = str(size)
+        response.headers['Content-Disposition'] = dump_options_header('attachment', {'filename': filename})
+        return response
+
+    @staticmethod
+    async def _send_file(send, file_path):
+        fh = await asyncio.to_thread(open, file_path, 'rb')
+        try:
+            while True:
+                chunk = await asyncio.to_thread(fh.read, FILE_CHUNK_SIZE)
+                more = len(chunk) == FILE_CHUNK_SIZE
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': more})
+                if not more:
+                    break
+        finally:
+            await asyncio.to_thread(fh.close)
+
+    @staticmethod
+    def _start_message(response):
+        return {
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response.headers.items()],
+        }
+
+    async def _bridge(self, scope, receive, send):
+        """Run the Flask WSGI app on a worker thread, streaming its response back.
+
+        The whole WSGI call, including iterating a streamed body, happens on
+        one thread so ``stream_with_context`` keeps its request context. A
+        small queue gives backpressure when the client reads slowly.
+        """
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.extend(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        environ = build_environ(scope, bytes(body))
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=BRIDGE_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        def put(message):
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        def run_wsgi():
+            started = {}
+
+            def start_response(status, headers, exc_info=None):
+                started['message'] = {
+                    'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+                }
+                return lambda data: None
+
+            result = None
+            try:
+                result = self.flask_app.wsgi_app(environ, start_response)
+                for chunk in result:
+                    if stopped.is_set():
+                        return
+                    if 'message' in started:
+                        put(started.pop('message'))
+                    if chunk:
+                        put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if 'message' in started:
+                    put(started.pop('message'))
+                put({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+                put(None)
+
+        worker = asyncio.ensure_future(asyncio.to_thread(run_wsgi))
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                await send(message)
+        finally:
+            # Unblock a worker waiting on a full queue after the client went away
+            stopped.set()
+            while not queue.empty():
+                queue.get_nowait()
+            await worker
+
+
+def create_asgi_app(flask_app=None):
+    """ASGI application for ``flask_app`` (a new ``create_app()`` by default)"""
+    flask_app = flask_app or create_app()
+    flask_app.config.setdefault('ASGI_DB_POOL_SIZE', int(os.environ.get('ASGI_DB_POOL_SIZE', 20)))
+    flask_app.config.setdefault('ASGI_DB_MAX_OVERFLOW', int(os.environ.get('ASGI_DB_MAX_OVERFLOW', 10)))
+    return AsgiApp(flask_app)
@@ -0,0 +1,189 @@
+import os
+import base64
+import logging
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g, jsonify, request
+from flask_jwt_extended import verify_jwt_in_request
+from werkzeug.test import EnvironBuilder
+
+from .revocation import get_revocation_list
+
+logger = logging.getLogger(__name__)
+
+# Where flask_jwt_extended keeps a verified token for get_jwt() and get_jwt_identity()
+_JWT_G_KEYS = ('_jwt_extended_jwt', '_jwt_extended_jwt_header',
+               '_jwt_extended_jwt_user', '_jwt_extended_jwt_location')
+
+# Environ key carrying the batch's verified token into its sub-requests. Clients
+# can't set it: request headers only reach the environ as HTTP_* keys.
+VERIFIED_TOKEN_ENVIRON_KEY = 'backend.batch.verified_token'
+
+READ_ONLY_METHODS = {'GET', 'HEAD'}
+ALLOWED_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'DELETE'}
+# Batch itself, and the event stream, which would hold the batch open
+UNBATCHABLE_PATHS = {'/api/batch', '/api/staff/events'}
+
+
+class BatchError(ValueError):
+    """Raised for a malformed batch envelope"""
+
+
+def validate_batch(items, max_requests):
+    """Check the envelope and normalise each sub-request"""
+    if not isinstance(items, list) or not items:
+        raise BatchError('requests must be a non-empty list')
+    if len(items) > max_requests:
+        raise BatchError(f'At most {max_requests} requests per batch')
+
+    normalised = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+            raise BatchError(f'Request {index} must be an object with a path')
+        method = str(item.get('method', 'GET')).upper()
+        path = item['path']
+        if method not in ALLOWED_METHODS:
+            raise BatchError(f'Request {index}: method {method} is not allowed')
+        if not path.startswith('/api/') or path.split('?', 1)[0].rstrip('/') in UNBATCHABLE_PATHS:
+            raise BatchError(f'Request {index}: path must be an /api/ route other than '
+                             f'{" or ".join(sorted(UNBATCHABLE_PATHS))}')
+        normalised.append({
+            'id': item.get('id', index),
+            'method': method,
+            'path': path,
+            'body': item.get('body'),
+        })
+    return normalised
+
+
+def jwt_required(**options):
+    """flask_jwt_extended's jwt_required, reusing the token a batch has already verified"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            verified = request.environ.get(VERIFIED_TOKEN_ENVIRON_KEY)
+            if verified is None or options.get('fresh') or options.get('refresh'):
+                verify_jwt_in_request(**options)
+            else:
+                vars(g).update(verified)
+            return current_app.ensure_sync(fn)(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _serialise_response(item_id, response):
+    envelope = {'id': item_id, 'status': response.status_code}
+    # send_file responses hand the file straight to the server; read it here instead
+    response.direct_passthrough = False
+    if response.is_json:
+        envelope['body'] = response.get_json()
+    elif response.mimetype.startswith('text/'):
+        envelope['body'] = response.get_data(as_text=True)
+    else:
+        envelope['body'] = base64.b64encode(response.get_data()).decode('ascii')
+        envelope['body_encoding'] = 'base64'
+        envelope['content_type'] = response.content_type
+    return envelope
+
+
+def _dispatch(app, item, authorization, verified):
+    """Run one sub-request in its own request context with the batch's verified token"""
+    path, _, query_string = item['path'].partition('?')
+    builder = EnvironBuilder(
+        path=path,
+        query_string=query_string,
+        method=item['method'],
+        headers={'Authorization': authorization} if authorization else None,
+        json=item['body'] if item['body'] is not None else None,
+        environ_overrides={VERIFIED_TOKEN_ENVIRON_KEY: verified} if verified else None,
+    )
+    with app.request_context(builder.get_environ()) as ctx:
+        try:
+            response = app.preprocess_request()
+            if response is None:
+                if ctx.request.routing_exception is not None:
+                    raise ctx.request.routing_exception
+                response = app.view_functions[ctx.request.url_rule.endpoint](**ctx.request.view_args)
+        except Exception as e:
+            # HTTP errors and exceptions with a registered handler, such as a revoked token
+            try:
+                response = app.handle_user_exception(e)
+            except Exception:
+                logger.exception('Batch sub-request %s %s failed', item['method'], item['path'])
+                response = jsonify({'error': 'Internal server error'}), 500
+
+        response = app.process_response(app.make_response(response))
+        try:
+            return _serialise_response(item['id'], response)
+        finally:
+            response.close()
+
+
+def _dispatch_isolated(app, item, authorization, verified):
+    """Run a read-only sub-request on a worker thread with its own app context and session"""
+    with app.app_context():
+        return _dispatch(app, item, authorization, verified)
+
+
+def run_batch(items):
+    """Execute validated sub-requests in order and return their response envelopes.
+
+    The token is verified once, for the batch, and handed to each sub-request.
+    Sub-requests run one after another in the caller's application context, so
+    they share its database session. With BATCH_MAX_WORKERS above 1,
+    consecutive read-only sub-requests run concurrently instead; a session
+    can't be shared between threads, so each of those checks out its own.
+    """
+    app = current_app._get_current_object()
+    authorization = request.headers.get('Authorization')
+    if not g.get('_jwt_extended_jwt'):
+        verify_jwt_in_request()
+    verified = {key: g.get(key) for key in _JWT_G_KEYS}
+    max_workers = app.config['BATCH_MAX_WORKERS']
+    results = [None] * len(items)
+
+    # Sub-requests run their own request hooks; keep the outer request's g intact
+    saved_g = dict(vars(g))
+
+    def flush_reads(pending):
+        if len(pending) == 1 or max_workers <= 1:
+            for index in pending:
+                results[index] = _dispatch(app, items[index], authorization, verified)
+                _restore_g(saved_g)
+            return
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as pool:
+            futures = {index: pool.submit(_dispatch_isolated, app, items[index], authorization, verified)
+                       for index in pending}
+        for index, future in futures.items():
+            results[index] = future.result()
+
+    pending_reads = []
+    for index, item in enumerate(items):
+        if item['method'] in READ_ONLY_METHODS:
+            pending_reads.append(index)
+            continue
+        if pending_reads:
+            flush_reads(pending_reads)
+            pending_reads = []
+        results[index] = _dispatch(app, item, authorization, verified)
+        _restore_g(saved_g)
+        if verified and get_revocation_list().is_revoked(verified['_jwt_extended_jwt']):
+            # Logged out part-way through; later sub-requests verify the header and get 401
+            verified = None
+
+    if pending_reads:
+        flush_reads(pending_reads)
+
+    return results
+
+
+def _restore_g(saved):
+    current = vars(g)
+    current.clear()
+    current.update(saved)
+
+
+def init_app(app):
+    app.config.setdefault('BATCH_MAX_REQUESTS', int(os.environ.get('BATCH_MAX_REQUESTS', 20)))
+    app.config.setdefault('BATCH_MAX_WORKERS', int(os.environ.get('BATCH_MAX_WORKERS', 1)))
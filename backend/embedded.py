@@ -0,0 +1,226 @@
+"""Embedded single-node mode on SQLite.
+
+Without DATABASE_URL the app runs on a SQLite file in the instance folder,
+so small deployments, benchmarks and CI need no database server. Every
+connection is opened in WAL mode (readers never block the writer) with
+synchronous=NORMAL, a memory map and a sized page cache; see the SQLITE_*
+settings in ``init_app``.
+
+SQLite allows one writer at a time. Rather than letting concurrent writers
+from several gunicorn workers poll on SQLITE_BUSY until one gives up with
+"database is locked", a connection takes the process-wide writer lock
+(a thread lock plus an flock on ``<database>.writer-lock``) before its first
+write statement and holds it until it goes back to the pool, so writers
+queue on the lock instead. Reads never take it.
+
+Postgres deployments are unaffected: ``init_app`` does nothing for other
+databases.
+"""
+import os
+import time
+import logging
+import threading
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.types import Boolean
+
+from . import db
+
+try:
+    import fcntl
+except ImportError:  # Windows: the thread lock alone still serialises writers within a process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATABASE = 'marynola.db'
+# Statements that need SQLite's write lock
+WRITE_VERBS = frozenset(('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER'))
+# Set in a pooled connection's info while it holds the writer lock
+HOLDS_WRITER_LOCK = 'embedded_writer_lock'
+
+
+def default_database_url(app):
+    """SQLite file in the instance folder, used when DATABASE_URL is not set"""
+    os.makedirs(app.instance_path, exist_ok=True)
+    return 'sqlite:///' + os.path.join(app.instance_path, DEFAULT_DATABASE)
+
+
+def database_path(url):
+    """File behind a SQLite URL, or None for other databases and in-memory SQLite"""
+    url = make_url(url)
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return os.path.abspath(url.database)
+
+
+class icontains(FunctionElement):
+    """Case-insensitive LIKE: ILIKE on Postgres, plain LIKE on SQLite.
+
+    SQLite's LIKE already ignores ASCII case, and its lower() is ASCII-only
+    too, so the lower(x) LIKE lower(y) that ilike() compiles to there gives
+    the same matches at the cost of two function calls per row.
+    """
+    type = Boolean()
+    inherit_cache = True
+    name = 'icontains'
+    # Renders as a comparison, so SQLite needs no "= 1" to use it as a condition
+    _is_implicitly_boolean = True
+
+
+@compiles(icontains)
+def _compile_icontains(element, compiler, **kw):
+    column, pattern = element.clauses
+    return compiler.process(column.ilike(pattern), **kw)
+
+
+@compiles(icontains, 'sqlite')
+def _compile_icontains_sqlite(element, compiler, **kw):
+    column, pattern = element.clauses
+    return compiler.process(column.like(pattern), **kw)
+
+
+class WriterLock:
+    """One writer at a time across the threads and processes sharing a database file"""
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._thread_lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+
+    def _file(self):
+        # Reopen after fork: an inherited descriptor would share the parent's flock
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    def acquire(self):
+        """Wait up to ``timeout`` seconds; returns False if the lock could not be taken"""
+        deadline = time.monotonic() + self.timeout
+        if not self._thread_lock.acquire(timeout=self.timeout):
+            return False
+        if fcntl is None:
+            return True
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(self._file(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    self._thread_lock.release()
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+
+    def release(self):
+        if fcntl is not None:
+            fcntl.flock(self._file(), fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+
+def pragmas(config):
+    """PRAGMA statements run on every new connection"""
+    return [
+        'PRAGMA journal_mode=WAL',
+        f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}",
+        f"PRAGMA cache_size=-{int(config['SQLITE_CACHE_SIZE_KB'])}",
+        f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}",
+        'PRAGMA temp_store=MEMORY',
+    ]
+
+
+def configure_engine(engine, config):
+    """Apply the connection pragmas to ``engine`` (sync, or an async engine's sync_engine)"""
+    statements = pragmas(config)
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+
+def install_writer_lock(engine, lock):
+    """Hold ``lock`` from a connection's first write until it is returned to the pool"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if HOLDS_WRITER_LOCK in conn.info:
+            return
+        verb = statement.lstrip()[:7].split(None, 1)
+        if not verb or verb[0].upper() not in WRITE_VERBS:
+            return
+        if lock.acquire():
+            conn.info[HOLDS_WRITER_LOCK] = True
+        else:
+            # Fall back to SQLite's own busy handling rather than failing the request here
+            conn.info[HOLDS_WRITER_LOCK] = False
+            logger.warning('Timed out waiting for the SQLite writer lock', extra={'timeout': lock.timeout})
+
+    def _release(dbapi_connection, connection_record, *args):
+        if connection_record is not None and connection_record.info.pop(HOLDS_WRITER_LOCK, False):
+            lock.release()
+
+    event.listen(engine, 'checkin', _release)
+    event.listen(engine, 'invalidate', _release)
+    event.listen(engine, 'soft_invalidate', _release)
+
+
+@click.group('embedded', cls=AppGroup)
+def embedded_cli():
+    """Embedded SQLite mode"""
+
+
+@embedded_cli.command('status')
+def status_command():
+    """Show the database file and the pragmas in effect"""
+    path = database_path(current_app.config['SQLALCHEMY_DATABASE_URI'])
+    if path is None:
+        raise click.ClickException('Not running on a SQLite file')
+    click.echo(f'database={path}')
+    with db.engine.connect() as conn:
+        for name in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size', 'page_size',
+                     'page_count', 'freelist_count'):
+            click.echo(f'{name}={conn.execute(text(f"PRAGMA {name}")).scalar()}')
+
+
+@embedded_cli.command('checkpoint')
+def checkpoint_command():
+    """Copy the WAL into the database file and truncate it"""
+    with db.engine.connect() as conn:
+        busy, log_frames, checkpointed = conn.execute(text('PRAGMA wal_checkpoint(TRUNCATE)')).one()
+    click.echo(f'busy={busy} log_frames={log_frames} checkpointed={checkpointed}')
+
+
+def init_app(app):
+    app.config.setdefault('SQLITE_SYNCHRONOUS', os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'))
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT_MS', int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)))
+    app.config.setdefault('SQLITE_CACHE_SIZE_KB', int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64 * 1024)))
+    app.config.setdefault('SQLITE_MMAP_SIZE', int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)))
+    app.config.setdefault('SQLITE_WRITE_LOCK_TIMEOUT', float(os.environ.get('SQLITE_WRITE_LOCK_TIMEOUT', 30)))
+
+    path = database_path(app.config['SQLALCHEMY_DATABASE_URI'])
+    if path is None:
+        return
+
+    with app.app_context():
+        engine = db.engine
+    configure_engine(engine, app.config)
+    lock = WriterLock(path + '.writer-lock', timeout=app.config['SQLITE_WRITE_LOCK_TIMEOUT'])
+    install_writer_lock(engine, lock)
+    app.extensions['embedded_writer_lock'] = lock
+    app.cli.add_command(embedded_cli)
@@ -0,0 +1,419 @@
+"""Server-sent events for staff changes.
+
+``GET /api/staff/events`` streams one event per committed staff write for
+the caller's boss, so the dashboard and staff list can patch themselves
+instead of polling /api/staff and /api/dashboard::
+
+    id: 3f9c1a-17
+    event: staff
+    data: {"action": "updated", "id": 12, "dashboard": {"employment_status_breakdown": {"Full-time": -1, "Contract": 1}}}
+
+``dashboard`` holds the changes to the /api/dashboard statistics (only the
+counters that moved). Events come from ``staff_changed`` and fan out through
+a broker:
+
+* ``memory`` (default): subscribers in this process only. Enough for a
+  single worker; with several, a client only hears about writes handled by
+  the worker it is connected to.
+* ``postgres``: events go through ``pg_notify`` on STAFF_EVENTS_CHANNEL and
+  a LISTEN thread in each worker delivers them to its subscribers, so every
+  client hears every write.
+
+A reconnecting EventSource sends Last-Event-ID; missed events still held in
+this worker's per-boss backlog are replayed, otherwise the client gets a
+``resync`` event and should refetch. A stream that falls too far behind gets
+``resync`` too. Streams end after EVENTS_STREAM_SECONDS and the browser
+reconnects, which re-checks the token.
+
+An open stream occupies whatever serves it for its whole life. Under the
+ASGI app (``asgi.py``) it is served natively on the event loop and costs no
+thread. Under WSGI it holds a worker thread, so run gunicorn with a
+threaded or gevent worker class (``-k gthread --threads N`` or
+``-k gevent``); a sync gunicorn worker would be blocked by a single
+dashboard tab, and refuses streams with 503 instead. Either way each worker
+serves at most EVENTS_MAX_STREAMS streams at once and answers further ones
+with 503 and Retry-After; keep it below the thread count under gthread so
+API requests still get threads.
+"""
+import os
+import json
+import time
+import queue
+import asyncio
+import select
+import logging
+import threading
+from collections import deque
+
+from flask import current_app, jsonify
+
+from . import db
+from .signals import staff_changed
+
+logger = logging.getLogger(__name__)
+
+# staff_changed action -> event action
+ACTIONS = {'added': 'created', 'updated': 'updated', 'deleted': 'deleted'}
+
+# /api/dashboard statistics key -> staff field it counts
+DASHBOARD_COUNTERS = (
+    ('employment_status_breakdown', 'employment_status'),
+    ('immigration_status_breakdown', 'immigration_status'),
+    ('gender_breakdown', 'sex'),
+)
+
+# Browser reconnect delay sent at the start of each stream, in milliseconds
+RETRY_MS = 3000
+RESYNC = 'event: resync\ndata: {}\n\n'
+KEEPALIVE = ': keepalive\n\n'
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+class TooManyStreams(Exception):
+    """This worker already serves EVENTS_MAX_STREAMS streams"""
+
+
+def dashboard_delta(action, staff, previous=None):
+    """Changes to the /api/dashboard statistics caused by one staff write"""
+    delta = {}
+    if action == 'added':
+        delta['total_staff'] = 1
+    elif action == 'deleted':
+        delta['total_staff'] = -1
+    for key, field in DASHBOARD_COUNTERS:
+        counts = {}
+        if action == 'deleted':
+            counts[staff.get(field)] = -1
+        elif action == 'added':
+            counts[staff.get(field)] = 1
+        elif previous is not None and previous.get(field) != staff.get(field):
+            counts[previous.get(field)] = -1
+            counts[staff.get(field)] = 1
+        if counts:
+            delta[key] = counts
+    return delta
+
+
+class Subscription:
+    """One connected stream: a bounded queue of (seq, event) pairs"""
+
+    # Put on the queue in place of events the subscriber was too slow to take
+    LAGGED = object()
+
+    def __init__(self, boss_id, size):
+        self.boss_id = boss_id
+        self.queue = queue.Queue(maxsize=size)
+
+    def offer(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # Make room for the marker; the stream ends with a resync
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(self.LAGGED)
+            except queue.Full:
+                pass
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscription(Subscription):
+    """Subscription consumed on an event loop; events may be offered from any thread"""
+
+    # Put on the queue when the client disconnects
+    CLOSED = object()
+
+    def __init__(self, boss_id, size, loop):
+        self.boss_id = boss_id
+        self.queue = asyncio.Queue(maxsize=size)
+        self.loop = loop
+
+    def offer(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self._offer, item)
+        except RuntimeError:
+            # Loop already closed; the stream is gone
+            pass
+
+    def _offer(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(self.LAGGED)
+
+    def close(self):
+        self.offer(self.CLOSED)
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBroker:
+    """In-process fan-out of staff events to the streams of each boss"""
+
+    def __init__(self, queue_size=256, backlog=100, max_streams=50):
+        self.queue_size = queue_size
+        self.backlog = backlog
+        self.max_streams = max_streams
+        # Event ids are '<epoch>-<seq>' with a per-boss seq; a Last-Event-ID from
+        # another process or run has a different epoch
+        self.epoch = os.urandom(3).hex()
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._streams = 0
+        self._seqs = {}
+        self._backlogs = {}
+
+    def subscribe(self, boss_id, loop=None):
+        """New subscription for ``boss_id``, async when ``loop`` is given; raises TooManyStreams"""
+        if loop is None:
+            subscription = Subscription(boss_id, self.queue_size)
+        else:
+            subscription = AsyncSubscription(boss_id, self.queue_size, loop)
+        with self._lock:
+            if self._streams >= self.max_streams:
+                raise TooManyStreams()
+            self._subscribers.setdefault(boss_id, set()).add(subscription)
+            self._streams += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Safe to call more than once"""
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.boss_id)
+            if subscribers is not None and subscription in subscribers:
+                subscribers.discard(subscription)
+                self._streams -= 1
+                if not subscribers:
+                    del self._subscribers[subscription.boss_id]
+
+    def subscriber_count(self):
+        with self._lock:
+            return self._streams
+
+    def publish(self, boss_id, event):
+        """Send ``event`` to every stream of ``boss_id``"""
+        self._deliver(boss_id, event)
+
+    def _deliver(self, boss_id, event):
+        with self._lock:
+            seq = self._seqs[boss_id] = self._seqs.get(boss_id, 0) + 1
+            item = (seq, event)
+            self._backlogs.setdefault(boss_id, deque(maxlen=self.backlog)).append(item)
+            subscribers = list(self._subscribers.get(boss_id, ()))
+        for subscription in subscribers:
+            subscription.offer(item)
+
+    def missed(self, boss_id, last_event_id):
+        """Events after ``last_event_id``, or None if they are no longer all held"""
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self._lock:
+            latest = self._seqs.get(boss_id, 0)
+            held = list(self._backlogs.get(boss_id, ()))
+        if seq > latest:
+            return None
+        missed = [item for item in held if item[0] > seq]
+        if len(missed) != latest - seq:
+            return None
+        return missed
+
+    def event_id(self, seq):
+        return f'{self.epoch}-{seq}'
+
+    def close(self):
+        pass
+
+
+class PostgresBroker(EventBroker):
+    """Fan-out across workers through Postgres LISTEN/NOTIFY"""
+
+    def __init__(self, app, channel='staff_events', **kwargs):
+        super().__init__(**kwargs)
+        self.app = app
+        self.channel = channel
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def publish(self, boss_id, event):
+        payload = json.dumps({'boss_id': boss_id, 'event': event}, separators=(',', ':'))
+        with db.engine.begin() as conn:
+            conn.execute(db.select(db.func.pg_notify(self.channel, payload)))
+
+    def subscribe(self, boss_id, loop=None):
+        self._ensure_listener()
+        return super().subscribe(boss_id, loop)
+
+    def _ensure_listener(self):
+        # Started on first subscribe, so a forked worker starts its own
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name='staff-events-listen', daemon=True)
+                self._thread.start()
+
+    def _listen(self):
+        delay = 1
+        while not self._stopped.is_set():
+            try:
+                with self.app.app_context():
+                    raw = db.engine.raw_connection()
+                try:
+                    connection = raw.driver_connection
+                    connection.autocommit = True
+                    with connection.cursor() as cursor:
+                        cursor.execute(f'LISTEN "{self.channel}"')
+                    delay = 1
+                    while not self._stopped.is_set():
+                        if select.select([connection], [], [], 5) == ([], [], []):
+                            continue
+                        connection.poll()
+                        while connection.notifies:
+                            self._dispatch(connection.notifies.pop(0).payload)
+                finally:
+                    raw.invalidate()
+            except Exception:
+                logger.exception('Staff events listener failed; reconnecting')
+                self._stopped.wait(delay)
+                delay = min(delay * 2, 30)
+
+    def _dispatch(self, payload):
+        try:
+            message = json.loads(payload)
+            self._deliver(message['boss_id'], message['event'])
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Ignoring malformed staff event', extra={'payload': payload[:200]})
+
+    def close(self):
+        self._stopped.set()
+
+
+def get_event_broker():
+    return current_app.extensions['staff_events']
+
+
+def format_event(event_id, name, data):
+    return f'id: {event_id}\nevent: {name}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def too_many_streams():
+    response = jsonify({'error': 'Too many live update streams on this server; try again shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(RETRY_MS // 1000)
+    return response
+
+
+def _opening(broker, boss_id, last_event_id):
+    """Chunks that start a stream (retry hint, replayed events); returns (chunks, last seq sent)"""
+    chunks, sent = [f'retry: {RETRY_MS}\n\n'], 0
+    if last_event_id:
+        missed = broker.missed(boss_id, last_event_id)
+        if missed is None:
+            chunks.append(RESYNC)
+            missed = []
+        for seq, event in missed:
+            sent = seq
+            chunks.append(format_event(broker.event_id(seq), 'staff', event))
+    return chunks, sent
+
+
+def stream(broker, subscription, last_event_id=None, heartbeat=15, max_seconds=300):
+    """SSE body for one client; unsubscribes when the client goes away or the stream ends"""
+    # Events published while the backlog is replayed arrive on the queue as well
+    try:
+        chunks, sent = _opening(broker, subscription.boss_id, last_event_id)
+        yield from chunks
+
+        deadline = time.monotonic() + max_seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            item = subscription.get(min(heartbeat, remaining))
+            if item is None:
+                yield KEEPALIVE
+            elif item is Subscription.LAGGED:
+                yield RESYNC
+                return
+            elif item[0] > sent:
+                sent = item[0]
+                yield format_event(broker.event_id(item[0]), 'staff', item[1])
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def astream(broker, subscription, last_event_id=None, heartbeat=15, max_seconds=300):
+    """``stream`` for an AsyncSubscription; ends when the subscription is closed. The caller unsubscribes."""
+    chunks, sent = _opening(broker, subscription.boss_id, last_event_id)
+    for chunk in chunks:
+        yield chunk
+
+    deadline = time.monotonic() + max_seconds
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        item = await subscription.get(min(heartbeat, remaining))
+        if item is None:
+            yield KEEPALIVE
+        elif item is AsyncSubscription.CLOSED:
+            return
+        elif item is Subscription.LAGGED:
+            yield RESYNC
+            return
+        elif item[0] > sent:
+            sent = item[0]
+            yield format_event(broker.event_id(item[0]), 'staff', item[1])
+
+
+def on_staff_changed(sender, boss_id, action, staff, previous=None):
+    event = {
+        'action': ACTIONS[action],
+        'id': staff.get('id'),
+        'dashboard': dashboard_delta(action, staff, previous),
+    }
+    try:
+        sender.extensions['staff_events'].publish(boss_id, event)
+    except Exception:
+        # The write is committed; a lost event only means a client refetches later
+        logger.exception('Failed to publish staff event')
+
+
+def init_app(app):
+    app.config.setdefault('EVENTS_BROKER', os.environ.get('EVENTS_BROKER', 'memory'))
+    app.config.setdefault('STAFF_EVENTS_CHANNEL', os.environ.get('STAFF_EVENTS_CHANNEL', 'staff_events'))
+    app.config.setdefault('EVENTS_HEARTBEAT_SECONDS', float(os.environ.get('EVENTS_HEARTBEAT_SECONDS', 15)))
+    app.config.setdefault('EVENTS_STREAM_SECONDS', float(os.environ.get('EVENTS_STREAM_SECONDS', 300)))
+    app.config.setdefault('EVENTS_QUEUE_SIZE', int(os.environ.get('EVENTS_QUEUE_SIZE', 256)))
+    app.config.setdefault('EVENTS_BACKLOG', int(os.environ.get('EVENTS_BACKLOG', 100)))
+    app.config.setdefault('EVENTS_MAX_STREAMS', int(os.environ.get('EVENTS_MAX_STREAMS', 50)))
+
+    options = {
+        'queue_size': app.config['EVENTS_QUEUE_SIZE'],
+        'backlog': app.config['EVENTS_BACKLOG'],
+        'max_streams': app.config['EVENTS_MAX_STREAMS'],
+    }
+    if app.config['EVENTS_BROKER'] == 'postgres':
+        broker = PostgresBroker(app, channel=app.config['STAFF_EVENTS_CHANNEL'], **options)
+    elif app.config['EVENTS_BROKER'] == 'memory':
+        broker = EventBroker(**options)
+    else:
+        raise RuntimeError(f"Unknown EVENTS_BROKER {app.config['EVENTS_BROKER']!r}; use 'memory' or 'postgres'")
+
+    app.extensions['staff_events'] = broker
+    staff_changed.connect(on_staff_changed, sender=app)
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# format -> file extension used for cached artifacts
+EXPORT_EXTENSIONS = {'xlsx': 'xlsx', 'csv': 'csv', 'ndjson': 'ndjson'}
+
+
+class ExportJobManager:
+    """Run staff exports in a worker pool and cache the finished files on disk.
+
+    Artifacts are keyed by boss, format, filters and the boss's staff data
+    version, so an unchanged roster is served from disk without rebuilding.
+    Job state lives in small JSON files next to the artifacts, which lets
+    any gunicorn worker on the host answer a status poll.
+    """
+
+    def __init__(self, app, cache_dir, max_workers=2, max_age=24 * 3600, max_bytes=200 * 1024 * 1024):
+        self.app = app
+        self.cache_dir = cache_dir
+        self.jobs_dir = os.path.join(cache_dir, 'jobs')
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='export')
+        self._lock = threading.Lock()
+        self._running = {}  # cache key -> job id
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+    # Cache helpers
+
+    @staticmethod
+    def cache_key(boss_id, export_format, query, filters, data_version):
+        filters = {field: sorted(values) for field, values in (filters or {}).items()}
+        raw = json.dumps([boss_id, export_format, query or '', filters, data_version], sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+    def artifact_path(self, boss_id, export_format, key):
+        return os.path.join(self.cache_dir, f'{boss_id}_{key}.{EXPORT_EXTENSIONS[export_format]}')
+
+    def cached_artifact(self, path):
+        """Return ``path`` if a finished artifact exists there, refreshing its LRU timestamp"""
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    # Job state
+
+    def _job_path(self, job_id):
+        return os.path.join(self.jobs_dir, f'{job_id}.json')
+
+    def _write_job(self, job):
+        path = self._job_path(job['id'])
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(job, fh)
+        os.replace(tmp_path, path)
+
+    def get_job(self, job_id):
+        # Job ids are generated by us; reject anything that is not a plain hex id
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._job_path(job_id)) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def start(self, boss_id, export_format, query, filters, data_version):
+        """Create a job, completing it immediately when the artifact is already cached"""
+        key = self.cache_key(boss_id, export_format, query, filters, data_version)
+        path = self.artifact_path(boss_id, export_format, key)
+
+        with self._lock:
+            running_id = self._running.get(key)
+            if running_id:
+                job = self.get_job(running_id)
+                if job and job['status'] in ('queued', 'running'):
+                    return job
+
+            job = {
+                'id': uuid.uuid4().hex,
+                'boss_id': boss_id,
+                'format': export_format,
+                'status': 'queued',
+                'cached': False,
+                'path': path,
+                'created_at': time.time(),
+                'finished_at': None,
+                'error': None,
+            }
+
+            if self.cached_artifact(path):
+                job.update(status='completed', cached=True, finished_at=time.time())
+                self._write_job(job)
+                return job
+
+            self._write_job(job)
+            self._running[key] = job['id']
+
+        self._executor.submit(self._run, dict(job), key, query, filters)
+        return job
+
+    def _run(self, job, key, query, filters):
+        job['status'] = 'running'
+        self._write_job(job)
+        try:
+            with self.app.app_context():
+                self.build_artifact(job['boss_id'], job['format'], query, filters, job['path'])
+            job['status'] = 'completed'
+        except Exception as e:
+            logger.exception('Export job %s failed', job['id'])
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        finally:
+            job['finished_at'] = time.time()
+            self._write_job(job)
+            with self._lock:
+                self._running.pop(key, None)
+            self.evict()
+
+    @staticmethod
+    def build_artifact(boss_id, export_format, query, filters, path):
+        """Write the export to ``path`` atomically. Needs an application context."""
+        from .services import StaffService, FileService
+
+        directory = os.path.dirname(path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            if export_format == 'xlsx':
+                staff_list = StaffService.get_staff_by_boss_for_export(boss_id, query, filters)
+                with os.fdopen(fd, 'wb') as fh:
+                    fh.write(FileService.create_staff_excel(staff_list).getvalue())
+            else:
+                generate = FileService.generate_staff_csv if export_format == 'csv' else FileService.generate_staff_ndjson
+                rows = StaffService.iter_staff_for_export(boss_id, query, filters)
+                with os.fdopen(fd, 'w', encoding='utf-8', newline='') as fh:
+                    for chunk in generate(rows):
+                        fh.write(chunk)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def store(self, path, data):
+        """Cache bytes produced outside the job pool (e.g. a synchronous download)"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Drop artifacts and job records past max age, then oldest artifacts until under max bytes"""
+        now = time.time()
+        artifacts = []
+
+        for directory in (self.cache_dir, self.jobs_dir):
+            for entry in os.scandir(directory):
+                if not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                # Leave in-progress temp files alone unless they are clearly abandoned
+                if now - stat.st_mtime > self.max_age:
+                    self._remove(entry.path)
+                elif directory == self.cache_dir and not entry.name.endswith('.tmp'):
+                    artifacts.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in artifacts)
+        for _, size, path in sorted(artifacts):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def init_app(app):
+    """Attach an ExportJobManager to ``app``"""
+    app.config.setdefault('EXPORT_CACHE_DIR', os.environ.get(
+        'EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'marynola-exports')))
+    app.config.setdefault('EXPORT_WORKERS', int(os.environ.get('EXPORT_WORKERS', 2)))
+    app.config.setdefault('EXPORT_CACHE_MAX_AGE', int(os.environ.get('EXPORT_CACHE_MAX_AGE', 24 * 3600)))
+    app.config.setdefault('EXPORT_CACHE_MAX_BYTES', int(os.environ.get('EXPORT_CACHE_MAX_BYTES', 200 * 1024 * 1024)))
+
+    app.extensions['export_jobs'] = ExportJobManager(
+        app,
+        app.config['EXPORT_CACHE_DIR'],
+        max_workers=app.config['EXPORT_WORKERS'],
+        max_age=app.config['EXPORT_CACHE_MAX_AGE'],
+        max_bytes=app.config['EXPORT_CACHE_MAX_BYTES'],
+    )
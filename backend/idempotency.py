@@ -0,0 +1,283 @@
+"""Idempotency-Key support for mutating endpoints.
+
+A client that retries a write after a timeout sends the same
+``Idempotency-Key`` header both times. The first request claims the key by
+inserting an ``in_progress`` row into ``idempotency_record``; the unique
+(boss_id, key) constraint makes the claim atomic across threads, processes
+and hosts. When the view finishes, its response is stored on the row and
+every retry gets that stored response back (with ``Idempotent-Replayed:
+true``) without running the view again. A retry that arrives while the
+first request is still running waits for it, up to
+IDEMPOTENCY_WAIT_SECONDS, and then gets 409.
+
+Only completed, non-5xx responses are kept: a crash or server error releases
+the key so the retry runs for real. A key reused with a different method,
+path or body gets 422. Rows expire after IDEMPOTENCY_TTL seconds and are
+purged in the background, together with the oldest rows beyond
+IDEMPOTENCY_MAX_RECORDS; ``flask idempotency purge`` runs that by hand.
+
+Usage, below ``@jwt_required()`` since keys are scoped to the boss::
+
+    @main.route('/api/staff', methods=['POST'])
+    @jwt_required()
+    @idempotent
+    def add_staff():
+        ...
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from functools import wraps
+
+import click
+from flask import Response, current_app, jsonify, request
+from flask.cli import AppGroup
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .models import IdempotencyRecord
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+# Longest pause between checks while waiting on a duplicate in progress
+MAX_POLL_SECONDS = 0.25
+
+_records = IdempotencyRecord.__table__
+
+
+class IdempotencyStore:
+    """Claims keys and stores responses in the idempotency_record table"""
+
+    def __init__(self, app, ttl=24 * 3600, wait=10, lock_timeout=120, max_body_bytes=1024 * 1024,
+                 max_records=100000, purge_interval=3600):
+        self.app = app
+        self.ttl = timedelta(seconds=ttl)
+        self.wait = wait
+        self.lock_timeout = timedelta(seconds=lock_timeout)
+        self.max_body_bytes = max_body_bytes
+        self.max_records = max_records
+        self.purge_interval = purge_interval
+        self._next_purge = time.monotonic() + purge_interval
+
+    # Statements run on their own connections, independent of the view's session
+
+    def get(self, boss_id, key):
+        with db.engine.connect() as conn:
+            return conn.execute(
+                select(_records).where(_records.c.boss_id == boss_id, _records.c.key == key)
+            ).first()
+
+    def is_stale(self, record, now=None):
+        """Expired, or still in progress long after its request must have died"""
+        now = now or datetime.utcnow()
+        if record.expires_at <= now:
+            return True
+        return record.state == 'in_progress' and record.created_at <= now - self.lock_timeout
+
+    def claim(self, boss_id, key, fingerprint):
+        """Claim ``key``; returns (record_id, None) when claimed, or (None, existing_record)"""
+        for _ in range(3):
+            now = datetime.utcnow()
+            try:
+                with db.engine.begin() as conn:
+                    result = conn.execute(insert(_records).values(
+                        boss_id=boss_id, key=key, fingerprint=fingerprint, state='in_progress',
+                        created_at=now, expires_at=now + self.ttl,
+                    ))
+                return result.inserted_primary_key[0], None
+            except IntegrityError:
+                pass
+
+            record = self.get(boss_id, key)
+            if record is not None and not self.is_stale(record, now):
+                return None, record
+            if record is not None:
+                # Delete by id so concurrent takeovers cannot remove each other's claims
+                with db.engine.begin() as conn:
+                    conn.execute(delete(_records).where(_records.c.id == record.id))
+        return None, self.get(boss_id, key)
+
+    def complete(self, record_id, response):
+        """Store a finished response; returns False if it is not worth replaying"""
+        if response.status_code >= 500 or response.direct_passthrough or response.is_streamed:
+            self.release(record_id)
+            return False
+        body = response.get_data()
+        if len(body) > self.max_body_bytes:
+            self.release(record_id)
+            return False
+        with db.engine.begin() as conn:
+            conn.execute(update(_records).where(_records.c.id == record_id).values(
+                state='done',
+                status_code=response.status_code,
+                content_type=response.content_type,
+                location=response.headers.get('Location'),
+                body=body,
+            ))
+        return True
+
+    def release(self, record_id):
+        """Give up a claim so a retry runs the request again"""
+        with db.engine.begin() as conn:
+            conn.execute(delete(_records).where(_records.c.id == record_id))
+
+    def purge(self):
+        """Delete expired records and the oldest finished ones over the cap; returns the count"""
+        with db.engine.begin() as conn:
+            deleted = conn.execute(delete(_records).where(_records.c.expires_at <= datetime.utcnow())).rowcount
+            cutoff = conn.execute(
+                select(_records.c.created_at).order_by(_records.c.created_at.desc())
+                .offset(self.max_records).limit(1)
+            ).scalar()
+            if cutoff is not None:
+                deleted += conn.execute(delete(_records).where(
+                    _records.c.created_at <= cutoff, _records.c.state == 'done')).rowcount
+        if deleted:
+            logger.info('Purged idempotency records', extra={'deleted': deleted})
+        return deleted
+
+    def maybe_purge(self):
+        """Start a background purge when the interval has elapsed"""
+        if not self.purge_interval or time.monotonic() < self._next_purge:
+            return
+        self._next_purge = time.monotonic() + self.purge_interval
+        threading.Thread(target=self._background_purge, name='idempotency-purge', daemon=True).start()
+
+    def _background_purge(self):
+        try:
+            with self.app.app_context():
+                self.purge()
+        except Exception:
+            logger.exception('Idempotency purge failed')
+
+
+def get_idempotency_store():
+    return current_app.extensions['idempotency']
+
+
+def request_fingerprint():
+    """SHA-256 of the method, path, query and body.
+
+    Form fields and files are hashed by value rather than as raw multipart
+    bytes, because clients pick a new boundary on every retry.
+    """
+    digest = hashlib.sha256()
+    digest.update(f'{request.method}\0{request.path}\0'.encode())
+    digest.update(request.query_string + b'\0')
+    if request.mimetype == 'multipart/form-data':
+        for name, value in sorted(request.form.items(multi=True)):
+            digest.update(f'{name}\0{value}\0'.encode())
+        for name, file in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+            digest.update(f'{name}\0{file.filename}\0'.encode())
+            for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+                digest.update(chunk)
+            file.stream.seek(0)
+    elif request.is_json:
+        data = request.get_json(silent=True)
+        digest.update(json.dumps(data, sort_keys=True, separators=(',', ':')).encode())
+    else:
+        digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _replay(record):
+    response = Response(record.body, status=record.status_code, content_type=record.content_type)
+    if record.location:
+        response.headers['Location'] = record.location
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """Replay the stored response for a repeated Idempotency-Key instead of running ``view`` again"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return view(*args, **kwargs)
+        key = key.strip()
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({'error': f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters'}), 400
+
+        store = get_idempotency_store()
+        boss_id = int(get_jwt_identity())
+        fingerprint = request_fingerprint()
+
+        record_id, record = store.claim(boss_id, key, fingerprint)
+        deadline = time.monotonic() + store.wait
+        delay = 0.02
+        while record_id is None:
+            if record is not None:
+                if record.fingerprint != fingerprint:
+                    return jsonify({'error': f'{HEADER} was already used for a different request'}), 422
+                if record.state == 'done':
+                    return _replay(record)
+            if time.monotonic() >= deadline:
+                response = jsonify({'error': f'A request with this {HEADER} is still in progress'})
+                response.headers['Retry-After'] = '1'
+                return response, 409
+            if record is None:
+                record_id, record = store.claim(boss_id, key, fingerprint)
+                continue
+
+            # Duplicate in flight: wait for the first request to finish (or die)
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_SECONDS)
+            record = store.get(boss_id, key)
+            if record is not None and store.is_stale(record):
+                record_id, record = store.claim(boss_id, key, fingerprint)
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            store.release(record_id)
+            raise
+        store.complete(record_id, response)
+        return response
+
+    return wrapper
+
+
+@click.group('idempotency', cls=AppGroup)
+def idempotency_cli():
+    """Idempotency record maintenance"""
+
+
+@idempotency_cli.command('purge')
+def purge_command():
+    """Delete expired idempotency records and trim to IDEMPOTENCY_MAX_RECORDS"""
+    click.echo(f'deleted={get_idempotency_store().purge()}')
+
+
+def _after_request(response):
+    get_idempotency_store().maybe_purge()
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('IDEMPOTENCY_TTL', int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600)))
+    app.config.setdefault('IDEMPOTENCY_WAIT_SECONDS', float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 10)))
+    app.config.setdefault('IDEMPOTENCY_LOCK_TIMEOUT', int(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT', 120)))
+    app.config.setdefault('IDEMPOTENCY_MAX_BODY_BYTES', int(os.environ.get('IDEMPOTENCY_MAX_BODY_BYTES', 1024 * 1024)))
+    app.config.setdefault('IDEMPOTENCY_MAX_RECORDS', int(os.environ.get('IDEMPOTENCY_MAX_RECORDS', 100000)))
+    app.config.setdefault('IDEMPOTENCY_PURGE_INTERVAL', int(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 3600)))
+
+    app.extensions['idempotency'] = IdempotencyStore(
+        app,
+        ttl=app.config['IDEMPOTENCY_TTL'],
+        wait=app.config['IDEMPOTENCY_WAIT_SECONDS'],
+        lock_timeout=app.config['IDEMPOTENCY_LOCK_TIMEOUT'],
+        max_body_bytes=app.config['IDEMPOTENCY_MAX_BODY_BYTES'],
+        max_records=app.config['IDEMPOTENCY_MAX_RECORDS'],
+        purge_interval=app.config['IDEMPOTENCY_PURGE_INTERVAL'],
+    )
+    app.cli.add_command(idempotency_cli)
+    app.after_request(_after_request)
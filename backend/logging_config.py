@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+from flask import g, request, has_request_context
+
+access_logger = logging.getLogger('backend.access')
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+
+
+class RequestContextFilter(logging.Filter):
+    """Attach the current request id, method and route to each record.
+
+    Runs on the QueueHandler, i.e. in the thread that logged, where the
+    request context is still available.
+    """
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.route = request.url_rule.rule if request.url_rule is not None else request.path
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Drop a fraction of high-volume debug events.
+
+    A record can carry its own ``sample_rate`` via ``extra``; otherwise
+    ``debug_rate`` applies to DEBUG records. Warnings and errors are never
+    sampled.
+    """
+
+    def __init__(self, debug_rate=1.0):
+        super().__init__()
+        self.debug_rate = debug_rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = getattr(record, 'sample_rate', None)
+        if rate is None:
+            rate = self.debug_rate if record.levelno <= logging.DEBUG else 1.0
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        payload = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and key != 'sample_rate' and value is not None:
+                payload[key] = value
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+class _PreformattedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that ships the already formatted JSON line.
+
+    Formatting happens in the logging thread so the listener only has to
+    write bytes, and the record is reduced to plain strings before crossing
+    threads.
+    """
+
+    def prepare(self, record):
+        message = self.format(record)
+        record = logging.makeLogRecord({'msg': message, 'levelno': record.levelno,
+                                        'levelname': record.levelname, 'name': record.name})
+        return record
+
+
+def parse_levels(spec):
+    """Parse ``"backend.routes=DEBUG,sqlalchemy.engine=WARNING"`` into a dict"""
+    levels = {}
+    for item in (spec or '').split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level='INFO', module_levels=None, debug_sample_rate=1.0, stream=None):
+    """Route all logging through a queue drained by a background listener thread"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter('%(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _PreformattedQueueHandler(log_queue)
+    queue_handler.setFormatter(JsonFormatter())
+    queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+    queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+def _before_request():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.log_start = time.perf_counter()
+
+
+def _after_request(response):
+    start = g.pop('log_start', None)
+    if start is None:
+        return response
+    response.headers['X-Request-ID'] = g.request_id
+    access_logger.info('request', extra={
+        'status': response.status_code,
+        'duration_ms': round((time.perf_counter() - start) * 1000, 3),
+        'size': response.content_length,
+    })
+    return response
+
+
+def init_app(app):
+    """Configure structured logging and per-request ids for ``app``"""
+    app.config.setdefault('LOG_LEVEL', os.environ.get('LOG_LEVEL', 'INFO'))
+    app.config.setdefault('LOG_LEVELS', os.environ.get('LOG_LEVELS', ''))
+    app.config.setdefault('LOG_DEBUG_SAMPLE_RATE', float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0.1)))
+
+    configure_logging(
+        level=app.config['LOG_LEVEL'],
+        module_levels=parse_levels(app.config['LOG_LEVELS']),
+        debug_sample_rate=app.config['LOG_DEBUG_SAMPLE_RATE'],
+    )
+    app.before_request(_before_request)
+    app.after_request(_after_request)
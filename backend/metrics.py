@@ -0,0 +1,363 @@
+import os
+import re
+import json
+import time
+import atexit
+import logging
+import tempfile
+import threading
+
+from flask import g, request, Response, current_app, has_request_context, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import fcntl
+except ImportError:  # Windows: snapshots of exited workers are kept as they are
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# name -> (type, help, label names, buckets)
+METRICS = {
+    'http_requests_total': (
+        'counter', 'Total HTTP requests by route and status code',
+        ('method', 'route', 'status'), None),
+    'http_request_duration_seconds': (
+        'histogram', 'HTTP request latency in seconds',
+        ('method', 'route'), LATENCY_BUCKETS),
+    'http_response_size_bytes': (
+        'histogram', 'HTTP response body size in bytes',
+        ('method', 'route'), SIZE_BUCKETS),
+    'db_queries_per_request': (
+        'histogram', 'Number of SQL statements executed per request',
+        ('method', 'route'), QUERY_COUNT_BUCKETS),
+    'db_time_per_request_seconds': (
+        'histogram', 'Total time spent in SQL statements per request',
+        ('method', 'route'), LATENCY_BUCKETS),
+    'db_queries_total': (
+        'counter', 'Total SQL statements executed by route',
+        ('route',), None),
+    'db_slow_queries_total': (
+        'counter', 'SQL statements slower than SLOW_QUERY_MS by route',
+        ('route',), None),
+    'singleflight_requests_total': (
+        'counter', 'Coalescable requests by route and outcome (leader, shared, shared_worker, fallback)',
+        ('route', 'outcome'), None),
+}
+
+
+class MetricsRegistry:
+    """Thread-safe in-process store for counters and histograms"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][3]
+        key = (name, tuple(labels))
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # bucket counts followed by sum and count
+                series = [0] * len(buckets) + [0.0, 0]
+                self._values[key] = series
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self):
+        """Return a JSON-serialisable copy of all series"""
+        with self._lock:
+            return [
+                [name, list(labels), list(value) if isinstance(value, list) else value]
+                for (name, labels), value in self._values.items()
+            ]
+
+
+registry = MetricsRegistry()
+
+
+def merge_snapshots(snapshots):
+    """Sum series from several worker snapshots"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(labels))
+            current = merged.get(key)
+            if current is None:
+                merged[key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                merged[key] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[key] = current + value
+    return merged
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_prometheus(merged):
+    """Render merged series in the Prometheus text exposition format"""
+    lines = []
+    for name, (metric_type, help_text, label_names, buckets) in METRICS.items():
+        series = sorted((labels, value) for (n, labels), value in merged.items() if n == name)
+        if not series:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in series:
+            if metric_type == 'counter':
+                lines.append(f'{name}{_format_labels(label_names, labels)} {value}')
+                continue
+            # Prometheus buckets are cumulative, ours are already "<= bound"
+            for bound, count in zip(buckets, value):
+                le = ('le', repr(float(bound)) if isinstance(bound, float) else str(bound))
+                lines.append(f'{name}_bucket{_format_labels(label_names, labels, le)} {count}')
+            lines.append(f'{name}_bucket{_format_labels(label_names, labels, ("le", "+Inf"))} {value[-1]}')
+            lines.append(f'{name}_sum{_format_labels(label_names, labels)} {value[-2]}')
+            lines.append(f'{name}_count{_format_labels(label_names, labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+WORKER_SNAPSHOT = re.compile(r'worker_(\d+)_\d+\.json')
+# Counts of workers that have exited, so totals do not drop when a worker is replaced
+RETIRED_SNAPSHOT = 'retired.json'
+
+
+def _exited(entry):
+    """True if ``entry`` is the snapshot of a worker process that is no longer running"""
+    match = WORKER_SNAPSHOT.fullmatch(entry)
+    if match is None or int(match.group(1)) == os.getpid():
+        return False
+    try:
+        os.kill(int(match.group(1)), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def _load_snapshot(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_snapshot(path, snapshot):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(snapshot, fh)
+    os.replace(tmp_path, path)
+
+
+class WorkerSnapshotWriter:
+    """Periodically persist this worker's registry so /metrics can aggregate across gunicorn workers"""
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self._path = None
+        self._pid = None
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        atexit.register(self.flush)
+
+    @property
+    def path(self):
+        # Resolved in the worker: under gunicorn --preload every worker inherits this object
+        if self._pid != os.getpid():
+            self._path = os.path.join(self.directory, f'worker_{os.getpid()}_{int(time.time())}.json')
+            self._pid = os.getpid()
+        return self._path
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.monotonic()
+            try:
+                _write_snapshot(self.path, registry.snapshot())
+            except OSError as e:
+                logger.warning('Failed to write metrics snapshot %s: %s', self.path, e)
+
+    def compact(self):
+        """Fold the snapshots of exited workers into retired.json; returns how many were folded"""
+        exited = [entry for entry in os.listdir(self.directory) if _exited(entry)]
+        if fcntl is None or not exited:
+            return 0
+        fd = os.open(os.path.join(self.directory, 'compact.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # One scrape at a time, so no snapshot is added to retired.json twice
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            retired_path = os.path.join(self.directory, RETIRED_SNAPSHOT)
+            snapshots, folded = [_load_snapshot(retired_path) or []], []
+            for entry in exited:
+                path = os.path.join(self.directory, entry)
+                snapshot = _load_snapshot(path)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+                    folded.append(path)
+            if folded:
+                merged = merge_snapshots(snapshots)
+                _write_snapshot(retired_path, [[name, list(labels), value] for (name, labels), value in merged.items()])
+                for path in folded:
+                    os.remove(path)
+            return len(folded)
+        except OSError as e:
+            logger.warning('Failed to compact metrics snapshots in %s: %s', self.directory, e)
+            return 0
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def collect(self):
+        """Load snapshots from every worker, using live values for this one"""
+        self.compact()
+        snapshots = [registry.snapshot()]
+        for entry in os.listdir(self.directory):
+            path = os.path.join(self.directory, entry)
+            if not entry.endswith('.json') or path == self.path:
+                continue
+            snapshot = _load_snapshot(path)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        return snapshots
+
+
+def _route_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_query_count = 0
+    g.metrics_db_time = 0.0
+
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+
+    duration = time.perf_counter() - start
+    method = request.method
+    route = _route_label()
+    query_count = g.get('metrics_query_count', 0)
+
+    registry.inc('http_requests_total', (method, route, str(response.status_code)))
+    registry.observe('http_request_duration_seconds', (method, route), duration)
+    registry.observe('db_queries_per_request', (method, route), query_count)
+    registry.observe('db_time_per_request_seconds', (method, route), g.get('metrics_db_time', 0.0))
+    if query_count:
+        registry.inc('db_queries_total', (route,), query_count)
+
+    # Streamed responses have no known length up front
+    if response.content_length is not None:
+        registry.observe('http_response_size_bytes', (method, route), response.content_length)
+
+    writer = current_app.extensions.get('metrics_writer')
+    if writer is not None:
+        writer.maybe_flush()
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+
+    if not has_request_context() or 'metrics_start' not in g:
+        return
+
+    g.metrics_query_count += 1
+    g.metrics_db_time += elapsed
+
+    slow_ms = current_app.config.get('SLOW_QUERY_MS', 200)
+    if elapsed * 1000 >= slow_ms:
+        route = _route_label()
+        registry.inc('db_slow_queries_total', (route,))
+        logger.warning('Slow query (%.1f ms) on %s %s: %s',
+                       elapsed * 1000, request.method, route, ' '.join(statement.split())[:500])
+
+
+_engine_listeners_installed = False
+
+
+def _install_engine_listeners():
+    """Listen on every Engine so queries are counted regardless of which app created it"""
+    global _engine_listeners_installed
+    if _engine_listeners_installed:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _engine_listeners_installed = True
+
+
+def metrics_view():
+    """Expose collected metrics in Prometheus text format"""
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+
+    writer = current_app.extensions.get('metrics_writer')
+    snapshots = writer.collect() if writer is not None else [registry.snapshot()]
+    body = render_prometheus(merge_snapshots(snapshots))
+    return Response(body, mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_app(app):
+    """Register request hooks, SQL listeners and the /metrics endpoint"""
+    app.config.setdefault('SLOW_QUERY_MS', float(os.environ.get('SLOW_QUERY_MS', 200)))
+    app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+    # Shared by every worker on the host so /metrics covers all of them; set it empty to report per worker
+    app.config.setdefault('METRICS_DIR', os.environ.get(
+        'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'marynola-metrics')))
+    app.config.setdefault('METRICS_FLUSH_INTERVAL', float(os.environ.get('METRICS_FLUSH_INTERVAL', 5)))
+
+    if app.config['METRICS_DIR']:
+        app.extensions['metrics_writer'] = WorkerSnapshotWriter(
+            app.config['METRICS_DIR'], app.config['METRICS_FLUSH_INTERVAL']
+        )
+
+    _install_engine_listeners()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view, methods=['GET'])
@@ -1,8 +1,12 @@
 from datetime import datetime, timedelta
 from . import db
+from . import staff_schema
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-import random
+from flask import current_app
+import hmac
+import hashlib
+import secrets
 
 
 
@@ -16,9 +20,6 @@ class Boss(db.Model, UserMixin):
     lastname = db.Column(db.String(50), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    reset_token = db.Column(db.String(6), nullable=True)
-    reset_token_expiry = db.Column(db.DateTime, nullable=True)
-
     # Relationship to staff
     staff_members = db.relationship('Staff', backref='boss', lazy=True, cascade='all, delete-orphan')
 
@@ -29,40 +30,6 @@ class Boss(db.Model, UserMixin):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-    def generate_reset_token(self):
-        """Generate a 6-digit reset code"""
-
-        code = f"{random.randint(100000, 999999)}"
-        self.reset_token = code
-        self.reset_token_expiry = datetime.utcnow() + timedelta(minutes=15)  # Expires in 15 minutes
-        db.session.commit()
-        return code
-
-    @staticmethod
-    def verify_reset_token(email, code):
-        """Verify reset code"""
-
-        boss = Boss.query.filter_by(email=email.lower()).first()
-        if not boss or not boss.reset_token:
-            return None
-
-        if boss.reset_token_expiry and datetime.utcnow() > boss.reset_token_expiry:
-            # Code expired, clear it
-            boss.reset_token = None
-            boss.reset_token_expiry = None
-            db.session.commit()
-            return None
-
-        if boss.reset_token == code:
-            return boss
-        return None
-
-    def clear_reset_code(self):
-        """Clear reset code after successful password reset"""
-        self.reset_token = None
-        self.reset_token_expiry = None
-        db.session.commit()
-
     def to_dict(self):
         return {
             'id': self.id,
@@ -98,19 +65,127 @@ class Staff(db.Model):
     updated_at = db.Column(db.DateTime, onupdate=datetime.utcnow)
     boss_id = db.Column(db.Integer, db.ForeignKey('boss.id'), nullable=False)
 
+    __table_args__ = (
+        # Per-tenant listing in display order
+        db.Index('ix_staff_boss_name', 'boss_id', 'firstname', 'lastname'),
+        # Faceted search filters and per-facet counts
+        db.Index('ix_staff_boss_employment_status', 'boss_id', 'employment_status'),
+        db.Index('ix_staff_boss_visa_type', 'boss_id', 'visa_type'),
+        db.Index('ix_staff_boss_immigration_status', 'boss_id', 'immigration_status'),
+        db.Index('ix_staff_boss_sex', 'boss_id', 'sex'),
+        # Upload sweeper looks files up by name
+        db.Index('ix_staff_proof_of_id', 'proof_of_id'),
+    )
+    # boss_id is part of the identity so ORM UPDATE/DELETE statements filter on
+    # it and prune to one partition when staff is partitioned (see schema.py)
+    __mapper_args__ = {'primary_key': [id, boss_id]}
+
     def to_dict(self):
-        return {
-            'id': self.id,
-            'firstname': self.firstname,
-            'lastname': self.lastname,
-            'national_insurance_number': self.national_insurance_number,
-            'home_address': self.home_address,
-            'telephone_number': self.telephone_number,
-            'employment_status': self.employment_status,
-            'immigration_status': self.immigration_status,
-            'visa_type': self.visa_type,
-            'visa_sharecode': self.visa_sharecode,
-            'sex': self.sex,
-            'date_of_birth': self.date_of_birth.isoformat() if self.date_of_birth else None,
-            'proof_of_id': self.proof_of_id
-        }
\ No newline at end of file
+        return staff_schema.to_dict(self)
+
+
+# Password reset codes, kept apart from Boss so the reset flow never locks boss rows
+class PasswordResetToken(db.Model):
+    __tablename__ = 'password_reset_token'
+
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(120), nullable=False, index=True)
+    # HMAC of the code; the code itself is only ever in the email
+    code_hash = db.Column(db.String(64), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    @staticmethod
+    def hash_code(email, code):
+        key = current_app.config['SECRET_KEY'].encode()
+        return hmac.new(key, f'{email}:{code}'.encode(), hashlib.sha256).hexdigest()
+
+    @classmethod
+    def issue(cls, email, lifetime=timedelta(minutes=15)):
+        """Store a new 6-digit code for ``email`` with a single INSERT and return it.
+
+        Earlier codes are not touched: only the newest one verifies.
+        """
+        email = email.lower()
+        code = f'{secrets.randbelow(900000) + 100000}'
+        db.session.add(cls(email=email, code_hash=cls.hash_code(email, code),
+                           expires_at=datetime.utcnow() + lifetime))
+        db.session.commit()
+        return code
+
+    @classmethod
+    def latest(cls, email):
+        """Newest unexpired token for ``email``, or None"""
+        return cls.query.filter(
+            cls.email == email.lower(), cls.expires_at > datetime.utcnow()
+        ).order_by(cls.created_at.desc(), cls.id.desc()).first()
+
+    @classmethod
+    def verify(cls, email, code):
+        """Check a code without writing anything"""
+        token = cls.latest(email)
+        if not token or not code:
+            return False
+        return hmac.compare_digest(token.code_hash, cls.hash_code(email.lower(), str(code).strip()))
+
+    @classmethod
+    def revoke_all(cls, email):
+        """Delete every code for ``email`` (caller commits)"""
+        cls.query.filter(cls.email == email.lower()).delete(synchronize_session=False)
+
+    @classmethod
+    def purge_expired(cls):
+        """Bulk-delete expired codes; returns how many were removed"""
+        deleted = cls.query.filter(cls.expires_at <= datetime.utcnow()).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+# Revoked access tokens, loaded into each worker's denylist (see revocation.py)
+class RevokedToken(db.Model):
+    __tablename__ = 'revoked_token'
+
+    # Ascending id doubles as the workers' sync cursor
+    id = db.Column(db.Integer, primary_key=True)
+    # None revokes every token of boss_id issued before revoked_at (password reset)
+    jti = db.Column(db.String(36), unique=True, nullable=True)
+    boss_id = db.Column(db.Integer, nullable=False, index=True)
+    revoked_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # After this every token the row covers has expired on its own
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def revoke(cls, jti, boss_id, expires_at):
+        """Revoke one token (caller commits)"""
+        db.session.add(cls(jti=jti, boss_id=boss_id, expires_at=expires_at))
+
+    @classmethod
+    def revoke_all(cls, boss_id, lifetime):
+        """Revoke every token issued to ``boss_id`` so far (caller commits).
+
+        ``lifetime`` is the longest an access token lives.
+        """
+        now = datetime.utcnow()
+        db.session.add(cls(boss_id=boss_id, revoked_at=now, expires_at=now + lifetime))
+
+
+# Stored responses for requests sent with an Idempotency-Key header (see idempotency.py)
+class IdempotencyRecord(db.Model):
+    __tablename__ = 'idempotency_record'
+
+    id = db.Column(db.Integer, primary_key=True)
+    boss_id = db.Column(db.Integer, nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    # SHA-256 of method, path and body; a reused key with a different request is rejected
+    fingerprint = db.Column(db.String(64), nullable=False)
+    state = db.Column(db.String(20), nullable=False, default='in_progress')  # in_progress, done
+    status_code = db.Column(db.Integer, nullable=True)
+    content_type = db.Column(db.String(255), nullable=True)
+    location = db.Column(db.String(2048), nullable=True)
+    body = db.Column(db.LargeBinary, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('boss_id', 'key', name='uq_idempotency_boss_key'),
+    )
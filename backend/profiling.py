@@ -0,0 +1,325 @@
+"""Opt-in per-request profiling.
+
+A request is profiled when it carries a valid ``X-Profile-Token`` header
+(signed with PROFILE_SECRET; mint one with ``flask profiling token``) or is
+picked at random with probability PROFILE_SAMPLE_RATE. The whole request is
+run under cProfile, including the body of streamed responses such as
+exports, and every SQL statement it runs is timed.
+
+Each profile is written to PROFILE_DIR as three files sharing one name,
+``<utc time>_<method>_<route>_boss<id>_<ms>ms_<suffix>``:
+
+* ``.pstats``: function-level stats for ``python -m pstats`` or snakeviz
+* ``.collapsed``: folded stacks for flamegraph.pl or speedscope
+* ``.json``: route, boss id, duration, status and the SQL timings
+
+Only the newest PROFILE_MAX_FILES profiles are kept. Profiled responses
+carry ``X-Profile-Id`` with the file name.
+
+With neither PROFILE_SECRET nor a sample rate configured, no hooks or SQL
+listeners are registered at all.
+"""
+import os
+import json
+import time
+import random
+import pstats
+import cProfile
+import logging
+import tempfile
+from datetime import datetime, timezone
+
+import click
+from flask import current_app, g, has_request_context, request
+from flask.cli import AppGroup
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Profile-Token'
+# Set in the WSGI environ of requests that must not be profiled: the ASGI
+# server's native handlers share one event-loop thread, so cProfile cannot
+# tell their requests apart
+SKIP_ENVIRON_KEY = 'profiling.skip'
+# Statements kept in the JSON sidecar, slowest first
+MAX_SQL_STATEMENTS = 50
+# Deepest folded stack; deeper frames are merged into their parent
+MAX_STACK_DEPTH = 64
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.config['PROFILE_SECRET'], salt='request-profile')
+
+
+def make_token(app, label='admin'):
+    """Signed header value that turns profiling on for requests carrying it"""
+    return _serializer(app).dumps({'label': label})
+
+
+class RequestProfile:
+    """Profiler and SQL timings for one request"""
+
+    def __init__(self, trigger, label=None):
+        self.trigger = trigger
+        self.label = label
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.sql = []
+        self.meta = {}
+        self.finished = False
+        # Batch sub-requests share g with the outer request; only the outer one owns the profile
+        self.request = request._get_current_object()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def finish(self, directory, max_files):
+        if self.finished:
+            return
+        self.finished = True
+        self.profiler.disable()
+        duration = time.perf_counter() - self.start
+        try:
+            self._write(directory, duration)
+            _rotate(directory, max_files)
+        except Exception:
+            logger.exception('Failed to write request profile')
+
+    def _write(self, directory, duration):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, self.meta['name'])
+        stats = pstats.Stats(self.profiler)
+        stats.dump_stats(base + '.pstats')
+        with open(base + '.collapsed', 'w') as fh:
+            for stack, micros in collapse(stats):
+                fh.write(f'{stack} {micros}\n')
+
+        sql_total = sum(elapsed for elapsed, _ in self.sql)
+        slowest = sorted(self.sql, key=lambda item: item[0], reverse=True)[:MAX_SQL_STATEMENTS]
+        meta = dict(self.meta, **{
+            'trigger': self.trigger,
+            'label': self.label,
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': round(duration * 1000, 3),
+            'sql': {
+                'count': len(self.sql),
+                'total_ms': round(sql_total * 1000, 3),
+                'slowest': [{'ms': round(elapsed * 1000, 3), 'statement': statement}
+                            for elapsed, statement in slowest],
+            },
+        })
+        # Written last: its presence marks a complete profile
+        with open(base + '.json', 'w') as fh:
+            json.dump(meta, fh, indent=2)
+
+
+def _func_name(func):
+    filename, line, name = func
+    if filename == '~':
+        return name  # built-in
+    return f'{name} ({os.path.basename(filename)}:{line})'
+
+
+def collapse(stats):
+    """Folded stacks ("a;b;c microseconds") rebuilt from cProfile's caller graph.
+
+    cProfile records caller -> callee edges rather than whole stacks, so each
+    function's own time is split across its callers in proportion to the
+    time spent under each call edge.
+    """
+    entries = stats.stats  # func -> (cc, nc, tottime, cumtime, callers)
+    callees = {}
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    folded = {}
+
+    def walk(func, stack, share, depth):
+        _, _, tottime, cumtime, _ = entries[func]
+        stack = stack + (_func_name(func),)
+        own = tottime * share
+        if own > 0:
+            key = ';'.join(stack)
+            folded[key] = folded.get(key, 0.0) + own
+        if depth >= MAX_STACK_DEPTH or not cumtime:
+            return
+        for callee, edge_cumtime in callees.get(func, ()):
+            if callee in visiting:
+                continue  # recursion: already counted on this path
+            visiting.add(callee)
+            walk(callee, stack, share * edge_cumtime / entries[callee][3] if entries[callee][3] else 0, depth + 1)
+            visiting.discard(callee)
+
+    roots = [func for func, (_, _, _, _, callers) in entries.items() if not callers]
+    for root in roots:
+        visiting = {root}
+        walk(root, (), 1.0, 0)
+
+    return sorted((stack, int(seconds * 1e6)) for stack, seconds in folded.items() if seconds * 1e6 >= 1)
+
+
+def _rotate(directory, max_files):
+    """Keep only the newest ``max_files`` profiles"""
+    names = sorted({entry.rsplit('.', 1)[0] for entry in os.listdir(directory)
+                    if entry.endswith(('.json', '.pstats', '.collapsed'))})
+    for name in names[:-max_files] if max_files else names:
+        for suffix in ('.json', '.pstats', '.collapsed'):
+            try:
+                os.remove(os.path.join(directory, name + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def _slug(text):
+    return ''.join(c if c.isalnum() else '-' for c in text).strip('-')[:60] or 'root'
+
+
+def _trigger():
+    """('header', label) or ('sample', None) if this request should be profiled, else None"""
+    config = current_app.config
+    token = request.headers.get(HEADER)
+    if token and config['PROFILE_SECRET']:
+        try:
+            payload = _serializer(current_app).loads(token, max_age=config['PROFILE_TOKEN_MAX_AGE'])
+            return 'header', payload.get('label')
+        except BadSignature:
+            logger.warning('Rejected %s header', HEADER)
+    rate = config['PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate:
+        return 'sample', None
+    return None
+
+
+def _before_request():
+    if 'request_profile' in g or request.environ.get(SKIP_ENVIRON_KEY):
+        return
+    trigger = _trigger()
+    if trigger is not None:
+        g.request_profile = RequestProfile(*trigger)
+
+
+def _after_request(response):
+    profile = g.get('request_profile')
+    if profile is None or profile.request is not request._get_current_object():
+        return response
+
+    boss_id = None
+    try:
+        from flask_jwt_extended import get_jwt_identity
+        boss_id = get_jwt_identity()
+    except Exception:
+        pass
+    rule = request.url_rule
+    route = rule.rule if rule is not None else 'unmatched'
+    elapsed_ms = int((time.perf_counter() - profile.start) * 1000)
+    name = '_'.join([
+        profile.started_at.strftime('%Y%m%dT%H%M%S%f'),
+        request.method,
+        _slug(route),
+        f'boss{boss_id or "-"}',
+        f'{elapsed_ms}ms',
+        os.urandom(3).hex(),
+    ])
+    profile.meta = {
+        'name': name,
+        'method': request.method,
+        'route': route,
+        # Without the query string, which can carry a token (?jwt= on /api/staff/events)
+        'path': request.path,
+        'boss_id': boss_id,
+        'status': response.status_code,
+        'streamed': response.is_streamed,
+    }
+    response.headers['X-Profile-Id'] = name
+
+    # Streamed bodies (exports) are produced after this hook; stop once the server closes the response
+    directory, max_files = current_app.config['PROFILE_DIR'], current_app.config['PROFILE_MAX_FILES']
+    response.call_on_close(lambda: profile.finish(directory, max_files))
+    return response
+
+
+def _teardown_request(exc):
+    profile = g.get('request_profile')
+    if profile is None or profile.request is not request._get_current_object():
+        return
+    # No response was produced: stop profiling now, without writing anything
+    if not profile.meta and not profile.finished:
+        profile.finished = True
+        profile.profiler.disable()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('profile_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if not has_request_context():
+        return
+    profile = g.get('request_profile')
+    if profile is not None and not profile.finished:
+        profile.sql.append((elapsed, ' '.join(statement.split())[:2000]))
+
+
+_engine_listeners_installed = False
+
+
+def _install_engine_listeners():
+    global _engine_listeners_installed
+    if _engine_listeners_installed:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _engine_listeners_installed = True
+
+
+@click.group('profiling', cls=AppGroup)
+def profiling_cli():
+    """Request profiling"""
+
+
+@profiling_cli.command('token')
+@click.option('--label', default='admin', help='recorded in each profile taken with the token')
+def token_command(label):
+    """Print a value for the X-Profile-Token header"""
+    if not current_app.config['PROFILE_SECRET']:
+        raise click.ClickException('Set PROFILE_SECRET to enable header-triggered profiling')
+    click.echo(make_token(current_app, label))
+
+
+@profiling_cli.command('list')
+def list_command():
+    """Show stored profiles, newest first"""
+    directory = current_app.config['PROFILE_DIR']
+    if not os.path.isdir(directory):
+        return
+    for entry in sorted(os.listdir(directory), reverse=True):
+        if not entry.endswith('.json'):
+            continue
+        with open(os.path.join(directory, entry)) as fh:
+            meta = json.load(fh)
+        click.echo(f"{meta['name']}  {meta['method']} {meta['path']}  {meta['duration_ms']}ms  "
+                   f"sql={meta['sql']['count']}/{meta['sql']['total_ms']}ms")
+
+
+def init_app(app):
+    app.config.setdefault('PROFILE_SECRET', os.environ.get('PROFILE_SECRET'))
+    app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+    app.config.setdefault('PROFILE_TOKEN_MAX_AGE', int(os.environ.get('PROFILE_TOKEN_MAX_AGE', 3600)))
+    app.config.setdefault('PROFILE_DIR', os.environ.get(
+        'PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'marynola-profiles')))
+    app.config.setdefault('PROFILE_MAX_FILES', int(os.environ.get('PROFILE_MAX_FILES', 200)))
+
+    app.cli.add_command(profiling_cli)
+    if not app.config['PROFILE_SECRET'] and not app.config['PROFILE_SAMPLE_RATE']:
+        return
+
+    _install_engine_listeners()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,84 @@
+"""Expiry sweeper for password reset codes.
+
+Codes live in ``password_reset_token`` (see ``PasswordResetToken``). Issuing
+one is a single INSERT and verifying one is a read, so nothing deletes stale
+rows on the request path. Instead a background thread bulk-deletes expired
+codes at most every RESET_TOKEN_PURGE_INTERVAL seconds, triggered from
+request handling. ``flask reset-tokens purge`` runs it by hand.
+"""
+import os
+import time
+import logging
+import threading
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from . import db
+from .models import PasswordResetToken
+
+logger = logging.getLogger(__name__)
+
+
+class ResetTokenSweeper:
+    """Periodically deletes expired reset codes"""
+
+    def __init__(self, app, interval=3600):
+        self.app = app
+        self.interval = interval
+        self._next_run = time.monotonic() + interval
+
+    def maybe_purge(self):
+        """Start a background purge when the interval has elapsed"""
+        if not self.interval or time.monotonic() < self._next_run:
+            return
+        self._next_run = time.monotonic() + self.interval
+        threading.Thread(target=self._background_purge, name='reset-token-purge', daemon=True).start()
+
+    def _background_purge(self):
+        try:
+            with self.app.app_context():
+                self.purge()
+        except Exception:
+            logger.exception('Reset token purge failed')
+
+    def purge(self):
+        """Delete expired codes; returns how many were removed. Needs an application context."""
+        try:
+            deleted = PasswordResetToken.purge_expired()
+        except Exception:
+            db.session.rollback()
+            raise
+        if deleted:
+            logger.info('Purged expired reset codes', extra={'deleted': deleted})
+        return deleted
+
+
+def get_reset_token_sweeper():
+    return current_app.extensions['reset_tokens']
+
+
+@click.group('reset-tokens', cls=AppGroup)
+def reset_tokens_cli():
+    """Password reset code maintenance"""
+
+
+@reset_tokens_cli.command('purge')
+def purge_command():
+    """Delete expired password reset codes"""
+    click.echo(f'deleted={get_reset_token_sweeper().purge()}')
+
+
+def _after_request(response):
+    get_reset_token_sweeper().maybe_purge()
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('RESET_TOKEN_TTL_MINUTES', int(os.environ.get('RESET_TOKEN_TTL_MINUTES', 15)))
+    app.config.setdefault('RESET_TOKEN_PURGE_INTERVAL', int(os.environ.get('RESET_TOKEN_PURGE_INTERVAL', 3600)))
+
+    app.extensions['reset_tokens'] = ResetTokenSweeper(app, interval=app.config['RESET_TOKEN_PURGE_INTERVAL'])
+    app.cli.add_command(reset_tokens_cli)
+    app.after_request(_after_request)
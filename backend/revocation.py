@@ -0,0 +1,285 @@
+"""Access token revocation.
+
+Logout revokes the presented token and a password reset revokes every token
+issued to the boss before it. Both are stored as rows in ``revoked_token``
+(see ``RevokedToken``), so revocation survives restarts and reaches every
+worker.
+
+Checking the table on each ``@jwt_required`` request would add a query to
+every API call. Instead each worker holds the revoked JTIs in a Bloom filter
+and the per-boss password-reset cutoffs in a dict, refreshed from rows newer
+than the last one seen at most every REVOCATION_SYNC_INTERVAL seconds. A
+token whose JTI misses the filter is not revoked, which is nearly every
+request; only a filter hit, a revoked token or a rare false positive, costs
+a primary-key lookup. A revocation made on another worker takes effect here
+within the sync interval; one made on this worker takes effect immediately.
+
+The JWT ``iat`` claim is in whole seconds, so a login in the same second as
+a password reset would look older than the reset. Tokens carry the issue
+time in milliseconds as well (``iat_ms``) and the cutoff is compared with
+that.
+
+Rows are deleted once every token they cover has expired, in the background
+or with ``flask revocation purge``, and the filter is rebuilt from the
+remaining rows when it fills past REVOCATION_CAPACITY.
+"""
+import os
+import math
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, or_, select
+
+from . import db
+from .models import RevokedToken
+
+logger = logging.getLogger(__name__)
+
+_revoked = RevokedToken.__table__
+# Ids are allocated before commit, so on Postgres a row can become visible
+# after a higher id was already synced; rows this recent are read again
+SYNC_OVERLAP = timedelta(seconds=60)
+# Issue time in epoch milliseconds, added to every token this app creates
+ISSUED_AT_CLAIM = 'iat_ms'
+
+
+class BloomFilter:
+    """Set membership with no false negatives and about ``error_rate`` false positives"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        # Keys that set at least one new bit; repeats are not counted
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        for i in range(self.hashes):
+            yield (first + i * step) % size
+
+    def add(self, key):
+        bits = self.bits
+        new = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+def _epoch(value):
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _issued_at(payload):
+    """Epoch seconds the token was issued, to the millisecond when it says so"""
+    issued_ms = payload.get(ISSUED_AT_CLAIM)
+    if issued_ms is not None:
+        return issued_ms / 1000
+    return payload.get('iat', 0)
+
+
+class RevocationList:
+    """Per-worker view of revoked_token, kept current incrementally"""
+
+    def __init__(self, app, capacity=100000, error_rate=0.001, sync_interval=5, purge_interval=3600):
+        self.app = app
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.purge_interval = purge_interval
+        self.filter = None
+        # boss id (as in the token's sub claim) -> epoch seconds; earlier tokens are revoked
+        self.cutoffs = {}
+        self.cursor = 0
+        self.stats = {'checks': 0, 'filter_hits': 0, 'false_positives': 0, 'syncs': 0, 'rebuilds': 0}
+        self._lock = threading.Lock()
+        self._next_sync = 0.0
+        self._next_purge = time.monotonic() + purge_interval
+
+    def is_revoked(self, payload):
+        """True if the decoded token ``payload`` has been revoked. Needs an application context."""
+        self.stats['checks'] += 1
+        if self.filter is None or time.monotonic() >= self._next_sync:
+            self._sync_in_request()
+
+        cutoff = self.cutoffs.get(payload.get('sub'))
+        if cutoff is not None and _issued_at(payload) < cutoff:
+            return True
+        jti = payload.get('jti')
+        if jti is None or jti not in self.filter:
+            return False
+
+        self.stats['filter_hits'] += 1
+        with db.engine.connect() as conn:
+            revoked = conn.execute(select(_revoked.c.id).where(_revoked.c.jti == jti)).first() is not None
+        if not revoked:
+            self.stats['false_positives'] += 1
+        return revoked
+
+    def _sync_in_request(self):
+        # The first check waits for the initial load; later ones leave a sync in progress to its thread
+        if self.filter is None:
+            with self._lock:
+                if self.filter is None:
+                    self._rebuild()
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._sync()
+        except Exception:
+            # Keep serving from the current filter; the next check retries
+            logger.exception('Revocation sync failed')
+        finally:
+            self._lock.release()
+
+    def sync(self):
+        """Load revocations newer than the last sync. Needs an application context."""
+        with self._lock:
+            if self.filter is None:
+                self._rebuild()
+            else:
+                self._sync()
+
+    def _sync(self):
+        self._next_sync = time.monotonic() + self.sync_interval
+        with db.engine.connect() as conn:
+            rows = conn.execute(select(_revoked).where(or_(
+                _revoked.c.id > self.cursor,
+                _revoked.c.revoked_at >= datetime.utcnow() - SYNC_OVERLAP,
+            ))).all()
+        self._load(rows, self.filter, self.cutoffs)
+        self.stats['syncs'] += 1
+        if self.filter.count > self.capacity:
+            self._rebuild()
+
+    def _rebuild(self):
+        self._next_sync = time.monotonic() + self.sync_interval
+        with db.engine.connect() as conn:
+            rows = conn.execute(select(_revoked).where(_revoked.c.expires_at > datetime.utcnow())).all()
+        capacity = max(self.capacity, 2 * len(rows))
+        bloom, cutoffs = BloomFilter(capacity, self.error_rate), {}
+        self._load(rows, bloom, cutoffs)
+        # Checks running meanwhile keep using the old, complete filter until the swap
+        self.capacity = capacity
+        self.filter, self.cutoffs = bloom, cutoffs
+        self.stats['rebuilds'] += 1
+
+    def _load(self, rows, bloom, cutoffs):
+        for row in rows:
+            if row.jti is not None:
+                bloom.add(row.jti)
+            else:
+                sub = str(row.boss_id)
+                cutoff = _epoch(row.revoked_at)
+                if cutoff > cutoffs.get(sub, 0):
+                    cutoffs[sub] = cutoff
+            if row.id > self.cursor:
+                self.cursor = row.id
+
+    def purge(self):
+        """Delete rows whose tokens have all expired; returns the count. Needs an application context."""
+        with db.engine.begin() as conn:
+            deleted = conn.execute(delete(_revoked).where(_revoked.c.expires_at <= datetime.utcnow())).rowcount
+        if deleted:
+            logger.info('Purged revoked tokens', extra={'deleted': deleted})
+            with self._lock:
+                self._rebuild()
+        return deleted
+
+    def maybe_purge(self):
+        """Start a background purge when the interval has elapsed"""
+        if not self.purge_interval or time.monotonic() < self._next_purge:
+            return
+        self._next_purge = time.monotonic() + self.purge_interval
+        threading.Thread(target=self._background_purge, name='revocation-purge', daemon=True).start()
+
+    def _background_purge(self):
+        try:
+            with self.app.app_context():
+                self.purge()
+        except Exception:
+            logger.exception('Revoked token purge failed')
+
+
+def get_revocation_list():
+    return current_app.extensions['revocation']
+
+
+def _token_in_blocklist(jwt_header, jwt_payload):
+    return get_revocation_list().is_revoked(jwt_payload)
+
+
+def _issue_time_claims(identity):
+    return {ISSUED_AT_CLAIM: int(time.time() * 1000)}
+
+
+@click.group('revocation', cls=AppGroup)
+def revocation_cli():
+    """Access token revocation maintenance"""
+
+
+@revocation_cli.command('purge')
+def purge_command():
+    """Delete revocations whose tokens have all expired"""
+    click.echo(f'deleted={get_revocation_list().purge()}')
+
+
+@revocation_cli.command('status')
+def status_command():
+    """Show the size of the revocation table and this process's filter"""
+    revocations = get_revocation_list()
+    revocations.sync()
+    with db.engine.connect() as conn:
+        rows = conn.execute(select(func.count()).select_from(_revoked)).scalar()
+    bloom = revocations.filter
+    click.echo(f'rows={rows} filter_keys={bloom.count} capacity={bloom.capacity} '
+               f'bits={bloom.size} hashes={bloom.hashes} boss_cutoffs={len(revocations.cutoffs)}')
+
+
+def _after_request(response):
+    get_revocation_list().maybe_purge()
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('REVOCATION_CAPACITY', int(os.environ.get('REVOCATION_CAPACITY', 100000)))
+    app.config.setdefault('REVOCATION_ERROR_RATE', float(os.environ.get('REVOCATION_ERROR_RATE', 0.001)))
+    app.config.setdefault('REVOCATION_SYNC_INTERVAL', float(os.environ.get('REVOCATION_SYNC_INTERVAL', 5)))
+    app.config.setdefault('REVOCATION_PURGE_INTERVAL', int(os.environ.get('REVOCATION_PURGE_INTERVAL', 3600)))
+
+    app.extensions['revocation'] = RevocationList(
+        app,
+        capacity=app.config['REVOCATION_CAPACITY'],
+        error_rate=app.config['REVOCATION_ERROR_RATE'],
+        sync_interval=app.config['REVOCATION_SYNC_INTERVAL'],
+        purge_interval=app.config['REVOCATION_PURGE_INTERVAL'],
+    )
+    jwt = app.extensions['flask-jwt-extended']
+    jwt.token_in_blocklist_loader(_token_in_blocklist)
+    jwt.additional_claims_loader(_issue_time_claims)
+    app.cli.add_command(revocation_cli)
+    app.after_request(_after_request)
@@ -1,10 +1,19 @@
-from flask import Blueprint, request, jsonify, current_app, send_file
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
+from flask import Blueprint, request, jsonify, current_app, send_file, redirect, Response, stream_with_context
+from flask_jwt_extended import create_access_token, get_jwt, get_jwt_identity
 import os
-from datetime import datetime, timedelta
+import logging
 
-from .services import BossService, StaffService, FileService, ValidationService
-from .models import Boss
+from .services import BossService, StaffService, FileService, ValidationService, AnalyticsService
+from .models import Boss, PasswordResetToken
+from .batch import BatchError, jwt_required, validate_batch, run_batch
+from .storage import InvalidStorageToken, get_storage
+from .upload_gc import get_sweeper
+from .suggest import get_suggest_index
+from .events import STREAM_HEADERS, TooManyStreams, get_event_broker, stream, too_many_streams
+from .idempotency import idempotent
+from .singleflight import single_flight
+
+logger = logging.getLogger(__name__)
 
 # Create blueprint
 main = Blueprint('main', __name__)
@@ -40,10 +49,7 @@ def login():
 
     boss = BossService.authenticate_boss(data['email'], data['password'])
     if boss:
-        access_token = create_access_token(
-            identity=str(boss.id),
-            expires_delta=timedelta(hours=24)
-        )
+        access_token = create_access_token(identity=str(boss.id))
         return jsonify({
             'message': 'Login successful',
             'access_token': access_token,
@@ -61,19 +67,21 @@ def login():
 
 @main.route('/api/debug/get-reset-token', methods=['POST'])
 def get_reset_token_debug():
-    """DEBUG ONLY - Get current reset code for testing"""
+    """DEBUG ONLY - Check whether a reset code is active for testing.
+
+    Codes are stored hashed, so only the expiry can be reported; the code
+    itself is in the email (or the debug log).
+    """
     data = request.get_json()
     if not data or 'email' not in data:
         return jsonify({'error': 'Email is required'}), 400
 
-    boss = Boss.query.filter_by(email=data['email'].lower()).first()
-    if boss and boss.reset_token:
-        if boss.reset_token_expiry and datetime.utcnow() <= boss.reset_token_expiry:
-            return jsonify({
-                'email': boss.email,
-                'code': boss.reset_token,
-                'expires_at': boss.reset_token_expiry.isoformat()
-            }), 200
+    token = PasswordResetToken.latest(data['email'])
+    if token:
+        return jsonify({
+            'email': token.email,
+            'expires_at': token.expires_at.isoformat()
+        }), 200
 
     return jsonify({'error': 'No active reset code found'}), 404
 
@@ -105,13 +113,15 @@ def reset_password():
 @main.route('/api/logout', methods=['POST'])
 @jwt_required()
 def logout():
-    """Boss logout"""
-    return jsonify({'message': 'Logged out successfully'}), 200
+    """Boss logout: revokes the token used for this request"""
+    result, status = BossService.logout(int(get_jwt_identity()), get_jwt())
+    return jsonify(result), status
 
 
 # Staff Management Routes
 @main.route('/api/staff', methods=['POST'])
 @jwt_required()
+@idempotent
 def add_staff():
     """Add new staff member with optional file upload"""
     boss_id = int(get_jwt_identity())
@@ -145,6 +155,7 @@ def add_staff():
 
 @main.route('/api/staff', methods=['GET'])
 @jwt_required()
+@single_flight()
 def get_all_staff():
     """Get all staff members for the logged-in boss"""
     boss_id = int(get_jwt_identity())
@@ -166,39 +177,33 @@ def get_staff(staff_id):
 
 @main.route('/api/staff/<int:staff_id>', methods=['PUT'])
 @jwt_required()
+@idempotent
 def update_staff(staff_id):
     """Update staff member with JSON data only"""
     try:
         boss_id = int(get_jwt_identity())
 
-        boss = Boss.query.get(boss_id)
-        if not boss:
-            return jsonify({'error': 'Boss not found'}), 404
-
         # Only handle JSON data for this route
         update_data = request.get_json()
         if not update_data:
             return jsonify({'error': 'No JSON data provided'}), 400
 
-        result, status = StaffService.update_staff_json_only(staff_id, boss.id, update_data)
+        result, status = StaffService.update_staff_json_only(staff_id, boss_id, update_data)
         return jsonify(result), status
 
-    except Exception as e:
-        print(f"Error in update_staff: {e}")
+    except Exception:
+        logger.exception('Error in update_staff')
         return jsonify({'error': 'Internal server error'}), 500
 
 
 @main.route('/api/staff/<int:staff_id>/update-with-file', methods=['PUT'])
 @jwt_required()
+@idempotent
 def update_staff_with_file(staff_id):
     """Update staff member with form data and optional file upload"""
     try:
         boss_id = int(get_jwt_identity())
 
-        boss = Boss.query.get(boss_id)
-        if not boss:
-            return jsonify({'error': 'Boss not found'}), 404
-
         # Get form data (like in add_staff_with_file)
         update_data = request.form.to_dict()
         file = request.files.get('proof_of_id')
@@ -206,16 +211,17 @@ def update_staff_with_file(staff_id):
         if not update_data:
             return jsonify({'error': 'No form data provided'}), 400
 
-        result, status = StaffService.update_staff_with_file(staff_id, boss.id, update_data, file)
+        result, status = StaffService.update_staff_with_file(staff_id, boss_id, update_data, file)
         return jsonify(result), status
 
-    except Exception as e:
-        print(f"Error in update_staff_with_file: {e}")
+    except Exception:
+        logger.exception('Error in update_staff_with_file')
         return jsonify({'error': 'Internal server error'}), 500
 
 
 @main.route('/api/staff/<int:staff_id>', methods=['DELETE'])
 @jwt_required()
+@idempotent
 def delete_staff(staff_id):
     """Delete staff member"""
     boss_id = int(get_jwt_identity())
@@ -226,6 +232,7 @@ def delete_staff(staff_id):
 # File Upload Routes for ID Documents
 @main.route('/api/staff/<int:staff_id>/upload-id', methods=['POST'])
 @jwt_required()
+@idempotent
 def upload_staff_id(staff_id):
     """Upload proof of ID for existing staff member"""
     try:
@@ -243,11 +250,33 @@ def upload_staff_id(staff_id):
         result, status = FileService.upload_proof_of_id(file, staff_id, boss.id)
         return jsonify(result), status
 
-    except Exception as e:
-        print(f"Error in upload_staff_id: {e}")
+    except Exception:
+        logger.exception('Error in upload_staff_id')
         return jsonify({'error': 'Internal server error'}), 500
 
 
+@main.route('/api/staff/upload-ids', methods=['POST'])
+@jwt_required()
+@idempotent
+def upload_staff_ids():
+    """Upload proof of ID for many staff members at once.
+
+    Send each document as a ``proof_of_id_<staff_id>`` file field, or a zip
+    ``archive`` of files named ``<staff_id>.<ext>``; the response reports a
+    status per file.
+    """
+    boss_id = int(get_jwt_identity())
+    config = current_app.config
+    result, status = FileService.upload_proof_of_id_batch(
+        boss_id, request.files,
+        max_workers=config['ID_BATCH_WORKERS'],
+        max_files=config['ID_BATCH_MAX_FILES'],
+        max_archive_bytes=config['ID_BATCH_MAX_ARCHIVE_BYTES'],
+        max_file_bytes=config['MAX_CONTENT_LENGTH'],
+    )
+    return jsonify(result), status
+
+
 @main.route('/api/staff/<int:staff_id>/download-id', methods=['GET'])
 @jwt_required()
 def download_proof_of_id(staff_id):
@@ -259,89 +288,264 @@ def download_proof_of_id(staff_id):
     if not staff or not staff.get('proof_of_id'):
         return jsonify({'error': 'File not found'}), 404
 
-    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], staff['proof_of_id'])
+    storage = get_storage()
+    if storage.direct:
+        # Object storage serves the bytes; the worker only signs the URL
+        result, status = FileService.get_download_url(staff_id, boss_id)
+        if status != 200:
+            return jsonify(result), status
+        return redirect(result['url'])
+
+    file_path = storage.local_path(staff['proof_of_id'])
     if os.path.exists(file_path):
         return send_file(file_path, as_attachment=True)
 
     return jsonify({'error': 'File not found on server'}), 404
 
 
+@main.route('/api/staff/<int:staff_id>/download-url', methods=['GET'])
+@jwt_required()
+def proof_of_id_download_url(staff_id):
+    """Short-lived URL to download the proof of ID directly from storage"""
+    boss_id = int(get_jwt_identity())
+    result, status = FileService.get_download_url(staff_id, boss_id)
+    return jsonify(result), status
+
+
+@main.route('/api/staff/<int:staff_id>/upload-url', methods=['POST'])
+@jwt_required()
+@idempotent
+def proof_of_id_upload_url(staff_id):
+    """Presigned form upload for a new proof of ID; confirm it once the upload finishes"""
+    boss_id = int(get_jwt_identity())
+    data = request.get_json(silent=True) or {}
+    result, status = FileService.create_upload_url(staff_id, boss_id, data.get('filename'))
+    return jsonify(result), status
+
+
+@main.route('/api/staff/<int:staff_id>/upload-confirm', methods=['POST'])
+@jwt_required()
+@idempotent
+def confirm_proof_of_id_upload(staff_id):
+    """Attach a document uploaded through /upload-url to the staff member"""
+    boss_id = int(get_jwt_identity())
+    data = request.get_json(silent=True) or {}
+    result, status = FileService.confirm_upload(staff_id, boss_id, data.get('upload_id'))
+    return jsonify(result), status
+
+
+@main.route('/api/uploads/usage', methods=['GET'])
+@jwt_required()
+def upload_usage():
+    """Disk used by the logged-in boss's ID documents, as of the last upload sweep"""
+    boss_id = int(get_jwt_identity())
+    if get_storage().direct:
+        return jsonify({'error': 'Usage is only tracked for local storage'}), 404
+    return jsonify({'usage': get_sweeper().usage(boss_id)}), 200
+
+
+# Presigned local-storage URLs: authorised by their signature, not a JWT
+@main.route('/api/storage/<token>', methods=['GET'])
+def storage_download(token):
+    """Serve a file for a signed download URL (local storage backend)"""
+    storage = get_storage()
+    try:
+        payload = storage.load_token('download', token, current_app.config['STORAGE_URL_TTL'])
+    except InvalidStorageToken as e:
+        return jsonify({'error': str(e)}), 403
+
+    file_path = storage.local_path(payload['key'])
+    if not os.path.exists(file_path):
+        return jsonify({'error': 'File not found on server'}), 404
+    return send_file(file_path, as_attachment=True, download_name=payload['filename'])
+
+
+@main.route('/api/storage/upload/<token>', methods=['POST'])
+def storage_upload(token):
+    """Accept a form upload for a signed upload URL (local storage backend)"""
+    storage = get_storage()
+    try:
+        payload = storage.load_token('upload', token, current_app.config['STORAGE_URL_TTL'])
+    except InvalidStorageToken as e:
+        return jsonify({'error': str(e)}), 403
+
+    file = request.files.get('file')
+    if not file:
+        return jsonify({'error': 'No file provided'}), 400
+
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    if not 0 < size <= payload['max_bytes']:
+        return jsonify({'error': 'File is empty or too large'}), 400
+
+    storage.save(payload['key'], file, payload['content_type'])
+    return '', 204
+
+
 # Dashboard/Analytics Routes
 @main.route('/api/dashboard', methods=['GET'])
 @jwt_required()
+@single_flight()
 def dashboard():
     """Get dashboard statistics"""
     boss_id = int(get_jwt_identity())
     staff_list = StaffService.get_staff_by_boss(boss_id)
+    return jsonify(StaffService.build_dashboard(staff_list)), 200
 
-    stats = {
-        'total_staff': len(staff_list),
-        'employment_status_breakdown': {},
-        'immigration_status_breakdown': {},
-        'gender_breakdown': {}
-    }
 
-    for staff in staff_list:
-        # Employment status breakdown
-        emp_status = staff['employment_status']
-        stats['employment_status_breakdown'][emp_status] = stats['employment_status_breakdown'].get(emp_status, 0) + 1
+@main.route('/api/analytics', methods=['GET'])
+@jwt_required()
+def workforce_analytics():
+    """Get age bands, hiring trend and visa/employment cross-tab"""
+    boss_id = int(get_jwt_identity())
+    return jsonify({'analytics': AnalyticsService.get_workforce_analytics(boss_id)}), 200
 
-        # Immigration status breakdown
-        imm_status = staff['immigration_status']
-        stats['immigration_status_breakdown'][imm_status] = stats['immigration_status_breakdown'].get(imm_status, 0) + 1
 
-        # Gender breakdown
-        gender = staff['sex']
-        stats['gender_breakdown'][gender] = stats['gender_breakdown'].get(gender, 0) + 1
+@main.route('/api/staff/suggest', methods=['GET'])
+@jwt_required()
+def suggest_staff():
+    """Typeahead: id and name of staff whose name starts with q"""
+    boss_id = int(get_jwt_identity())
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), current_app.config['SUGGEST_MAX_LIMIT'])
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
 
-    return jsonify({
-        'statistics': stats,
-        'recent_staff': staff_list[-5:]  # Last 5 added staff
-    }), 200
+    suggestions = get_suggest_index().suggest(boss_id, request.args.get('q', ''), limit)
+    return jsonify({'suggestions': suggestions}), 200
+
+
+@main.route('/api/staff/events', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def staff_events():
+    """Server-sent stream of this boss's staff changes.
+
+    EventSource cannot set headers, so the token may also be passed as ?jwt=.
+    The ASGI app serves this route natively; see events.py for WSGI servers.
+    """
+    if (request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')
+            and not request.environ.get('wsgi.multithread')):
+        # A sync worker would serve nothing else for the life of the stream
+        logger.warning('Refusing staff event stream on a sync gunicorn worker; use -k gthread or gevent')
+        return jsonify({'error': 'Live updates are not available on this server'}), 503
+
+    boss_id = int(get_jwt_identity())
+    broker = get_event_broker()
+    try:
+        subscription = broker.subscribe(boss_id)
+    except TooManyStreams:
+        return too_many_streams()
+    body = stream(
+        broker, subscription,
+        last_event_id=request.headers.get('Last-Event-ID'),
+        heartbeat=current_app.config['EVENTS_HEARTBEAT_SECONDS'],
+        max_seconds=current_app.config['EVENTS_STREAM_SECONDS'],
+    )
+    response = Response(body, mimetype='text/event-stream', headers=STREAM_HEADERS)
+    # Also frees the slot when the body is never iterated
+    response.call_on_close(lambda: broker.unsubscribe(subscription))
+    return response
 
 
 @main.route('/api/staff/search', methods=['GET'])
 @jwt_required()
 def search_staff():
-    """Search staff by query and/or employment status"""
+    """Search staff by query and facet filters.
+
+    employment_status, visa_type, immigration_status and sex may each be
+    repeated to match any of several values. ``limit``/``offset`` return one
+    page plus ``total``; ``facets=1`` adds per-value counts for those fields.
+    """
     try:
         boss_id = int(get_jwt_identity())
-        query = request.args.get('q', '').strip()
-        employment_status = request.args.get('employment_status', '')
+        try:
+            options = StaffService.search_args(request.args)
+        except ValueError:
+            return jsonify({'error': 'limit and offset must be numbers'}), 400
 
-        print(f"Search request - Boss ID: {boss_id}, Query: '{query}', Employment Status: '{employment_status}'")
+        result = StaffService.search_staff_page(boss_id, **options)
 
-        # Allow search with either query or employment_status or both
-        staff_list = StaffService.search_staff(boss_id, query, employment_status)
+        logger.debug('Staff search', extra={
+            'boss_id': boss_id,
+            'query': options['query'],
+            'filters': options['filters'],
+            'results': len(result['staff']),
+        })
 
-        print(f"Search results: {len(staff_list)} staff found")
-
-        return jsonify({'staff': staff_list}), 200
+        return jsonify(result), 200
 
     except Exception as e:
-        print(f"Search error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('Search error')
         return jsonify({'error': str(e)}), 500
 
+# format -> (mimetype, chunk generator) for streamed exports
+EXPORT_FORMATS = {
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', None),
+    'csv': ('text/csv', FileService.generate_staff_csv),
+    'ndjson': ('application/x-ndjson', FileService.generate_staff_ndjson),
+}
+
+
+def _is_buffered_export():
+    # CSV and NDJSON stream from the cursor and cannot be shared; Excel is built in memory
+    return request.args.get('format', 'xlsx').lower() == 'xlsx'
+
+
 @main.route('/api/staff/download', methods=['GET'])
 @jwt_required()
+@single_flight(when=_is_buffered_export)
 def download_staff_excel():
-    """Download staff data as Excel file"""
+    """Download staff data as Excel, CSV or NDJSON.
+
+    Accepts the same ``q`` and repeatable facet filters (employment_status,
+    visa_type, immigration_status, sex) as /api/staff/search. CSV and NDJSON
+    are streamed straight from the database cursor; Excel is built in memory.
+    """
     try:
         boss_id = int(get_jwt_identity())
-        print(f"Download request for boss ID: {boss_id}")
+        export_format = request.args.get('format', 'xlsx').lower()
+        query = request.args.get('q', '').strip()
+        filters = StaffService.search_filters(request.args)
+
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({'error': f"Invalid format. Allowed: {', '.join(EXPORT_FORMATS)}"}), 400
+
+        if export_format != 'xlsx':
+            mimetype, generate = EXPORT_FORMATS[export_format]
+            rows = StaffService.iter_staff_for_export(boss_id, query, filters)
+            return Response(
+                stream_with_context(generate(rows)),
+                mimetype=mimetype,
+                headers={
+                    'Content-Disposition': f'attachment; filename=staff_list_{boss_id}.{export_format}',
+                    'X-Accel-Buffering': 'no',
+                }
+            )
+
+        # Serve an unchanged roster straight from the export cache
+        jobs = current_app.extensions['export_jobs']
+        data_version = StaffService.get_data_version(boss_id)
+        key = jobs.cache_key(boss_id, export_format, query, filters, data_version)
+        cached_path = jobs.cached_artifact(jobs.artifact_path(boss_id, export_format, key))
+        if cached_path:
+            return send_file(
+                cached_path,
+                mimetype=EXPORT_FORMATS['xlsx'][0],
+                as_attachment=True,
+                download_name=f'staff_list_{boss_id}.xlsx'
+            )
 
         # Get all staff for this boss using the export method
-        staff_list = StaffService.get_staff_by_boss_for_export(boss_id)
-        print(f"Found {len(staff_list)} staff members for download")
+        staff_list = StaffService.get_staff_by_boss_for_export(boss_id, query, filters)
 
         if not staff_list:
             return jsonify({'error': 'No staff data to download'}), 404
 
         # Create Excel file
         excel_file = FileService.create_staff_excel(staff_list)
-        print("Excel file created successfully")
+        logger.debug('Excel export created', extra={'boss_id': boss_id, 'rows': len(staff_list)})
+        jobs.store(jobs.artifact_path(boss_id, export_format, key), excel_file.getvalue())
 
         return send_file(
             excel_file,
@@ -351,12 +555,91 @@ def download_staff_excel():
         )
 
     except Exception as e:
-        print(f"Download error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('Download error')
         return jsonify({'error': str(e)}), 500
 
 
+@main.route('/api/staff/exports', methods=['POST'])
+@jwt_required()
+def start_export_job():
+    """Start a background export; completes immediately if the roster is unchanged.
+
+    Takes ``q`` and the facet filters of /api/staff/search, each a value or a list of values.
+    """
+    boss_id = int(get_jwt_identity())
+    data = request.get_json(silent=True) or {}
+    export_format = str(data.get('format', 'xlsx')).lower()
+    query = str(data.get('q', '')).strip()
+    filters = StaffService.search_filters(data)
+
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Invalid format. Allowed: {', '.join(EXPORT_FORMATS)}"}), 400
+
+    jobs = current_app.extensions['export_jobs']
+    data_version = StaffService.get_data_version(boss_id)
+    job = jobs.start(boss_id, export_format, query, filters, data_version)
+    return jsonify({'job': _export_job_response(job)}), 200 if job['status'] == 'completed' else 202
+
+
+@main.route('/api/staff/exports/<job_id>', methods=['GET'])
+@jwt_required()
+def get_export_job(job_id):
+    """Poll the status of an export job"""
+    boss_id = int(get_jwt_identity())
+    job = current_app.extensions['export_jobs'].get_job(job_id)
+    if not job or job['boss_id'] != boss_id:
+        return jsonify({'error': 'Export job not found'}), 404
+    return jsonify({'job': _export_job_response(job)}), 200
+
+
+@main.route('/api/staff/exports/<job_id>/download', methods=['GET'])
+@jwt_required()
+def download_export_job(job_id):
+    """Download the file produced by a completed export job"""
+    boss_id = int(get_jwt_identity())
+    jobs = current_app.extensions['export_jobs']
+    job = jobs.get_job(job_id)
+    if not job or job['boss_id'] != boss_id:
+        return jsonify({'error': 'Export job not found'}), 404
+    if job['status'] != 'completed':
+        return jsonify({'error': 'Export is not ready', 'status': job['status']}), 409
+    if not jobs.cached_artifact(job['path']):
+        return jsonify({'error': 'Export has expired, please start a new one'}), 410
+
+    return send_file(
+        job['path'],
+        mimetype=EXPORT_FORMATS[job['format']][0],
+        as_attachment=True,
+        download_name=f"staff_list_{boss_id}.{job['format']}"
+    )
+
+
+def _export_job_response(job):
+    response = {
+        'id': job['id'],
+        'status': job['status'],
+        'format': job['format'],
+        'cached': job['cached'],
+        'error': job['error'],
+    }
+    if job['status'] == 'completed':
+        response['download_url'] = f"/api/staff/exports/{job['id']}/download"
+    return response
+
+
+@main.route('/api/batch', methods=['POST'])
+@jwt_required()
+def batch_requests():
+    """Run several API calls in one round trip; each sub-request is authorised with the same token"""
+    data = request.get_json(silent=True) or {}
+    try:
+        items = validate_batch(data.get('requests'), current_app.config['BATCH_MAX_REQUESTS'])
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'responses': run_batch(items)}), 200
+
+
 # Error Handlers
 @main.errorhandler(404)
 def not_found(error):
@@ -0,0 +1,185 @@
+"""Schema management: table creation, indexes and optional staff partitioning.
+
+On PostgreSQL the ``staff`` table can be created as a hash-partitioned
+table on ``boss_id`` (``STAFF_PARTITIONS`` > 0). Every StaffService query
+filters on ``boss_id`` so the planner prunes to a single partition.
+
+PostgreSQL requires unique constraints on a partitioned table to include the
+partition key, so the primary key becomes ``(id, boss_id)`` and the
+National Insurance number constraint becomes ``(national_insurance_number,
+boss_id)``; global NI uniqueness is then enforced by StaffService, which
+checks ``ni_unique_enforced()`` before each write and then guards the
+statement with NOT EXISTS under an advisory lock on the NI number.
+"""
+import os
+import logging
+
+import click
+from flask import current_app
+from sqlalchemy import MetaData, Table, inspect, text
+
+from . import db
+from .models import Boss, Staff
+
+logger = logging.getLogger(__name__)
+
+
+def _partitioned_staff_table():
+    """Copy of the staff table definition shaped for hash partitioning"""
+    metadata = MetaData()
+    Boss.__table__.to_metadata(metadata)
+
+    columns = []
+    for column in Staff.__table__.columns:
+        copy = column._copy()
+        copy.unique = False
+        copy.index = False
+        if column.name == 'boss_id':
+            copy.primary_key = True
+        columns.append(copy)
+
+    table = Table(
+        'staff', metadata, *columns,
+        db.ForeignKeyConstraint(['boss_id'], ['boss.id']),
+        db.UniqueConstraint('national_insurance_number', 'boss_id', name='uq_staff_ni_boss'),
+        postgresql_partition_by='HASH (boss_id)',
+    )
+    table.c.id.autoincrement = True
+    return table
+
+
+def is_partitioned(bind):
+    """True when the existing staff table is a partitioned table"""
+    if bind.dialect.name != 'postgresql':
+        return False
+    return bool(bind.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = 'staff' AND c.relnamespace = current_schema()::regnamespace"
+    )).scalar())
+
+
+def ni_unique_enforced():
+    """False when staff is partitioned and the database only keeps NI numbers unique per boss.
+
+    Looked up once per process, so restart workers after ``flask schema partition``.
+    """
+    enforced = current_app.extensions.get('staff_ni_unique')
+    if enforced is None:
+        with db.engine.connect() as conn:
+            enforced = current_app.extensions['staff_ni_unique'] = not is_partitioned(conn)
+    return enforced
+
+
+def _create_partitions(bind, partitions):
+    for remainder in range(partitions):
+        bind.execute(text(
+            f'CREATE TABLE IF NOT EXISTS staff_p{remainder} PARTITION OF staff '
+            f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})'
+        ))
+
+
+def ensure_indexes(bind):
+    """Create any model indexes missing from existing tables (create_all skips them)"""
+    for table in (Boss.__table__, Staff.__table__):
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+
+
+def create_schema(partitions=0):
+    """Create all tables, partitioning staff on PostgreSQL when ``partitions`` > 0"""
+    bind = db.engine
+    with bind.begin() as conn:
+        if partitions and conn.dialect.name == 'postgresql':
+            if not inspect(conn).has_table('staff'):
+                db.metadata.create_all(conn, tables=[Boss.__table__])
+                _partitioned_staff_table().create(conn)
+                _create_partitions(conn, partitions)
+                logger.info('Created staff table with %d hash partitions', partitions)
+            elif not is_partitioned(conn):
+                logger.warning('staff exists as a plain table; run "flask schema partition" to convert it')
+        elif partitions:
+            logger.warning('STAFF_PARTITIONS is only supported on PostgreSQL; creating a plain staff table')
+
+        db.metadata.create_all(conn)
+        ensure_indexes(conn)
+
+
+def convert_to_partitioned(partitions):
+    """Rebuild an existing plain staff table as a partitioned one, in a single transaction"""
+    bind = db.engine
+    if bind.dialect.name != 'postgresql':
+        raise click.ClickException('Partitioning requires PostgreSQL')
+
+    with bind.begin() as conn:
+        if is_partitioned(conn):
+            raise click.ClickException('staff is already partitioned')
+
+        conn.execute(text('LOCK TABLE staff IN ACCESS EXCLUSIVE MODE'))
+        conn.execute(text('ALTER TABLE staff RENAME TO staff_heap'))
+        # Constraint and index names must be free for the new table
+        constraint_names = conn.execute(text(
+            "SELECT conname FROM pg_constraint WHERE conrelid = 'staff_heap'::regclass"
+        )).scalars().all()
+        for name in constraint_names:
+            conn.execute(text(f'ALTER TABLE staff_heap RENAME CONSTRAINT "{name}" TO "{name}_heap"'))
+        for index in Staff.__table__.indexes:
+            conn.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+
+        table = _partitioned_staff_table()
+        table.create(conn)
+        _create_partitions(conn, partitions)
+
+        column_list = ', '.join(c.name for c in table.columns)
+        conn.execute(text(f'INSERT INTO staff ({column_list}) SELECT {column_list} FROM staff_heap'))
+        conn.execute(text(
+            "SELECT setval(pg_get_serial_sequence('staff', 'id'), COALESCE((SELECT MAX(id) FROM staff), 0) + 1, false)"
+        ))
+        conn.execute(text('DROP TABLE staff_heap'))
+        ensure_indexes(conn)
+
+
+def partition_stats(bind):
+    """Row counts and on-disk size per staff partition"""
+    return bind.execute(text(
+        "SELECT c.relname, c.reltuples::bigint, pg_total_relation_size(c.oid) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'staff' ORDER BY c.relname"
+    )).all()
+
+
+@click.group('schema')
+def schema_cli():
+    """Database schema management"""
+
+
+@schema_cli.command('init')
+@click.option('--partitions', type=int, default=None,
+              help='hash partitions for staff (PostgreSQL only, defaults to STAFF_PARTITIONS)')
+def init_command(partitions):
+    """Create missing tables and indexes"""
+    create_schema(current_app.config['STAFF_PARTITIONS'] if partitions is None else partitions)
+    click.echo('Schema is up to date')
+
+
+@schema_cli.command('partition')
+@click.option('--partitions', type=int, required=True)
+def partition_command(partitions):
+    """Convert the existing staff table to hash partitions on boss_id"""
+    convert_to_partitioned(partitions)
+    click.echo(f'staff converted to {partitions} hash partitions')
+
+
+@schema_cli.command('status')
+def status_command():
+    """Show whether staff is partitioned and per-partition sizes"""
+    with db.engine.connect() as conn:
+        if not is_partitioned(conn):
+            click.echo('staff is not partitioned')
+            return
+        for name, rows, size in partition_stats(conn):
+            click.echo(f'{name:20s} ~{rows:>10} rows {size / 1024 / 1024:>10.1f} MB')
+
+
+def init_app(app):
+    app.config.setdefault('STAFF_PARTITIONS', int(os.environ.get('STAFF_PARTITIONS', 0)))
+    app.cli.add_command(schema_cli)
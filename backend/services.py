@@ -1,13 +1,32 @@
 from flask import current_app
-import os
-from datetime import datetime
-from .models import db, Boss, Staff
+import csv
+import json
+import uuid
+import logging
+import re
+import mimetypes
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from .models import db, Boss, Staff, PasswordResetToken, RevokedToken
 from email_validator import validate_email, EmailNotValidError
 from . import mail
+from .cache import LRUCache
+from .revocation import get_revocation_list
+from .embedded import icontains
+from .schema import ni_unique_enforced
+from .storage import get_storage
+from .signals import staff_changed
+from . import staff_schema
+from .staff_schema import SchemaError
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 from flask_mail import Message
-import traceback
 import pandas as pd
-from io import BytesIO
+from io import BytesIO, StringIO
+
+logger = logging.getLogger(__name__)
+
 
 class BossService:
     @staticmethod
@@ -51,29 +70,32 @@ class BossService:
             return {'message': 'If email exists, reset link has been sent'}, 200
 
         try:
-            # Generate the code - this will save to reset_token column
-            code = boss.generate_reset_token()
+            # One INSERT into password_reset_token; the boss row is not written
+            lifetime = timedelta(minutes=current_app.config['RESET_TOKEN_TTL_MINUTES'])
+            code = PasswordResetToken.issue(boss.email, lifetime)
 
             # Try to send email (optional since email is failing)
             try:
-                EmailService.send_password_reset_email(boss)
+                EmailService.send_password_reset_email(boss, code)
             except Exception as email_error:
-                print(f"Email sending failed: {email_error}")
+                logger.warning('Email sending failed: %s', email_error)
 
             # Return success with debug code for testing
             return {
                 'message': 'Password reset code sent to your email'
             }, 200
         except Exception as e:
-            print(f"Error in request_password_reset: {e}")
-            traceback.print_exc()
+            logger.exception('Error in request_password_reset')
             return {'error': f'Failed to send reset email: {str(e)}'}, 500
 
 
     @staticmethod
     def reset_password(email, code, new_password):
         """Reset password using email and code"""
-        boss = Boss.verify_reset_token(email, code)
+        if not PasswordResetToken.verify(email, code):
+            return {'error': 'Invalid or expired token'}, 400
+
+        boss = Boss.query.filter_by(email=email.lower()).first()
         if not boss:
             return {'error': 'Invalid or expired token'}, 400
 
@@ -82,132 +104,181 @@ class BossService:
         if not is_valid:
             return {'error': message}, 400
 
+        # Password change, code revocation and sign-out everywhere in one transaction
         boss.set_password(new_password)
-        boss.clear_reset_code()
+        PasswordResetToken.revoke_all(boss.email)
+        RevokedToken.revoke_all(boss.id, current_app.config['JWT_ACCESS_TOKEN_EXPIRES'])
         db.session.commit()
+        get_revocation_list().sync()
         return {'message': 'Password reset successfully'}, 200
 
+    @staticmethod
+    def logout(boss_id, token):
+        """Revoke the access token ``token`` (its decoded claims)"""
+        RevokedToken.revoke(token['jti'], boss_id, datetime.utcfromtimestamp(token['exp']))
+        db.session.commit()
+        get_revocation_list().sync()
+        return {'message': 'Logged out successfully'}, 200
+
 
 class StaffService:
     @staticmethod
     def add_staff(boss_id, staff_data):
         """Add new staff member"""
         try:
-            staff = Staff(
-                boss_id=boss_id,
-                firstname=staff_data['firstname'],
-                lastname=staff_data['lastname'],
-                national_insurance_number=staff_data['national_insurance_number'],
-                home_address=staff_data['home_address'],
-                telephone_number=staff_data['telephone_number'],
-                employment_status=staff_data['employment_status'],
-                immigration_status=staff_data['immigration_status'],
-                visa_type=staff_data.get('visa_type'),
-                visa_sharecode=staff_data.get('visa_sharecode'),
-                sex=staff_data['sex'],
-                date_of_birth=datetime.strptime(staff_data['date_of_birth'], '%Y-%m-%d').date(),
-                proof_of_id='pending_upload'  # Placeholder until file is uploaded
-            )
-
-            db.session.add(staff)
+            staff = StaffService._insert(boss_id, staff_schema.coerce(staff_data))
             db.session.commit()
-            return {'message': 'Staff added successfully', 'staff_id': staff.id}, 201
+        except DuplicateNINumber:
+            db.session.rollback()
+            return {'error': NI_NUMBER_EXISTS}, 400
         except Exception as e:
             db.session.rollback()
             return {'error': str(e)}, 400
 
+        StaffService._notify('added', staff, boss_id)
+        return {'message': 'Staff added successfully', 'staff_id': staff['id']}, 201
+
     @staticmethod
     def add_staff_with_file(boss_id, data, file=None):
         """Add staff member with optional proof of ID file upload"""
         try:
-            # Parse date of birth
-            try:
-                date_of_birth = datetime.strptime(data['date_of_birth'], '%Y-%m-%d').date()
-            except ValueError:
-                return {'error': 'Invalid date format. Use YYYY-MM-DD'}, 400
-
-            # Check if National Insurance Number already exists
-            existing_staff = Staff.query.filter_by(
-                national_insurance_number=data['national_insurance_number'].upper()
-            ).first()
-            if existing_staff:
-                return {'error': 'National Insurance Number already exists'}, 400
-
-            # Handle file upload if provided
-            proof_of_id_filename = 'pending_upload'
-            if file and file.filename:
-                # Validate file type
-                if not FileService.allowed_file(file.filename):
-                    return {'error': 'Invalid file type. Allowed: PDF, PNG, JPG, JPEG'}, 400
-
-                # Create staff first to get ID for filename
-                staff = Staff(
-                    firstname=data['firstname'].strip(),
-                    lastname=data['lastname'].strip(),
-                    national_insurance_number=data['national_insurance_number'].upper(),
-                    home_address=data['home_address'].strip(),
-                    telephone_number=data['telephone_number'].strip(),
-                    employment_status=data['employment_status'],
-                    immigration_status=data['immigration_status'].strip(),
-                    visa_type=data['visa_type'].strip(),
-                    visa_sharecode=data['visa_sharecode'].strip(),
-                    sex=data['sex'],
-                    date_of_birth=date_of_birth,
-                    proof_of_id='temp',  # Temporary value
-                    boss_id=boss_id
-                )
+            values = staff_schema.coerce(data)
+        except SchemaError as e:
+            return {'error': str(e)}, 400
 
-                db.session.add(staff)
-                db.session.flush()  # Get the ID without committing
+        # Validate file type before writing anything
+        has_file = file and file.filename
+        if has_file and not FileService.allowed_file(file.filename):
+            return {'error': 'Invalid file type. Allowed: PDF, PNG, JPG, JPEG'}, 400
 
-                # Save file with proper naming convention
-                file_extension = file.filename.rsplit('.', 1)[1].lower()
-                filename = f"staff_{staff.id}_{data['firstname'].lower()}_id.{file_extension}"
-                upload_folder = current_app.config['UPLOAD_FOLDER']
-                os.makedirs(upload_folder, exist_ok=True)
-                file_path = os.path.join(upload_folder, filename)
-                file.save(file_path)
+        filename = None
+        try:
+            # Without a file the staff member needs a separate upload later
+            staff = StaffService._insert(boss_id, values)
 
-                # Update with actual filename
-                staff.proof_of_id = filename
-                proof_of_id_filename = filename
-            else:
-                # Create staff without file (will require separate upload)
-                staff = Staff(
-                    firstname=data['firstname'].strip(),
-                    lastname=data['lastname'].strip(),
-                    national_insurance_number=data['national_insurance_number'].upper(),
-                    home_address=data['home_address'].strip(),
-                    telephone_number=data['telephone_number'].strip(),
-                    employment_status=data['employment_status'],
-                    immigration_status=data['immigration_status'].strip(),
-                    visa_type=data['visa_type'].strip(),
-                    visa_sharecode=data['visa_sharecode'].strip(),
-                    sex=data['sex'],
-                    date_of_birth=date_of_birth,
-                    proof_of_id=proof_of_id_filename,
-                    boss_id=boss_id
-                )
-                db.session.add(staff)
+            if has_file:
+                # The file name needs the id RETURNING gave us; the row is written in the same transaction
+                filename = FileService.store_proof_of_id(file, staff['id'], values['firstname'])
+                db.session.execute(db.update(_staff).where(
+                    _staff.c.id == staff['id'], _staff.c.boss_id == boss_id
+                ).values(proof_of_id=filename))
+                staff['proof_of_id'] = filename
 
             db.session.commit()
-
-            return {
-                'message': 'Staff member added successfully',
-                'staff': staff.to_dict(),
-                'file_status': 'uploaded' if file else 'pending_upload'
-            }, 201
-
+        except DuplicateNINumber:
+            db.session.rollback()
+            return {'error': NI_NUMBER_EXISTS}, 400
         except Exception as e:
             db.session.rollback()
+            FileService.discard_proof_of_id(filename)
             return {'error': f'Failed to add staff: {str(e)}'}, 500
 
+        StaffService._notify('added', staff, boss_id)
+        return {
+            'message': 'Staff member added successfully',
+            'staff': staff,
+            'file_status': 'uploaded' if file else 'pending_upload'
+        }, 201
+
+    @staticmethod
+    def _insert(boss_id, values):
+        """INSERT ... RETURNING a new staff member (caller commits); returns its to_dict().
+
+        A taken National Insurance number is caught by the unique constraint,
+        not looked up first. Raises DuplicateNINumber.
+        """
+        row = dict(values, boss_id=boss_id, proof_of_id='pending_upload', created_at=datetime.utcnow())
+        if ni_unique_enforced():
+            statement = db.insert(_staff).values(row)
+        else:
+            # Partitioned staff is only unique per boss; other bosses are checked in the same statement
+            _lock_ni_number(row['national_insurance_number'])
+            taken = db.select(_staff.c.id).where(_staff.c.national_insurance_number == row['national_insurance_number'])
+            source = db.select(*(db.literal(value, _staff.c[name].type) for name, value in row.items()))
+            statement = db.insert(_staff).from_select(list(row), source.where(~taken.exists()))
+
+        try:
+            created = db.session.execute(statement.returning(*STAFF_COLUMNS)).first()
+        except IntegrityError as e:
+            if _is_ni_conflict(e):
+                raise DuplicateNINumber from e
+            raise
+        if created is None:
+            raise DuplicateNINumber
+        return staff_schema.from_values(created)
+
+    @staticmethod
+    def _update(staff_id, boss_id, values):
+        """UPDATE ... RETURNING one of ``boss_id``'s staff (caller commits).
+
+        Ownership is part of the WHERE clause and a taken National Insurance
+        number is caught by the unique constraint, so there is no read first.
+        Returns ``(staff, previous)`` as to_dict()s, or None if the boss has
+        no such staff member. Raises DuplicateNINumber.
+        """
+        owned = (_staff.c.id == staff_id, _staff.c.boss_id == boss_id)
+        statement = db.update(_staff).where(*owned).values({**values, 'updated_at': datetime.utcnow()})
+
+        guarded = 'national_insurance_number' in values and not ni_unique_enforced()
+        if guarded:
+            _lock_ni_number(values['national_insurance_number'])
+            other = _staff.alias('other')
+            statement = statement.where(~db.select(other.c.id).where(
+                other.c.national_insurance_number == values['national_insurance_number'],
+                other.c.id != staff_id
+            ).exists())
+
+        if db.engine.dialect.name == 'postgresql':
+            # The row as it was comes back from a locked CTE in the same statement
+            before = db.select(*STAFF_COLUMNS).where(*owned).with_for_update().cte('previous')
+            statement = statement.where(_staff.c.id == before.c.id).returning(
+                *STAFF_COLUMNS, *(column.label(f'previous_{column.name}') for column in before.c))
+            previous = None
+        else:
+            # SQLite cannot return another table's columns; an embedded read is no round trip
+            previous = db.session.execute(db.select(*STAFF_COLUMNS).where(*owned)).first()
+            if previous is None:
+                return None
+            statement = statement.returning(*STAFF_COLUMNS)
+
+        try:
+            row = db.session.execute(statement).first()
+        except IntegrityError as e:
+            if _is_ni_conflict(e):
+                raise DuplicateNINumber from e
+            raise
+        if row is None:
+            if guarded and db.session.execute(db.select(_staff.c.id).where(*owned)).first() is not None:
+                raise DuplicateNINumber
+            return None
+
+        width = len(STAFF_COLUMNS)
+        if previous is None:
+            previous = row[width:]
+        return staff_schema.from_values(row[:width]), staff_schema.from_values(previous)
+
+    @staticmethod
+    def _notify(action, staff, boss_id, previous=None):
+        """Tell in-process caches and event streams about a committed staff write"""
+        staff_changed.send(current_app._get_current_object(), boss_id=boss_id, action=action, staff=staff,
+                           previous=previous)
+
     @staticmethod
     def get_staff_by_boss(boss_id):
         """Get all staff members for a specific boss"""
         staff_list = Staff.query.filter_by(boss_id=boss_id).all()
         return [staff.to_dict() for staff in staff_list]
 
+    @staticmethod
+    def get_data_version(boss_id):
+        """Fingerprint of a boss's staff data that changes on every insert, update or delete"""
+        count, max_id, last_change = db.session.query(
+            db.func.count(Staff.id),
+            db.func.max(Staff.id),
+            db.func.max(db.func.coalesce(Staff.updated_at, Staff.created_at))
+        ).filter(Staff.boss_id == boss_id).one()
+        return f'{count}-{max_id or 0}-{last_change or 0}'
+
     @staticmethod
     def get_staff_by_id(staff_id, boss_id):
         """Get specific staff member"""
@@ -215,140 +286,110 @@ class StaffService:
         return staff.to_dict() if staff else None
 
     @staticmethod
-    def get_staff_by_boss_for_export(boss_id):
-        """Get all staff for a specific boss in export format"""
+    def get_staff_by_boss_for_export(boss_id, query=None, filters=None):
+        """Get all staff for a specific boss in export format, narrowed as by /api/staff/search"""
         try:
-            staff_query = Staff.query.filter_by(boss_id=boss_id).order_by(Staff.firstname, Staff.lastname)
-
-            staff_list = []
-            for staff in staff_query.all():
-                staff_list.append({
-                    'id': staff.id,
-                    'firstname': staff.firstname,
-                    'lastname': staff.lastname,
-                    'national_insurance_number': staff.national_insurance_number,
-                    'home_address': staff.home_address,
-                    'telephone_number': staff.telephone_number,
-                    'employment_status': staff.employment_status,
-                    'immigration_status': staff.immigration_status,
-                    'visa_type': staff.visa_type,
-                    'visa_sharecode': staff.visa_sharecode,
-                    'sex': staff.sex,
-                    'date_of_birth': staff.date_of_birth.strftime('%Y-%m-%d') if staff.date_of_birth else '',
-                    'proof_of_id': staff.proof_of_id
-                })
-
-            return staff_list
+            staff_query = StaffService._filtered_staff_query(boss_id, query, filters)
 
-        except Exception as e:
-            print(f"Get staff for export error: {e}")
+            return [StaffService.staff_row(staff) for staff in staff_query.all()]
+
+        except Exception:
+            logger.exception('Get staff for export error')
             return []
 
+    @staticmethod
+    def iter_staff_for_export(boss_id, query=None, filters=None, batch_size=1000):
+        """Yield staff rows in export format from a server-side cursor.
+
+        Only the exported columns are selected and rows are fetched in
+        batches of ``batch_size``, so memory stays flat however large the
+        company is.
+        """
+        columns = [getattr(Staff, field) for field in STAFF_EXPORT_FIELDS]
+        statement = StaffService._filtered_staff_query(boss_id, query, filters).with_entities(*columns)
+        result = db.session.execute(
+            statement.statement.execution_options(stream_results=True, yield_per=batch_size)
+        )
+        for row in result:
+            yield staff_schema.from_values(row)
+
     @staticmethod
     def update_staff_json_only(staff_id, boss_id, update_data):
         """Update staff member with JSON data only (no file upload)"""
-        staff = Staff.query.filter_by(id=staff_id, boss_id=boss_id).first()
-        if not staff:
-            return {'error': 'Staff not found'}, 404
+        try:
+            values = staff_schema.coerce_update(update_data)
+        except SchemaError as e:
+            return {'error': str(e)}, 400
 
         try:
-            # Update fields from JSON data
-            for key, value in update_data.items():
-                if key == 'date_of_birth' and value:
-                    try:
-                        value = datetime.strptime(value, '%Y-%m-%d').date()
-                    except ValueError:
-                        return {'error': 'Invalid date format. Use YYYY-MM-DD'}, 400
-                elif key == 'national_insurance_number' and value:
-                    # Check if NI number is being changed and if it already exists
-                    if value.upper() != staff.national_insurance_number:
-                        existing = Staff.query.filter_by(national_insurance_number=value.upper()).first()
-                        if existing:
-                            return {'error': 'National Insurance Number already exists'}, 400
-                    value = value.upper()
-                elif isinstance(value, str):
-                    value = value.strip()
-
-                # Only update valid staff attributes
-                if hasattr(staff, key) and key not in ['id', 'boss_id', 'created_at']:
-                    setattr(staff, key, value)
-
-            staff.updated_at = datetime.utcnow()
+            changed = StaffService._update(staff_id, boss_id, values)
+            if changed is None:
+                db.session.rollback()
+                return {'error': 'Staff not found'}, 404
             db.session.commit()
-
-            return {
-                'message': 'Staff updated successfully',
-                'staff': staff.to_dict()
-            }, 200
-
+        except DuplicateNINumber:
+            db.session.rollback()
+            return {'error': NI_NUMBER_EXISTS}, 400
         except Exception as e:
             db.session.rollback()
             return {'error': f'Failed to update staff: {str(e)}'}, 500
 
+        staff, previous = changed
+        StaffService._notify('updated', staff, boss_id, previous)
+        return {
+            'message': 'Staff updated successfully',
+            'staff': staff
+        }, 200
+
     @staticmethod
     def update_staff_with_file(staff_id, boss_id, update_data, file=None):
         """Update staff member with form data and optional file upload (like add_staff_with_file)"""
-        staff = Staff.query.filter_by(id=staff_id, boss_id=boss_id).first()
-        if not staff:
-            return {'error': 'Staff not found'}, 404
-
+        # Form posts send every field; blank ones are left unchanged
         try:
-            # Handle file upload first if provided (same as add_staff_with_file)
-            if file and file.filename:
-                if not FileService.allowed_file(file.filename):
-                    return {'error': 'Invalid file type. Allowed: PDF, PNG, JPG, JPEG'}, 400
-
-                # Delete old file if it exists
-                if staff.proof_of_id and staff.proof_of_id != 'pending_upload':
-                    old_file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], staff.proof_of_id)
-                    if os.path.exists(old_file_path):
-                        os.remove(old_file_path)
-
-                # Save new file
-                file_extension = file.filename.rsplit('.', 1)[1].lower()
-                filename = f"staff_{staff_id}_{staff.firstname.lower()}_id.{file_extension}"
-                upload_folder = current_app.config['UPLOAD_FOLDER']
-                os.makedirs(upload_folder, exist_ok=True)
-                file_path = os.path.join(upload_folder, filename)
-                file.save(file_path)
-
-                # Update proof_of_id in update_data
-                update_data['proof_of_id'] = filename
-
-            # Update other fields (same logic as add_staff_with_file)
-            for key, value in update_data.items():
-                if key == 'date_of_birth' and value:
-                    try:
-                        value = datetime.strptime(value, '%Y-%m-%d').date()
-                    except ValueError:
-                        return {'error': 'Invalid date format. Use YYYY-MM-DD'}, 400
-                elif key == 'national_insurance_number' and value:
-                    # Check if NI number is being changed and if it already exists
-                    if value.upper() != staff.national_insurance_number:
-                        existing = Staff.query.filter_by(national_insurance_number=value.upper()).first()
-                        if existing:
-                            return {'error': 'National Insurance Number already exists'}, 400
-                    value = value.upper()
-                elif isinstance(value, str) and value:
-                    value = value.strip()
-
-                # Only update valid staff attributes
-                if hasattr(staff, key) and key not in ['id', 'boss_id', 'created_at'] and value:
-                    setattr(staff, key, value)
-
-            staff.updated_at = datetime.utcnow()
-            db.session.commit()
+            values = staff_schema.coerce_update(update_data, skip_empty=True)
+        except SchemaError as e:
+            return {'error': str(e)}, 400
 
-            return {
-                'message': 'Staff updated successfully',
-                'staff': staff.to_dict(),
-                'file_status': 'uploaded' if file else 'no_file_change'
-            }, 200
+        has_file = file and file.filename
+        if has_file and not FileService.allowed_file(file.filename):
+            return {'error': 'Invalid file type. Allowed: PDF, PNG, JPG, JPEG'}, 400
+
+        filename = None
+        try:
+            changed = StaffService._update(staff_id, boss_id, values)
+            if changed is None:
+                db.session.rollback()
+                return {'error': 'Staff not found'}, 404
+            staff, previous = changed
+
+            if has_file:
+                # A fresh key, so the current document stays valid until the commit
+                filename = FileService.new_document_key(staff_id, staff['firstname'], file.filename)
+                get_storage().save(filename, file, file.mimetype)
+                db.session.execute(db.update(_staff).where(
+                    _staff.c.id == staff_id, _staff.c.boss_id == boss_id
+                ).values(proof_of_id=filename))
+                staff['proof_of_id'] = filename
 
+            db.session.commit()
+        except DuplicateNINumber:
+            db.session.rollback()
+            return {'error': NI_NUMBER_EXISTS}, 400
         except Exception as e:
             db.session.rollback()
+            FileService.discard_proof_of_id(filename)
             return {'error': f'Failed to update staff: {str(e)}'}, 500
 
+        StaffService._notify('updated', staff, boss_id, previous)
+        if filename:
+            FileService.discard_proof_of_id(previous['proof_of_id'])
+
+        return {
+            'message': 'Staff updated successfully',
+            'staff': staff,
+            'file_status': 'uploaded' if file else 'no_file_change'
+        }, 200
+
     @staticmethod
     def delete_staff(staff_id, boss_id):
         """Delete staff member"""
@@ -356,56 +397,288 @@ class StaffService:
         if not staff:
             return {'error': 'Staff not found'}, 404
 
+        proof_of_id = staff.proof_of_id
+        deleted = staff.to_dict()
         db.session.delete(staff)
         db.session.commit()
+        StaffService._notify('deleted', deleted, boss_id)
+
+        # The row is gone; a failure here leaves an orphan for the upload sweeper
+        try:
+            FileService.delete_proof_of_id(proof_of_id)
+        except Exception:
+            logger.exception('Failed to delete proof of ID %s', proof_of_id)
         return {'message': 'Staff deleted successfully'}, 200
 
     @staticmethod
-    def search_staff(boss_id, query=None, employment_status=None):
+    def search_staff(boss_id, query=None, employment_status=None, filters=None):
         """Search staff by query and/or employment status"""
+        return StaffService.search_staff_page(boss_id, query, employment_status, filters)['staff']
+
+    @staticmethod
+    def search_staff_page(boss_id, query=None, employment_status=None, filters=None,
+                          facets=False, limit=None, offset=0):
+        """Search staff, optionally one page at a time and with facet counts.
+
+        ``filters`` maps FACET_FIELDS to lists of accepted values. With a
+        ``limit`` the result includes ``total``; with ``facets`` it includes
+        counts per value of every facet field (see facet_statement).
+        """
+        filters = StaffService.merge_filters(filters, employment_status)
         try:
-            # Start with base query
-            staff_query = Staff.query.filter_by(boss_id=boss_id)
-
-            # Add search conditions
-            if query:
-                search_term = f'%{query}%'
-                staff_query = staff_query.filter(
-                    db.or_(
-                        Staff.firstname.ilike(search_term),
-                        Staff.lastname.ilike(search_term),
-                        Staff.telephone_number.ilike(search_term),
-                        Staff.national_insurance_number.ilike(search_term)
-                    )
+            statement = StaffService.search_page_statement(boss_id, query, filters, limit, offset)
+            if limit is None:
+                staff_list = db.session.execute(statement).scalars().all()
+                result = {'staff': [StaffService.staff_row(staff) for staff in staff_list]}
+            else:
+                rows = db.session.execute(statement).all()
+                result = {'staff': [StaffService.staff_row(row[0]) for row in rows]}
+                result['total'] = rows[0][1] if rows else StaffService._count(boss_id, query, filters, offset)
+
+            if facets:
+                statement = StaffService.facet_statement(boss_id, query, filters, db.session.get_bind().dialect.name)
+                result['facets'] = StaffService.facet_counts(db.session.execute(statement))
+            return result
+
+        except Exception:
+            logger.exception('Search error')
+            db.session.rollback()
+            result = {'staff': []}
+            if limit is not None:
+                result['total'] = 0
+            if facets:
+                result['facets'] = {field: [] for field in FACET_FIELDS}
+            return result
+
+    @staticmethod
+    def _count(boss_id, query, filters, offset):
+        # The windowed total rides on the page rows; an empty page needs its own count
+        if not offset:
+            return 0
+        conditions = StaffService.search_conditions(boss_id, query, filters=filters)
+        return db.session.execute(db.select(db.func.count()).select_from(Staff).where(*conditions)).scalar()
+
+    @staticmethod
+    def _filtered_staff_query(boss_id, query=None, filters=None):
+        """Build the boss-scoped, ordered staff query shared by search and export"""
+        conditions = StaffService.search_conditions(boss_id, query, filters=filters)
+        return Staff.query.filter(*conditions).order_by(*STAFF_ORDER)
+
+    @staticmethod
+    def search_args(args):
+        """search_staff_page keyword arguments from request args; raises ValueError for a bad limit/offset"""
+        limit = args.get('limit')
+        if limit is not None:
+            limit = min(max(int(limit), 1), SEARCH_MAX_LIMIT)
+        offset = max(int(args.get('offset', 0)), 0)
+        return {
+            'query': args.get('q', '').strip(),
+            'filters': StaffService.search_filters(args),
+            'facets': args.get('facets', '').lower() in ('1', 'true', 'yes'),
+            'limit': limit,
+            'offset': offset if limit is not None else 0,
+        }
+
+    @staticmethod
+    def search_filters(args):
+        """Facet filters from request args or a JSON object.
+
+        Each field may be repeated (or, in JSON, a list) to accept several values.
+        """
+        filters = {}
+        for field in FACET_FIELDS:
+            if hasattr(args, 'getlist'):
+                values = args.getlist(field)
+            else:
+                value = args.get(field)
+                values = value if isinstance(value, list) else [value]
+            values = [str(value) for value in values if value]
+            if values:
+                filters[field] = values
+        return filters
+
+    @staticmethod
+    def merge_filters(filters, employment_status=None):
+        """Copy of ``filters`` with the single-value employment_status argument folded in"""
+        filters = dict(filters or {})
+        if employment_status and 'employment_status' not in filters:
+            filters['employment_status'] = [employment_status]
+        return filters
+
+    @staticmethod
+    def search_conditions(boss_id, query=None, employment_status=None, filters=None, exclude=None):
+        """WHERE clauses for a boss-scoped staff search; usable with sync or async sessions.
+
+        ``exclude`` names a facet field whose own filter is left out, for
+        counting that facet's other values.
+        """
+        # Start with base query
+        conditions = [Staff.boss_id == boss_id]
+
+        # Add search conditions
+        if query:
+            search_term = f'%{query}%'
+            conditions.append(
+                db.or_(
+                    icontains(Staff.firstname, search_term),
+                    icontains(Staff.lastname, search_term),
+                    icontains(Staff.telephone_number, search_term),
+                    icontains(Staff.national_insurance_number, search_term)
                 )
+            )
 
-            if employment_status:
-                staff_query = staff_query.filter_by(employment_status=employment_status)
-
-            # Execute query and convert to list
-            staff_list = []
-            for staff in staff_query.order_by(Staff.firstname, Staff.lastname).all():
-                staff_list.append({
-                    'id': staff.id,
-                    'firstname': staff.firstname,
-                    'lastname': staff.lastname,
-                    'national_insurance_number': staff.national_insurance_number,
-                    'home_address': staff.home_address,
-                    'telephone_number': staff.telephone_number,
-                    'employment_status': staff.employment_status,
-                    'immigration_status': staff.immigration_status,
-                    'visa_type': staff.visa_type,
-                    'visa_sharecode': staff.visa_sharecode,
-                    'sex': staff.sex,
-                    'date_of_birth': staff.date_of_birth.strftime('%Y-%m-%d') if staff.date_of_birth else '',
-                    'proof_of_id': staff.proof_of_id
-                })
-
-            return staff_list
+        for field, values in StaffService.merge_filters(filters, employment_status).items():
+            if field == exclude:
+                continue
+            column = getattr(Staff, field)
+            conditions.append(column == values[0] if len(values) == 1 else column.in_(values))
 
-        except Exception as e:
-            print(f"Search error: {e}")
-            return []
+        return conditions
+
+    @staticmethod
+    def search_page_statement(boss_id, query=None, filters=None, limit=None, offset=0):
+        """Ordered Staff select; with ``limit``, each row also carries the unpaged total"""
+        conditions = StaffService.search_conditions(boss_id, query, filters=filters)
+        statement = db.select(Staff).where(*conditions).order_by(*STAFF_ORDER, Staff.id)
+        if limit is None:
+            return statement
+        return statement.add_columns(db.func.count().over().label('total')).limit(limit).offset(offset)
+
+    @staticmethod
+    def facet_statement(boss_id, query=None, filters=None, dialect='postgresql'):
+        """One statement yielding (facet, value, count) rows for every facet field.
+
+        Each facet is counted with all filters applied except its own, so the
+        counts show what selecting another value would return. PostgreSQL
+        computes every facet in a single scan with GROUPING SETS and
+        per-facet FILTER clauses; elsewhere each facet is a GROUP BY branch of
+        a UNION ALL, which can use the (boss_id, field) indexes.
+        """
+        filters = filters or {}
+        columns = [getattr(Staff, field) for field in FACET_FIELDS]
+
+        if dialect != 'postgresql':
+            return db.union_all(*(
+                db.select(db.literal(field).label('facet'), column.label('value'), db.func.count().label('count'))
+                .where(*StaffService.search_conditions(boss_id, query, filters=filters, exclude=field))
+                .group_by(column)
+                for field, column in zip(FACET_FIELDS, columns)
+            ))
+
+        # Only the free-text condition is shared; facet filters move into FILTER clauses
+        conditions = StaffService.search_conditions(boss_id, query)
+        counts = []
+        for field in FACET_FIELDS:
+            others = StaffService.search_conditions(boss_id, filters=filters, exclude=field)[1:]
+            count = db.func.count()
+            counts.append((count.filter(db.and_(*others)) if others else count).label(f'count_{field}'))
+        return (
+            db.select(*columns, *(db.func.grouping(column).label(f'grouping_{field}')
+                                  for field, column in zip(FACET_FIELDS, columns)), *counts)
+            .where(*conditions)
+            .group_by(db.func.grouping_sets(*columns))
+        )
+
+    @staticmethod
+    def facet_counts(rows):
+        """Shape facet_statement rows as {field: [{'value', 'count'}, ...]}, most common first"""
+        facets = {field: [] for field in FACET_FIELDS}
+        for row in rows:
+            row = row._mapping
+            if 'facet' in row:
+                field, value, count = row['facet'], row['value'], row['count']
+            else:
+                # GROUPING(column) is 0 for the column this grouping set is keyed on
+                field = next(field for field in FACET_FIELDS if row[f'grouping_{field}'] == 0)
+                value, count = row[field], row[f'count_{field}']
+            if count:
+                facets[field].append({'value': value, 'count': count})
+        for values in facets.values():
+            values.sort(key=lambda entry: (-entry['count'], entry['value']))
+        return facets
+
+    @staticmethod
+    def staff_row(staff):
+        """Staff member in the search/export format (date of birth as YYYY-MM-DD or '')"""
+        return staff_schema.to_row(staff)
+
+    @staticmethod
+    def build_dashboard(staff_list):
+        """Dashboard statistics and recent staff from a list of staff dicts"""
+        stats = {
+            'total_staff': len(staff_list),
+            'employment_status_breakdown': {},
+            'immigration_status_breakdown': {},
+            'gender_breakdown': {}
+        }
+
+        for staff in staff_list:
+            # Employment status breakdown
+            emp_status = staff['employment_status']
+            stats['employment_status_breakdown'][emp_status] = stats['employment_status_breakdown'].get(emp_status, 0) + 1
+
+            # Immigration status breakdown
+            imm_status = staff['immigration_status']
+            stats['immigration_status_breakdown'][imm_status] = stats['immigration_status_breakdown'].get(imm_status, 0) + 1
+
+            # Gender breakdown
+            gender = staff['sex']
+            stats['gender_breakdown'][gender] = stats['gender_breakdown'].get(gender, 0) + 1
+
+        return {
+            'statistics': stats,
+            'recent_staff': staff_list[-5:]  # Last 5 added staff
+        }
+
+
+# How long after requesting an upload URL the upload can still be confirmed
+UPLOAD_CONFIRM_MAX_AGE = 3600
+
+# Batch ID uploads: proof_of_id_<staff_id> form fields, and archive entries
+# named <staff_id>.<ext> or <staff_id>_<anything>.<ext>
+BATCH_FIELD_PATTERN = re.compile(r'proof_of_id_(\d+)')
+ARCHIVE_ENTRY_PATTERN = re.compile(r'(\d+)(?:[_\-. ][^/]*)?\.[A-Za-z0-9]+$')
+
+# Display order for staff listings
+STAFF_ORDER = (Staff.firstname, Staff.lastname)
+
+# Staff fields that search can filter on and count (each has a (boss_id, field) index)
+FACET_FIELDS = ('employment_status', 'visa_type', 'immigration_status', 'sex')
+
+# Largest page /api/staff/search will return
+SEARCH_MAX_LIMIT = 1000
+
+# Column order and headers for CSV/NDJSON exports
+STAFF_EXPORT_FIELDS = staff_schema.OUTPUT_FIELDS
+
+# Staff writes are Core statements on the table, returning these columns in to_dict() order
+_staff = Staff.__table__
+STAFF_COLUMNS = tuple(_staff.c[name] for name in staff_schema.OUTPUT_FIELDS)
+
+NI_NUMBER_EXISTS = 'National Insurance Number already exists'
+# First key of the transaction advisory locks taken on National Insurance numbers
+NI_LOCK_CLASS = 4701
+
+
+class DuplicateNINumber(Exception):
+    """A staff write would reuse a National Insurance number"""
+
+
+def _is_ni_conflict(error):
+    """True if an IntegrityError is a unique violation on the National Insurance number"""
+    message = str(error.orig).lower()
+    return 'unique' in message and 'national_insurance_number' in message
+
+
+def _lock_ni_number(ni_number):
+    """Hold a transaction advisory lock on ``ni_number`` until commit (PostgreSQL).
+
+    With partitioned staff a NOT EXISTS guard keeps NI numbers unique across
+    bosses, but under READ COMMITTED two concurrent writes would both pass
+    it. Writers of the same number queue here instead, and the guard of the
+    second one sees the first one's committed row.
+    """
+    db.session.execute(db.select(db.func.pg_advisory_xact_lock(NI_LOCK_CLASS, db.func.hashtext(ni_number))))
 
 
 class FileService:
@@ -415,39 +688,291 @@ class FileService:
         if not file or file.filename == '':
             return {'error': 'No file selected'}, 400
 
-        # Verify staff exists and belongs to boss if boss_id provided
-        staff = Staff.query.get(staff_id)
+        # Verify staff exists and belongs to boss if boss_id provided; filtering
+        # on boss_id also lets a partitioned staff table prune to one partition
+        if boss_id:
+            staff = Staff.query.filter_by(id=staff_id, boss_id=boss_id).first()
+        else:
+            staff = Staff.query.filter_by(id=staff_id).first()
         if not staff:
             return {'error': 'Staff not found'}, 404
 
-        if boss_id and staff.boss_id != boss_id:
-            return {'error': 'Unauthorized access to staff record'}, 403
-
         if FileService.allowed_file(file.filename):
-            # Delete old file if it exists
-            if staff.proof_of_id and staff.proof_of_id != 'pending_upload':
-                old_file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], staff.proof_of_id)
-                if os.path.exists(old_file_path):
-                    os.remove(old_file_path)
+            # A fresh key, so the current document stays valid until the commit
+            old_filename = staff.proof_of_id
+            previous = staff.to_dict()
+            filename = FileService.new_document_key(staff_id, staff.firstname, file.filename)
+            try:
+                get_storage().save(filename, file, file.mimetype)
+                staff.proof_of_id = filename
+                staff.updated_at = datetime.utcnow()
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                FileService.discard_proof_of_id(filename)
+                return {'error': f'Failed to upload proof of ID: {str(e)}'}, 500
+
+            StaffService._notify('updated', staff.to_dict(), staff.boss_id, previous)
+            FileService.discard_proof_of_id(old_filename)
+            return {'message': 'Proof of ID uploaded successfully', 'filename': filename}, 200
 
-            # Create new filename
-            file_extension = file.filename.rsplit('.', 1)[1].lower()
-            filename = f"staff_{staff_id}_{staff.firstname.lower()}_id.{file_extension}"
-            upload_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+        return {'error': 'Invalid file type. Allowed: PDF, PNG, JPG, JPEG'}, 400
 
-            # Ensure upload directory exists
-            os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
+    @staticmethod
+    def store_proof_of_id(file, staff_id, firstname):
+        """Save an uploaded ID document through the storage backend and return its key"""
+        file_extension = file.filename.rsplit('.', 1)[1].lower()
+        filename = f"staff_{staff_id}_{firstname.lower()}_id.{file_extension}"
+        get_storage().save(filename, file, file.mimetype)
+        return filename
 
-            file.save(upload_path)
+    @staticmethod
+    def new_document_key(staff_id, firstname, filename):
+        """Storage key for a new ID document that never collides with the current one"""
+        file_extension = filename.rsplit('.', 1)[1].lower()
+        return f"staff_{staff_id}_{firstname.lower()}_id_{uuid.uuid4().hex[:8]}.{file_extension}"
 
-            # Update staff record
-            staff.proof_of_id = filename
-            staff.updated_at = datetime.utcnow()
-            db.session.commit()
+    @staticmethod
+    def _batch_sources(files, max_files, max_archive_bytes, max_file_bytes):
+        """Report entries and openers for the documents in a batch upload.
+
+        Returns (results, pending): one result dict per file, in request
+        order, and (result, staff_id, filename, open_file, content_type) for
+        the files that passed the name and type checks.
+        """
+        results, pending = [], []
+
+        def add(name, staff_id, open_file, content_type=None):
+            result = {'file': name, 'staff_id': staff_id}
+            results.append(result)
+            if len(results) > max_files:
+                result.update(status=400, error=f'At most {max_files} files per batch')
+            elif staff_id is None:
+                result.update(status=400, error='Cannot tell which staff member this file is for')
+            elif not FileService.allowed_file(name):
+                result.update(status=400, error='Invalid file type. Allowed: PDF, PNG, JPG, JPEG')
+            else:
+                pending.append((result, staff_id, name, open_file, content_type or mimetypes.guess_type(name)[0]))
+
+        for field, file in files.items(multi=True):
+            if field == 'archive':
+                FileService._batch_archive_sources(file, add, max_archive_bytes, max_file_bytes, results)
+                continue
+            match = BATCH_FIELD_PATTERN.fullmatch(field)
+            if not file or not file.filename:
+                continue
+            add(file.filename, int(match.group(1)) if match else None, lambda file=file: file, file.mimetype)
+        return results, pending
 
-            return {'message': 'Proof of ID uploaded successfully', 'filename': filename}, 200
+    @staticmethod
+    def _batch_archive_sources(file, add, max_archive_bytes, max_file_bytes, results):
+        try:
+            archive = zipfile.ZipFile(file.stream)
+            entries = [info for info in archive.infolist() if not info.is_dir()]
+        except zipfile.BadZipFile:
+            results.append({'file': file.filename, 'staff_id': None, 'status': 400, 'error': 'Not a zip archive'})
+            return
+
+        total = 0
+        for info in entries:
+            name = info.filename.rsplit('/', 1)[-1]
+            # Resource forks and hidden files that archivers add
+            if not name or name.startswith('.') or info.filename.startswith('__MACOSX/'):
+                continue
+            total += info.file_size
+            if info.file_size > max_file_bytes or total > max_archive_bytes:
+                results.append({'file': name, 'staff_id': None, 'status': 413, 'error': 'File too large'})
+                continue
+            match = ARCHIVE_ENTRY_PATTERN.match(name)
+            add(name, int(match.group(1)) if match else None, lambda info=info: archive.open(info))
 
-        return {'error': 'Invalid file type. Allowed: PDF, PNG, JPG, JPEG'}, 400
+    @staticmethod
+    def upload_proof_of_id_batch(boss_id, files, max_workers=8, max_files=500,
+                                 max_archive_bytes=256 * 1024 * 1024, max_file_bytes=16 * 1024 * 1024):
+        """Store many ID documents and repoint their staff in one transaction.
+
+        ``files`` are the request files: ``proof_of_id_<staff_id>`` fields
+        and/or zip ``archive`` fields with entries named ``<staff_id>.<ext>``
+        or ``<staff_id>_<anything>.<ext>``. Ownership is checked with one
+        query, documents are written to storage on a thread pool, and every
+        successful file's staff row is updated in a single commit.
+        """
+        results, pending = FileService._batch_sources(files, max_files, max_archive_bytes, max_file_bytes)
+        if not results:
+            return {'error': 'No files provided'}, 400
+
+        staff_ids = {staff_id for _, staff_id, _, _, _ in pending}
+        owned = {}
+        if staff_ids:
+            owned = {staff.id: staff for staff in Staff.query.filter(
+                Staff.boss_id == boss_id, Staff.id.in_(staff_ids))}
+
+        jobs, claimed = [], set()
+        for result, staff_id, name, open_file, content_type in pending:
+            staff = owned.get(staff_id)
+            if staff is None:
+                result.update(status=404, error='Staff not found')
+            elif staff_id in claimed:
+                result.update(status=409, error='Another file in this batch is for the same staff member')
+            else:
+                claimed.add(staff_id)
+                key = FileService.new_document_key(staff_id, staff.firstname, name)
+                jobs.append((result, staff, key, open_file, content_type))
+
+        storage = get_storage()
+
+        def store(job):
+            _, _, key, open_file, content_type = job
+            fileobj = open_file()
+            try:
+                storage.save(key, fileobj, content_type)
+            finally:
+                if isinstance(fileobj, zipfile.ZipExtFile):
+                    fileobj.close()
+
+        stored = []
+        if jobs:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+                futures = [(job, pool.submit(store, job)) for job in jobs]
+                for job, future in futures:
+                    try:
+                        future.result()
+                        stored.append(job)
+                    except Exception:
+                        logger.exception('Failed to store ID document', extra={'key': job[2]})
+                        job[0].update(status=500, error='Failed to store file')
+
+        replaced, changes = [], []
+        if stored:
+            now = datetime.utcnow()
+            for _, staff, key, _, _ in stored:
+                previous = staff.to_dict()
+                replaced.append(staff.proof_of_id)
+                staff.proof_of_id = key
+                staff.updated_at = now
+                changes.append((staff.to_dict(), previous))
+            try:
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                logger.exception('Batch ID upload commit failed', extra={'boss_id': boss_id})
+                for result, _, key, _, _ in stored:
+                    result.update(status=500, error='Failed to save staff records')
+                    storage.delete(key)
+                stored, replaced, changes = [], [], []
+
+        for result, _, key, _, _ in stored:
+            result.update(status=200, filename=key)
+        for staff, previous in changes:
+            StaffService._notify('updated', staff, boss_id, previous)
+
+        # The rows point at the new documents; a failure here leaves orphans for the upload sweeper
+        stale = [key for key in replaced if key and key not in ('pending_upload', 'temp')]
+        if stale:
+            def discard(key):
+                try:
+                    storage.delete(key)
+                except Exception:
+                    logger.warning('Failed to delete replaced ID document', extra={'key': key})
+
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(stale))) as pool:
+                list(pool.map(discard, stale))
+
+        uploaded = len(stored)
+        return {
+            'message': f'{uploaded} of {len(results)} files uploaded',
+            'uploaded': uploaded,
+            'failed': len(results) - uploaded,
+            'results': results,
+        }, 200
+
+    @staticmethod
+    def delete_proof_of_id(filename):
+        """Remove a stored ID document, ignoring placeholders"""
+        if filename and filename not in ('pending_upload', 'temp'):
+            get_storage().delete(filename)
+
+    @staticmethod
+    def discard_proof_of_id(filename):
+        """delete_proof_of_id that only logs failures; leftovers are found by the upload sweeper"""
+        try:
+            FileService.delete_proof_of_id(filename)
+        except Exception:
+            logger.warning('Failed to delete ID document', extra={'key': filename})
+
+    @staticmethod
+    def create_upload_url(staff_id, boss_id, filename):
+        """Presigned form upload for a new proof of ID, to be confirmed afterwards"""
+        staff = Staff.query.filter_by(id=staff_id, boss_id=boss_id).first()
+        if not staff:
+            return {'error': 'Staff not found'}, 404
+        if not filename or not FileService.allowed_file(filename):
+            return {'error': 'Invalid file type. Allowed: PDF, PNG, JPG, JPEG'}, 400
+
+        # A fresh key per upload: the current document stays in place until confirmed
+        key = FileService.new_document_key(staff_id, staff.firstname, filename)
+        content_type = mimetypes.guess_type(key)[0]
+        ttl = current_app.config['STORAGE_URL_TTL']
+
+        upload = get_storage().presigned_upload(key, content_type, current_app.config['MAX_CONTENT_LENGTH'], ttl)
+        upload_id = FileService._upload_serializer().dumps({'staff_id': staff_id, 'boss_id': boss_id, 'key': key})
+        return {
+            'upload': upload,
+            'content_type': content_type,
+            'upload_id': upload_id,
+            'expires_in': ttl
+        }, 200
+
+    @staticmethod
+    def confirm_upload(staff_id, boss_id, upload_id):
+        """Point the staff record at a document uploaded through a presigned URL"""
+        try:
+            upload = FileService._upload_serializer().loads(upload_id or '', max_age=UPLOAD_CONFIRM_MAX_AGE)
+        except BadSignature:
+            return {'error': 'Invalid or expired upload'}, 400
+        if upload['staff_id'] != staff_id or upload['boss_id'] != boss_id:
+            return {'error': 'Invalid or expired upload'}, 400
+
+        staff = Staff.query.filter_by(id=staff_id, boss_id=boss_id).first()
+        if not staff:
+            return {'error': 'Staff not found'}, 404
+
+        key = upload['key']
+        if staff.proof_of_id == key:
+            return {'message': 'Proof of ID uploaded successfully', 'filename': key}, 200
+        if not get_storage().exists(key):
+            return {'error': 'File has not been uploaded yet'}, 400
+
+        old_filename = staff.proof_of_id
+        previous = staff.to_dict()
+        staff.proof_of_id = key
+        staff.updated_at = datetime.utcnow()
+        db.session.commit()
+        StaffService._notify('updated', staff.to_dict(), boss_id, previous)
+        FileService.delete_proof_of_id(old_filename)
+
+        return {'message': 'Proof of ID uploaded successfully', 'filename': key}, 200
+
+    @staticmethod
+    def get_download_url(staff_id, boss_id):
+        """Short-lived URL the client can fetch the proof of ID from directly"""
+        staff = Staff.query.filter_by(id=staff_id, boss_id=boss_id).first()
+        if not staff or not staff.proof_of_id or staff.proof_of_id == 'pending_upload':
+            return {'error': 'File not found'}, 404
+
+        storage = get_storage()
+        if not storage.direct and not storage.exists(staff.proof_of_id):
+            return {'error': 'File not found on server'}, 404
+
+        ttl = current_app.config['STORAGE_URL_TTL']
+        return {
+            'url': storage.presigned_download_url(staff.proof_of_id, staff.proof_of_id, ttl),
+            'expires_in': ttl
+        }, 200
+
+    @staticmethod
+    def _upload_serializer():
+        return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='proof-of-id-upload')
 
     @staticmethod
     def allowed_file(filename):
@@ -455,30 +980,54 @@ class FileService:
         ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
         return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+    @staticmethod
+    def generate_staff_csv(rows, rows_per_chunk=500):
+        """Yield CSV text chunks, starting with the header row straight away"""
+        buffer = StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=STAFF_EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+        pending = 0
+        for row in rows:
+            writer.writerow(row)
+            pending += 1
+            if pending >= rows_per_chunk:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+
+        if pending:
+            yield buffer.getvalue()
+
+    @staticmethod
+    def generate_staff_ndjson(rows, rows_per_chunk=500):
+        """Yield newline-delimited JSON chunks, one object per staff member, the first straight away"""
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return
+        # NDJSON has no header, so the first object goes out on its own as soon as the cursor has it
+        yield json.dumps(first, separators=(',', ':')) + '\n'
+
+        chunk = []
+        for row in rows:
+            chunk.append(json.dumps(row, separators=(',', ':')))
+            if len(chunk) >= rows_per_chunk:
+                yield '\n'.join(chunk) + '\n'
+                chunk = []
+
+        if chunk:
+            yield '\n'.join(chunk) + '\n'
+
     @staticmethod
     def create_staff_excel(staff_list):
         """Create Excel file from staff data"""
         try:
-            # Prepare data for Excel
-            excel_data = []
-            for staff in staff_list:
-                excel_data.append({
-                    'First Name': staff.get('firstname', ''),
-                    'Last Name': staff.get('lastname', ''),
-                    'National Insurance Number': staff.get('national_insurance_number', ''),
-                    'Home Address': staff.get('home_address', ''),
-                    'Telephone Number': staff.get('telephone_number', ''),
-                    'Employment Status': staff.get('employment_status', ''),
-                    'Immigration Status': staff.get('immigration_status', ''),
-                    'Visa Type': staff.get('visa_type', ''),
-                    'Visa Sharecode': staff.get('visa_sharecode', ''),
-                    'Sex': staff.get('sex', ''),
-                    'Date of Birth': staff.get('date_of_birth', ''),
-                    'Proof of ID': staff.get('proof_of_id', '')
-                })
-
-            # Create DataFrame
-            df = pd.DataFrame(excel_data)
+            df = pd.DataFrame(staff_schema.excel_records(staff_list), columns=staff_schema.EXCEL_HEADERS)
 
             # Create Excel file in memory
             output = BytesIO()
@@ -503,10 +1052,126 @@ class FileService:
             return output
 
         except Exception as e:
-            print(f"Excel creation error: {e}")
+            logger.exception('Excel creation error')
             raise e
 
 
+# Age bands as (label, lower bound inclusive); the last band is open-ended
+AGE_BANDS = [('Under 25', 0), ('25-34', 25), ('35-44', 35), ('45-54', 45), ('55-64', 55), ('65+', 65)]
+
+_analytics_cache = LRUCache(maxsize=512)
+
+
+class AnalyticsService:
+    @staticmethod
+    def get_workforce_analytics(boss_id):
+        """Age bands, monthly hiring trend and visa x employment cross-tab for a boss.
+
+        Results are cached per boss data version and day, so repeat calls on
+        an unchanged roster cost a single fingerprint query. Ages are computed
+        as of the same ``today`` that keys the cache.
+        """
+        today = date.today()
+        data_version = StaffService.get_data_version(boss_id)
+        cache_key = (boss_id, data_version, today)
+        cached = _analytics_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        if db.engine.dialect.name == 'postgresql':
+            analytics = AnalyticsService._compute_sql(boss_id, *AnalyticsService._postgres_expressions(today))
+        else:
+            analytics = AnalyticsService._compute_pandas(boss_id, today)
+
+        analytics['data_version'] = data_version
+        _analytics_cache.set(cache_key, analytics)
+        return analytics
+
+    @staticmethod
+    def _empty_result():
+        return {
+            'total_staff': 0,
+            'average_age': None,
+            'age_bands': {label: 0 for label, _ in AGE_BANDS},
+            'hiring_trend': [],
+            'visa_employment_crosstab': {},
+        }
+
+    @staticmethod
+    def _postgres_expressions(today):
+        """(age in completed years on ``today``, hiring month) via age() and date_trunc"""
+        age = db.func.date_part('year', db.func.age(db.literal(today, db.Date), Staff.date_of_birth))
+        return age, db.func.date_trunc('month', Staff.created_at)
+
+    @staticmethod
+    def _compute_sql(boss_id, age, month):
+        """Aggregate in the database with CASE bucketing over the given age and month expressions"""
+        result = AnalyticsService._empty_result()
+
+        band_expr = db.case(
+            *[(age >= lower, label) for label, lower in reversed(AGE_BANDS[1:])],
+            else_=AGE_BANDS[0][0]
+        ).label('band')
+        total_age = 0
+        for band, count, age_sum in db.session.query(band_expr, db.func.count(), db.func.sum(age)).filter(
+            Staff.boss_id == boss_id
+        ).group_by(band_expr):
+            result['age_bands'][band] = count
+            result['total_staff'] += count
+            total_age += age_sum or 0
+        if result['total_staff']:
+            result['average_age'] = round(float(total_age) / result['total_staff'], 1)
+
+        month = month.label('month')
+        for month_start, count in db.session.query(month, db.func.count()).filter(
+            Staff.boss_id == boss_id
+        ).group_by(month).order_by(month):
+            if month_start is not None:
+                result['hiring_trend'].append({'month': month_start.strftime('%Y-%m'), 'count': count})
+
+        for visa_type, employment_status, count in db.session.query(
+            Staff.visa_type, Staff.employment_status, db.func.count()
+        ).filter(Staff.boss_id == boss_id).group_by(Staff.visa_type, Staff.employment_status):
+            result['visa_employment_crosstab'].setdefault(visa_type, {})[employment_status] = count
+
+        return result
+
+    @staticmethod
+    def _compute_pandas(boss_id, today):
+        """Vectorised path for SQLite and other databases without date_trunc/age, over a column-projected frame"""
+        rows = db.session.query(
+            Staff.date_of_birth, Staff.created_at, Staff.visa_type, Staff.employment_status
+        ).filter(Staff.boss_id == boss_id).all()
+        result = AnalyticsService._empty_result()
+        if not rows:
+            return result
+
+        df = pd.DataFrame(rows, columns=['date_of_birth', 'created_at', 'visa_type', 'employment_status'])
+        result['total_staff'] = len(df)
+
+        # Completed years, matching Postgres age()
+        dob = pd.to_datetime(df['date_of_birth'])
+        today = pd.Timestamp(today)
+        before_birthday = (dob.dt.month > today.month) | ((dob.dt.month == today.month) & (dob.dt.day > today.day))
+        ages = today.year - dob.dt.year - before_birthday.astype(int)
+        result['average_age'] = round(float(ages.mean()), 1)
+
+        edges = [lower for _, lower in AGE_BANDS] + [float('inf')]
+        labels = [label for label, _ in AGE_BANDS]
+        bands = pd.cut(ages, bins=edges, labels=labels, right=False).value_counts()
+        result['age_bands'] = {label: int(bands.get(label, 0)) for label in labels}
+
+        months = pd.to_datetime(df['created_at']).dropna().dt.to_period('M').value_counts().sort_index()
+        result['hiring_trend'] = [{'month': str(period), 'count': int(count)} for period, count in months.items()]
+
+        crosstab = pd.crosstab(df['visa_type'], df['employment_status'])
+        result['visa_employment_crosstab'] = {
+            visa_type: {status: int(count) for status, count in counts.items() if count}
+            for visa_type, counts in crosstab.iterrows()
+        }
+        return result
+
+
 class ValidationService:
     @staticmethod
     def validate_email(email):
@@ -578,40 +1243,16 @@ class ValidationService:
     @staticmethod
     def validate_staff_data(data):
         """Validate staff input data"""
-        required_fields = [
-            'firstname', 'lastname', 'national_insurance_number',
-            'home_address', 'telephone_number', 'employment_status',
-            'immigration_status','visa_type', 'visa_sharecode', 'sex', 'date_of_birth'
-        ]
-
-        errors = []
-        for field in required_fields:
-            if field not in data or not data[field]:
-                errors.append(f'{field} is required')
-
-
-        # Validate specific fields
-        if 'sex' in data and data['sex'] not in ['Male', 'Female', 'Other']:
-            errors.append('Invalid sex value')
-
-        if 'employment_status' in data and data['employment_status'] not in ['Full-time', 'Part-time', 'Contract',
-                                                                             'Intern']:
-            errors.append('Invalid employment status')
-
-        return errors if errors else None
+        return staff_schema.validate(data)
 
 
 class EmailService:
     @staticmethod
-    def send_password_reset_email(boss):
+    def send_password_reset_email(boss, code):
         """Send 6-digit password reset code via email"""
-        code = boss.generate_reset_token()
-
-        # Print code to console for testing
-        print(f"\n=== PASSWORD RESET CODE ===")
-        print(f"Email: {boss.email}")
-        print(f"6-Digit Code: {code}")
-        print(f"============================\n")
+        # Log code for local testing; DEBUG is off in production
+        logger.debug('Password reset code generated', extra={'email': boss.email, 'code': code, 'sample_rate': 1.0})
+        minutes = current_app.config['RESET_TOKEN_TTL_MINUTES']
 
         msg = Message(
             'Password Reset Code',
@@ -623,7 +1264,7 @@ class EmailService:
             <p><strong>Your 6-digit password reset code is:</strong></p>
             <h2 style="background-color: #f0f0f0; padding: 15px; text-align: center; font-family: monospace; letter-spacing: 3px;">{code}</h2>
             <p>Enter this code to reset your password.</p>
-            <p><strong>This code will expire in 15 minutes.</strong></p>
+            <p><strong>This code will expire in {minutes} minutes.</strong></p>
             <p>If you didn't request this, please ignore this email.</p>
             <br>
             <p>Best regards,<br>Staff Management System</p>
@@ -638,7 +1279,7 @@ class EmailService:
             Your 6-digit password reset code is: {code}
 
             Enter this code to reset your password.
-            This code will expire in 15 minutes.
+            This code will expire in {minutes} minutes.
 
             If you didn't request this, please ignore this email.
 
@@ -649,8 +1290,8 @@ class EmailService:
 
         try:
             mail.send(msg)
-            print("Email sent successfully!")
+            logger.info('Password reset email sent', extra={'email': boss.email})
             return True
         except Exception as e:
-            print(f"Email failed, but code printed above: {e}")
+            logger.warning('Password reset email failed: %s', e)
             return False
@@ -0,0 +1,17 @@
+"""Application signals.
+
+``staff_changed`` is sent by StaffService after a staff write is committed,
+with ``boss_id``, ``action`` ('added', 'updated' or 'deleted'), ``staff``
+(the staff member's ``to_dict()``, captured before a delete) and
+``previous`` (the ``to_dict()`` before an update, otherwise None). Receivers
+run synchronously in the request, so they must be cheap.
+
+``document_changed`` is sent by the local storage backend after it writes
+or removes a file, with ``action`` ('saved' or 'deleted') and ``key``.
+"""
+from blinker import Namespace
+
+_signals = Namespace()
+
+staff_changed = _signals.signal('staff-changed')
+document_changed = _signals.signal('document-changed')
@@ -0,0 +1,303 @@
+"""Single-flight coalescing of identical expensive reads.
+
+When a company's managers all open the dashboard at shift start, or an
+export button is double-clicked, the same boss sends several identical
+requests at once and each would run the full query and serialization.
+Views marked ``@single_flight()`` share one run instead: the first request
+(the leader) runs the view and every identical request that arrives while
+it is running waits and gets a copy of its response.
+
+Requests are identical when method, route, URL parameters, query string,
+boss and the boss's staff data version (``StaffService.get_data_version``)
+all match, so a request that arrives after a committed write never gets a
+response computed before it. Requests with conditional or range headers
+are not coalesced, since their responses depend on those headers.
+
+Within a worker, waiting requests block on the leader's thread. With
+SINGLEFLIGHT_DIR set, the gunicorn workers on a host coalesce too: the
+leader holds an flock on a per-key lock file and leaves its response in a
+result file for SINGLEFLIGHT_RESULT_TTL seconds, and a worker that finds
+the lock taken waits for it and serves that file. Stale files are removed
+in the background.
+
+A leader that raises does not share anything: the waiting requests run the
+view themselves, as do requests that wait longer than
+SINGLEFLIGHT_WAIT_SECONDS. Each response carries ``X-Single-Flight`` with
+its outcome, which is also counted in ``singleflight_requests_total`` on
+/metrics:
+
+* ``leader``: ran the view
+* ``shared``: got the response of a leader in this worker
+* ``shared_worker``: got the response a leader in another worker stored
+* ``fallback``: ran the view after the leader failed or took too long
+
+Usage, below ``@jwt_required()``::
+
+    @main.route('/api/dashboard', methods=['GET'])
+    @jwt_required()
+    @single_flight()
+    def dashboard():
+        ...
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from functools import wraps
+
+from flask import Response, current_app, request
+from flask_jwt_extended import get_jwt_identity
+
+from .metrics import registry
+from .services import StaffService
+
+try:
+    import fcntl
+except ImportError:  # Windows: coalescing stays within each worker
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Single-Flight'
+# Responses to these depend on more than the key
+CONDITIONAL_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since')
+# Recomputed for every copy
+SKIPPED_HEADERS = frozenset(('content-length', 'set-cookie'))
+
+
+class FrozenResponse:
+    """Status, headers and body of a finished response, to build copies from"""
+
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @classmethod
+    def of(cls, response):
+        """Capture ``response``, or None for a stream that can only be sent once"""
+        if response.is_streamed and not response.direct_passthrough:
+            return None
+        # send_file responses hand the file straight to the server; read it here instead
+        response.direct_passthrough = False
+        headers = [(name, value) for name, value in response.headers.items()
+                   if name.lower() not in SKIPPED_HEADERS]
+        return cls(response.status_code, headers, response.get_data())
+
+    def response(self):
+        return Response(self.body, status=self.status, headers=self.headers)
+
+    def dumps(self):
+        head = json.dumps({'status': self.status, 'headers': self.headers}, separators=(',', ':'))
+        return head.encode() + b'\n' + self.body
+
+    @classmethod
+    def loads(cls, data):
+        head, _, body = data.partition(b'\n')
+        head = json.loads(head)
+        return cls(head['status'], [tuple(header) for header in head['headers']], body)
+
+
+class _Flight:
+    __slots__ = ('done', 'frozen')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.frozen = None
+
+
+class SingleFlight:
+    """Runs one request per key at a time and hands its response to identical ones"""
+
+    def __init__(self, wait=30, directory=None, result_ttl=5, max_stored_bytes=32 * 1024 * 1024,
+                 purge_interval=300):
+        self.wait = wait
+        self.directory = directory if fcntl is not None else None
+        self.result_ttl = result_ttl
+        self.max_stored_bytes = max_stored_bytes
+        self.purge_interval = purge_interval
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._next_purge = time.monotonic() + purge_interval
+        if directory and fcntl is None:
+            logger.warning('SINGLEFLIGHT_DIR needs fcntl; coalescing within each worker only')
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def do(self, key, run):
+        """Response for ``key``: from ``run()`` or a copy of a concurrent leader's; returns (response, outcome)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            if flight.done.wait(self.wait) and flight.frozen is not None:
+                return flight.frozen.response(), 'shared'
+            return run(), 'fallback'
+
+        try:
+            response, flight.frozen, outcome = self._lead(key, run)
+            return response, outcome
+        finally:
+            # New arrivals start their own flight once this one is over
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _lead(self, key, run):
+        if not self.directory:
+            response = run()
+            return response, FrozenResponse.of(response), 'leader'
+
+        lock_path = os.path.join(self.directory, f'{key}.lock')
+        result_path = os.path.join(self.directory, f'{key}.result')
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not self._acquire(fd):
+                response = run()
+                return response, FrozenResponse.of(response), 'fallback'
+            try:
+                # Keeps the purge away from lock files in use
+                os.utime(fd)
+                frozen = self._load(result_path)
+                if frozen is not None:
+                    return frozen.response(), frozen, 'shared_worker'
+                response = run()
+                frozen = FrozenResponse.of(response)
+                if frozen is not None and frozen.status < 500 and len(frozen.body) <= self.max_stored_bytes:
+                    self._store(result_path, frozen)
+                return response, frozen, 'leader'
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _acquire(self, fd):
+        """flock ``fd``, waiting up to ``wait`` seconds; returns False on timeout"""
+        deadline = time.monotonic() + self.wait
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+
+    def _load(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > self.result_ttl:
+                return None
+            with open(path, 'rb') as fh:
+                return FrozenResponse.loads(fh.read())
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _store(self, path, frozen):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as fh:
+                fh.write(frozen.dumps())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('Failed to store single-flight result %s: %s', path, e)
+
+    def purge(self):
+        """Delete result and lock files no request can still be using; returns the count"""
+        if not self.directory:
+            return 0
+        # A lock file removed while a request waits on it only costs that request its coalescing
+        cutoff = time.time() - max(self.result_ttl, self.wait) * 2
+        removed = 0
+        for entry in os.listdir(self.directory):
+            path = os.path.join(self.directory, entry)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def maybe_purge(self):
+        """Start a background purge when the interval has elapsed"""
+        if not self.directory or time.monotonic() < self._next_purge:
+            return
+        self._next_purge = time.monotonic() + self.purge_interval
+        threading.Thread(target=self._background_purge, name='singleflight-purge', daemon=True).start()
+
+    def _background_purge(self):
+        try:
+            self.purge()
+        except Exception:
+            logger.exception('Single-flight purge failed')
+
+
+def get_single_flight():
+    return current_app.extensions['single_flight']
+
+
+def request_key(boss_id):
+    """Hash of everything that makes two requests for ``boss_id`` interchangeable"""
+    raw = json.dumps([
+        request.method,
+        request.url_rule.rule,
+        request.view_args,
+        sorted(request.args.items(multi=True)),
+        boss_id,
+        StaffService.get_data_version(boss_id),
+    ], default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+def single_flight(when=None):
+    """Share one run of the view among concurrent identical requests.
+
+    ``when``, if given, is called in the request context and the request is
+    only coalesced when it returns true (e.g. only for formats that are not
+    streamed).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            flights = get_single_flight()
+            if (not current_app.config['SINGLEFLIGHT_ENABLED']
+                    or any(name in request.headers for name in CONDITIONAL_HEADERS)
+                    or (when is not None and not when())):
+                return view(*args, **kwargs)
+
+            key = request_key(int(get_jwt_identity()))
+            response, outcome = flights.do(key, lambda: current_app.make_response(view(*args, **kwargs)))
+            response.headers[HEADER] = outcome
+            registry.inc('singleflight_requests_total', (request.url_rule.rule, outcome))
+            flights.maybe_purge()
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def init_app(app):
+    app.config.setdefault('SINGLEFLIGHT_ENABLED',
+                          os.environ.get('SINGLEFLIGHT_ENABLED', '1').lower() in ('1', 'true', 'yes'))
+    app.config.setdefault('SINGLEFLIGHT_WAIT_SECONDS', float(os.environ.get('SINGLEFLIGHT_WAIT_SECONDS', 30)))
+    app.config.setdefault('SINGLEFLIGHT_DIR', os.environ.get('SINGLEFLIGHT_DIR'))
+    app.config.setdefault('SINGLEFLIGHT_RESULT_TTL', float(os.environ.get('SINGLEFLIGHT_RESULT_TTL', 5)))
+    app.config.setdefault('SINGLEFLIGHT_MAX_STORED_BYTES',
+                          int(os.environ.get('SINGLEFLIGHT_MAX_STORED_BYTES', 32 * 1024 * 1024)))
+
+    app.extensions['single_flight'] = SingleFlight(
+        wait=app.config['SINGLEFLIGHT_WAIT_SECONDS'],
+        directory=app.config['SINGLEFLIGHT_DIR'],
+        result_ttl=app.config['SINGLEFLIGHT_RESULT_TTL'],
+        max_stored_bytes=app.config['SINGLEFLIGHT_MAX_STORED_BYTES'],
+    )
@@ -0,0 +1,151 @@
+"""The staff fields exposed by the API, declared once.
+
+The field lists, validation, coercion and serialization that routes,
+services and exports use all loop over ``FIELDS``, so adding a field or
+changing a rule happens here only. Nothing in this module touches
+the database.
+"""
+from datetime import date
+from operator import attrgetter
+
+EMPLOYMENT_STATUSES = ('Full-time', 'Part-time', 'Contract', 'Intern')
+SEXES = ('Male', 'Female', 'Other')
+
+DATE_FORMAT_ERROR = 'Invalid date format. Use YYYY-MM-DD'
+
+
+class SchemaError(ValueError):
+    """Raised when a submitted value cannot be coerced"""
+
+
+def strip(value):
+    return value.strip() if isinstance(value, str) else value
+
+
+def upper(value):
+    return value.strip().upper() if isinstance(value, str) else value
+
+
+def parse_date(value):
+    """YYYY-MM-DD to a date; stricter than date.fromisoformat, which also takes week dates"""
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str) and len(value) == 10 and value[4] == '-' and value[7] == '-':
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            pass
+    raise SchemaError(DATE_FORMAT_ERROR)
+
+
+class Field:
+    """One staff attribute: its column, export header and input rules"""
+
+    __slots__ = ('name', 'label', 'input', 'coerce', 'choices', 'error')
+
+    def __init__(self, name, label, input=True, coerce=None, choices=None, error=None):
+        self.name = name
+        self.label = label
+        # False for fields the server assigns (id, stored file name)
+        self.input = input
+        self.coerce = coerce
+        self.choices = frozenset(choices) if choices else None
+        self.error = error
+
+
+# Serialization order of to_dict, search results and exports
+FIELDS = (
+    Field('id', 'ID', input=False),
+    Field('firstname', 'First Name', coerce=strip),
+    Field('lastname', 'Last Name', coerce=strip),
+    Field('national_insurance_number', 'National Insurance Number', coerce=upper),
+    Field('home_address', 'Home Address', coerce=strip),
+    Field('telephone_number', 'Telephone Number', coerce=strip),
+    Field('employment_status', 'Employment Status', choices=EMPLOYMENT_STATUSES, error='Invalid employment status'),
+    Field('immigration_status', 'Immigration Status', coerce=strip),
+    Field('visa_type', 'Visa Type', coerce=strip),
+    Field('visa_sharecode', 'Visa Sharecode', coerce=strip),
+    Field('sex', 'Sex', choices=SEXES, error='Invalid sex value'),
+    Field('date_of_birth', 'Date of Birth', coerce=parse_date),
+    Field('proof_of_id', 'Proof of ID', input=False),
+)
+
+# Views of FIELDS
+
+OUTPUT_FIELDS = tuple(field.name for field in FIELDS)
+INPUT_FIELDS = tuple(field.name for field in FIELDS if field.input)
+# The spreadsheet export leaves out the database id
+EXCEL_FIELDS = OUTPUT_FIELDS[1:]
+EXCEL_HEADERS = tuple(field.label for field in FIELDS[1:])
+
+_COERCERS = tuple((field.name, field.coerce) for field in FIELDS if field.input)
+_CHOICES = tuple((field.name, field.choices, field.error) for field in FIELDS if field.choices)
+# Staff instance -> tuple of its values in OUTPUT_FIELDS order
+_output_values = attrgetter(*OUTPUT_FIELDS)
+
+
+def validate(data):
+    """Error messages for a new staff submission, or None when it is complete and valid"""
+    errors = []
+    for name in INPUT_FIELDS:
+        if not data.get(name):
+            errors.append(f'{name} is required')
+    for name, choices, error in _CHOICES:
+        if name in data and data[name] not in choices:
+            errors.append(error)
+    return errors or None
+
+
+def from_values(values, missing_date=None):
+    """Serialize a tuple of column values in OUTPUT_FIELDS order"""
+    row = dict(zip(OUTPUT_FIELDS, values))
+    # date_of_birth is the only field that needs converting
+    dob = row['date_of_birth']
+    row['date_of_birth'] = dob.isoformat() if dob else missing_date
+    return row
+
+
+def to_dict(staff):
+    """API representation of a Staff instance"""
+    return from_values(_output_values(staff))
+
+
+def to_row(staff):
+    """Search/export representation: as to_dict, but a missing date of birth is ''"""
+    return from_values(_output_values(staff), '')
+
+
+def coerce(data):
+    """Column values for a new staff member from validated input; raises SchemaError"""
+    values = {}
+    for name, convert in _COERCERS:
+        value = data.get(name)
+        values[name] = convert(value) if convert else value
+    return values
+
+
+def coerce_update(data, skip_empty=False):
+    """Column values for the input fields present in ``data``; raises SchemaError.
+
+    Unknown keys and server-assigned fields are ignored. Empty values are
+    dropped with ``skip_empty`` (form posts send every field) and rejected
+    otherwise, since every staff column is required.
+    """
+    values = {}
+    for name, convert in _COERCERS:
+        if name not in data:
+            continue
+        value = data[name]
+        if value and convert:
+            value = convert(value)
+        if not value:
+            if skip_empty:
+                continue
+            raise SchemaError(f'{name} is required')
+        values[name] = value
+    return values
+
+
+def excel_records(rows):
+    """Value lists in EXCEL_FIELDS order from serialized staff dicts"""
+    return [[row.get(name, '') for name in EXCEL_FIELDS] for row in rows]
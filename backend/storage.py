@@ -0,0 +1,221 @@
+"""Storage backends for uploaded ID documents.
+
+``STORAGE_BACKEND`` selects where document bodies live:
+
+* ``local`` (default): files under ``UPLOAD_FOLDER``. Presigned URLs point
+  at this app's ``/api/storage/...`` routes and carry an itsdangerous
+  signature instead of a JWT.
+* ``s3``: any S3-compatible object store (AWS S3, MinIO, Cloudflare R2...).
+  Presigned URLs go straight to the store, so clients transfer document
+  bytes without passing through a worker. Set ``S3_ENDPOINT_URL`` to point
+  at a local stand-in such as MinIO for development.
+
+Both backends address objects by key, which is the filename stored in
+``Staff.proof_of_id``.
+"""
+import os
+import shutil
+import mimetypes
+import threading
+
+from flask import current_app, url_for
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from werkzeug.http import dump_options_header
+
+from .signals import document_changed
+
+
+class StorageError(Exception):
+    """Raised when a storage operation fails"""
+
+
+class InvalidStorageToken(StorageError):
+    """Raised for a tampered or expired presigned local URL"""
+
+
+def _content_type(key):
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+class LocalStorage:
+    """Files on local disk under the app's UPLOAD_FOLDER"""
+
+    # Downloads are served by this app, so there is nothing to redirect to
+    direct = False
+
+    def __init__(self, app):
+        self.app = app
+
+    @property
+    def root(self):
+        # Read on every call: run.py and tests change UPLOAD_FOLDER after create_app
+        return self.app.config['UPLOAD_FOLDER']
+
+    def _serializer(self, purpose):
+        return URLSafeTimedSerializer(self.app.config['SECRET_KEY'], salt=f'storage-{purpose}')
+
+    def local_path(self, key):
+        return os.path.join(self.root, os.path.basename(key))
+
+    def save(self, key, fileobj, content_type=None):
+        os.makedirs(self.root, exist_ok=True)
+        if hasattr(fileobj, 'save'):
+            fileobj.save(self.local_path(key))
+        else:
+            with open(self.local_path(key), 'wb') as fh:
+                shutil.copyfileobj(fileobj, fh)
+        document_changed.send(self.app, action='saved', key=os.path.basename(key))
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.local_path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+        document_changed.send(self.app, action='deleted', key=os.path.basename(key))
+
+    def presigned_download_url(self, key, filename=None, expires_in=None):
+        token = self._serializer('download').dumps({'key': key, 'filename': filename or key})
+        return url_for('main.storage_download', token=token, _external=True)
+
+    def presigned_upload(self, key, content_type, max_bytes, expires_in=None):
+        """Form POST target for a direct upload; the file goes in a ``file`` field after ``fields``"""
+        token = self._serializer('upload').dumps({'key': key, 'content_type': content_type, 'max_bytes': max_bytes})
+        return {'url': url_for('main.storage_upload', token=token, _external=True), 'method': 'POST', 'fields': {}}
+
+    def load_token(self, purpose, token, max_age):
+        try:
+            return self._serializer(purpose).loads(token, max_age=max_age)
+        except SignatureExpired:
+            raise InvalidStorageToken('Link has expired')
+        except BadSignature:
+            raise InvalidStorageToken('Invalid link')
+
+
+class S3Storage:
+    """Objects in an S3-compatible bucket, accessed through boto3"""
+
+    direct = True
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None,
+                 access_key_id=None, secret_access_key=None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self._client_options = {
+            'endpoint_url': endpoint_url or None,
+            'region_name': region or None,
+            'aws_access_key_id': access_key_id or None,
+            'aws_secret_access_key': secret_access_key or None,
+        }
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            # Creating clients is not thread-safe in boto3, and the ID batch upload uses a thread pool
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    def _create_client(self):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError as e:
+            raise StorageError('STORAGE_BACKEND=s3 needs the boto3 package: pip install boto3') from e
+        # Path-style addressing works with MinIO and other local stand-ins
+        config = Config(signature_version='s3v4', s3={'addressing_style': 'path'})
+        # A session of our own rather than boto3's shared default session
+        return boto3.session.Session().client('s3', config=config, **self._client_options)
+
+    def object_key(self, key):
+        return f'{self.prefix}{key}'
+
+    def save(self, key, fileobj, content_type=None):
+        stream = getattr(fileobj, 'stream', fileobj)
+        self.client.upload_fileobj(stream, self.bucket, self.object_key(key),
+                                   ExtraArgs={'ContentType': content_type or _content_type(key)})
+
+    def _head(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def size(self, key):
+        head = self._head(key)
+        if head is None:
+            raise FileNotFoundError(key)
+        return head['ContentLength']
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def presigned_download_url(self, key, filename=None, expires_in=300):
+        return self.client.generate_presigned_url('get_object', ExpiresIn=expires_in, Params={
+            'Bucket': self.bucket,
+            'Key': self.object_key(key),
+            'ResponseContentDisposition': dump_options_header('attachment', {'filename': filename or key}),
+        })
+
+    def presigned_upload(self, key, content_type, max_bytes, expires_in=300):
+        """Presigned POST; the policy pins the key, content type and maximum size"""
+        post = self.client.generate_presigned_post(
+            Bucket=self.bucket,
+            Key=self.object_key(key),
+            Fields={'Content-Type': content_type},
+            Conditions=[{'Content-Type': content_type}, ['content-length-range', 1, max_bytes]],
+            ExpiresIn=expires_in,
+        )
+        return {'url': post['url'], 'method': 'POST', 'fields': post['fields']}
+
+
+def get_storage():
+    """Storage backend of the current app"""
+    return current_app.extensions['storage']
+
+
+def init_app(app):
+    app.config.setdefault('STORAGE_BACKEND', os.environ.get('STORAGE_BACKEND', 'local'))
+    app.config.setdefault('STORAGE_URL_TTL', int(os.environ.get('STORAGE_URL_TTL', 300)))
+    app.config.setdefault('S3_BUCKET', os.environ.get('S3_BUCKET'))
+    app.config.setdefault('S3_PREFIX', os.environ.get('S3_PREFIX', ''))
+    app.config.setdefault('S3_ENDPOINT_URL', os.environ.get('S3_ENDPOINT_URL'))
+    app.config.setdefault('S3_REGION', os.environ.get('S3_REGION'))
+    app.config.setdefault('S3_ACCESS_KEY_ID', os.environ.get('S3_ACCESS_KEY_ID'))
+    app.config.setdefault('S3_SECRET_ACCESS_KEY', os.environ.get('S3_SECRET_ACCESS_KEY'))
+    # POST /api/staff/upload-ids
+    app.config.setdefault('ID_BATCH_WORKERS', int(os.environ.get('ID_BATCH_WORKERS', 8)))
+    app.config.setdefault('ID_BATCH_MAX_FILES', int(os.environ.get('ID_BATCH_MAX_FILES', 500)))
+    app.config.setdefault('ID_BATCH_MAX_ARCHIVE_BYTES',
+                          int(os.environ.get('ID_BATCH_MAX_ARCHIVE_BYTES', 256 * 1024 * 1024)))
+
+    backend = app.config['STORAGE_BACKEND']
+    if backend == 'local':
+        app.extensions['storage'] = LocalStorage(app)
+    elif backend == 's3':
+        if not app.config['S3_BUCKET']:
+            raise RuntimeError('STORAGE_BACKEND=s3 requires S3_BUCKET')
+        app.extensions['storage'] = S3Storage(
+            app.config['S3_BUCKET'],
+            prefix=app.config['S3_PREFIX'],
+            endpoint_url=app.config['S3_ENDPOINT_URL'],
+            region=app.config['S3_REGION'],
+            access_key_id=app.config['S3_ACCESS_KEY_ID'],
+            secret_access_key=app.config['S3_SECRET_ACCESS_KEY'],
+        )
+    else:
+        raise RuntimeError(f'Unknown STORAGE_BACKEND {backend!r}; use local or s3')
@@ -0,0 +1,190 @@
+"""Typeahead suggestions served from a per-boss in-memory prefix index.
+
+Each boss's index is a sorted list of ``(token, staff_id)`` pairs, where the
+tokens are every word-suffix of the lower-cased full name ("mary ann smith",
+"ann smith", "smith"). A prefix lookup is one bisect plus a short forward
+scan, independent of tenant size.
+
+Indexes are built on first use from (id, firstname, lastname) only, patched
+in place on ``staff_changed`` from this process, and revalidated against
+``StaffService.get_data_version`` every SUGGEST_REVALIDATE_SECONDS so writes
+made by other workers are picked up. A patch also takes the post-write
+version, so a worker's own writes don't trigger a rebuild. Least recently used indexes are evicted
+once their estimated size exceeds SUGGEST_CACHE_BYTES.
+"""
+import os
+import time
+import bisect
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from . import db
+from .models import Staff
+from .signals import staff_changed
+
+# Rough CPython cost of one (token, id) tuple plus its list slot, excluding the token text
+ENTRY_BYTES = 130
+# Rough cost of one names-dict entry, excluding the name text
+NAME_BYTES = 200
+
+
+def normalise(text):
+    return ' '.join((text or '').lower().split())
+
+
+def _tokens(staff_id, firstname, lastname):
+    words = normalise(f'{firstname} {lastname}').split()
+    return [(' '.join(words[i:]), staff_id) for i in range(len(words))]
+
+
+class PrefixIndex:
+    """Sorted name tokens for one boss's staff"""
+
+    def __init__(self, rows, data_version):
+        self.names = {}
+        self.entries = []
+        self.nbytes = 0
+        for staff_id, firstname, lastname in rows:
+            self._add(staff_id, firstname, lastname, append=True)
+        self.entries.sort()
+        self.data_version = data_version
+        self.checked_at = time.monotonic()
+
+    def _add(self, staff_id, firstname, lastname, append=False):
+        self.names[staff_id] = (firstname, lastname)
+        self.nbytes += NAME_BYTES + len(firstname or '') + len(lastname or '')
+        for entry in _tokens(staff_id, firstname, lastname):
+            if append:
+                self.entries.append(entry)
+            else:
+                bisect.insort(self.entries, entry)
+            self.nbytes += ENTRY_BYTES + len(entry[0])
+
+    def _remove(self, staff_id):
+        name = self.names.pop(staff_id, None)
+        if name is None:
+            return
+        self.nbytes -= NAME_BYTES + len(name[0] or '') + len(name[1] or '')
+        for entry in _tokens(staff_id, *name):
+            i = bisect.bisect_left(self.entries, entry)
+            if i < len(self.entries) and self.entries[i] == entry:
+                del self.entries[i]
+                self.nbytes -= ENTRY_BYTES + len(entry[0])
+
+    def apply(self, action, staff):
+        """Patch the index for one committed staff write"""
+        self._remove(staff['id'])
+        if action != 'deleted':
+            self._add(staff['id'], staff['firstname'], staff['lastname'])
+
+    def lookup(self, prefix, limit):
+        results = []
+        seen = set()
+        entries = self.entries
+        i = bisect.bisect_left(entries, (prefix,))
+        while i < len(entries) and len(results) < limit:
+            token, staff_id = entries[i]
+            if not token.startswith(prefix):
+                break
+            if staff_id not in seen:
+                seen.add(staff_id)
+                firstname, lastname = self.names[staff_id]
+                results.append({'id': staff_id, 'firstname': firstname, 'lastname': lastname})
+            i += 1
+        return results
+
+
+class SuggestIndexCache:
+    """LRU of per-boss prefix indexes under a memory cap"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, revalidate_after=30):
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.builds = 0
+        self.evictions = 0
+
+    def suggest(self, boss_id, query, limit=10):
+        """Staff whose name (or any later part of it) starts with ``query``. Needs an app context."""
+        prefix = normalise(query)
+        if not prefix:
+            return []
+        index = self._get(boss_id)
+        with self._lock:
+            return index.lookup(prefix, limit)
+
+    def _get(self, boss_id):
+        from .services import StaffService
+
+        with self._lock:
+            index = self._indexes.get(boss_id)
+            if index is not None:
+                self._indexes.move_to_end(boss_id)
+                if time.monotonic() - index.checked_at < self.revalidate_after:
+                    return index
+
+        version = StaffService.get_data_version(boss_id)
+        if index is not None and index.data_version == version:
+            index.checked_at = time.monotonic()
+            return index
+
+        rows = db.session.query(Staff.id, Staff.firstname, Staff.lastname).filter(Staff.boss_id == boss_id).all()
+        index = PrefixIndex(rows, version)
+        with self._lock:
+            previous = self._indexes.pop(boss_id, None)
+            if previous is not None:
+                self.total_bytes -= previous.nbytes
+            self._indexes[boss_id] = index
+            self.total_bytes += index.nbytes
+            self.builds += 1
+            # Always keep the index just built, even if it alone exceeds the cap
+            while self.total_bytes > self.max_bytes and len(self._indexes) > 1:
+                _, evicted = self._indexes.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+                self.evictions += 1
+        return index
+
+    def on_staff_changed(self, sender, boss_id, action, staff, previous=None):
+        from .services import StaffService
+
+        with self._lock:
+            index = self._indexes.get(boss_id)
+            if index is None:
+                return
+            before = index.nbytes
+            index.apply(action, staff)
+            self.total_bytes += index.nbytes - before
+            current = time.monotonic() - index.checked_at < self.revalidate_after
+        if not current:
+            return
+
+        # The patched index matches the database as of this write, so adopt its
+        # version and leave revalidation to rebuild only for other workers' writes.
+        # A row count that disagrees means one of those landed in between.
+        version = StaffService.get_data_version(boss_id)
+        with self._lock:
+            if self._indexes.get(boss_id) is index and version.split('-', 1)[0] == str(len(index.names)):
+                index.data_version = version
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self.total_bytes = 0
+
+
+def get_suggest_index():
+    return current_app.extensions['suggest_index']
+
+
+def init_app(app):
+    app.config.setdefault('SUGGEST_CACHE_BYTES', int(os.environ.get('SUGGEST_CACHE_BYTES', 64 * 1024 * 1024)))
+    app.config.setdefault('SUGGEST_REVALIDATE_SECONDS', float(os.environ.get('SUGGEST_REVALIDATE_SECONDS', 30)))
+    app.config.setdefault('SUGGEST_MAX_LIMIT', 50)
+
+    cache = SuggestIndexCache(app.config['SUGGEST_CACHE_BYTES'], app.config['SUGGEST_REVALIDATE_SECONDS'])
+    app.extensions['suggest_index'] = cache
+    staff_changed.connect(cache.on_staff_changed, sender=app)
@@ -0,0 +1,491 @@
+"""Garbage collection and disk-usage accounting for UPLOAD_FOLDER.
+
+A small SQLite index in ``UPLOAD_FOLDER/.gc`` records every uploaded file
+with its size and whether a staff row still points at it. The local storage
+backend and staff writes append to a journal next to it, so the folder is
+only listed on the first sweep and by ``flask uploads sweep --full``. Each
+sweep:
+
+1. Applies journal entries added since the last sweep: saved files are
+   indexed, deleted ones dropped, and documents whose staff row changed are
+   queued for a re-check.
+2. Reconciles a bounded number of files that are new or not checked
+   recently against ``Staff.proof_of_id``, one ``IN (...)`` query per batch.
+3. Quarantines (or deletes) files that have been unreferenced for longer
+   than the grace period. The grace period covers uploads that have been
+   written but not yet committed or confirmed.
+4. Purges quarantined files past their retention.
+
+Sweeps run in a background thread at most every UPLOAD_GC_INTERVAL seconds,
+triggered from request handling, and only one worker per host sweeps at a
+time. ``flask uploads sweep`` and ``flask uploads usage`` run it by hand.
+"""
+import os
+import time
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from . import db
+from .models import Staff
+from .signals import document_changed, staff_changed
+
+logger = logging.getLogger(__name__)
+
+STATE_DIR = '.gc'
+
+# Rotate the journal once this much of it has been applied
+JOURNAL_ROTATE_BYTES = 1024 * 1024
+
+# Placeholders StaffService stores in proof_of_id before a document exists
+PLACEHOLDER_KEYS = (None, '', 'pending_upload', 'temp')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    first_seen REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'unknown',
+    boss_id INTEGER,
+    orphan_since REAL,
+    checked_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_files_checked ON files (checked_at);
+CREATE INDEX IF NOT EXISTS ix_files_status ON files (status, orphan_since);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+'''
+
+
+class UploadSweeper:
+    """Keeps the upload index and removes orphaned ID documents"""
+
+    def __init__(self, app, interval=900, grace=24 * 3600, quarantine=True,
+                 quarantine_ttl=7 * 24 * 3600, batch_size=500, max_batches=20, recheck=24 * 3600):
+        self.app = app
+        self.interval = interval
+        self.grace = grace
+        self.quarantine = quarantine
+        self.quarantine_ttl = quarantine_ttl
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.recheck = recheck
+        self._lock = threading.Lock()
+        self._next_run = time.monotonic() + interval
+
+    @property
+    def root(self):
+        return self.app.config['UPLOAD_FOLDER']
+
+    @property
+    def state_dir(self):
+        # A subdirectory, so index writes never touch the upload folder's mtime
+        return os.path.join(self.root, STATE_DIR)
+
+    @property
+    def quarantine_dir(self):
+        return os.path.join(self.state_dir, 'quarantine')
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.state_dir, 'journal')
+
+    def _connect(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(self.state_dir, 'index.sqlite3'), timeout=30)
+        conn.executescript(SCHEMA)
+        return conn
+
+    @contextmanager
+    def _exclusive(self):
+        """Hold the in-process lock and, where available, a host-wide file lock"""
+        if not self._lock.acquire(blocking=False):
+            yield False
+            return
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            with open(os.path.join(self.state_dir, 'sweep.lock'), 'w') as fh:
+                try:
+                    import fcntl
+                except ImportError:
+                    # No cross-process lock on Windows; the thread lock still applies
+                    yield True
+                    return
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    # Journal
+
+    def record(self, action, key):
+        """Append an entry for the next sweep; a lost entry is recovered by ``sweep --full``"""
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            # One short append per entry, so concurrent workers don't interleave lines
+            with open(self.journal_path, 'a', encoding='utf-8') as fh:
+                fh.write(f'{action} {key}\n')
+        except OSError:
+            logger.warning('Could not journal upload change', exc_info=True, extra={'key': key})
+
+    def on_document_changed(self, sender, action, key, **kwargs):
+        self.record(action, key)
+
+    def on_staff_changed(self, sender, staff, previous=None, **kwargs):
+        # The document a row now points at, or stopped pointing at, needs a re-check
+        keys = {staff.get('proof_of_id'), (previous or {}).get('proof_of_id')}
+        for key in keys.difference(PLACEHOLDER_KEYS):
+            self.record('check', key)
+
+    def _drain_journal(self, conn, now):
+        """Apply journal entries added since the last drain; returns how many were applied"""
+        offset = int(self._get_meta(conn, 'journal_offset') or 0)
+        try:
+            if os.path.getsize(self.journal_path) < offset:
+                offset = 0
+        except FileNotFoundError:
+            return 0
+        offset, applied = self._apply_journal(conn, self.journal_path, offset, now)
+
+        if offset >= JOURNAL_ROTATE_BYTES:
+            # Entries appended between the rename and this read are still picked up
+            rotated = self.journal_path + '.old'
+            os.replace(self.journal_path, rotated)
+            applied += self._apply_journal(conn, rotated, offset, now)[1]
+            os.remove(rotated)
+            offset = 0
+        self._set_meta(conn, 'journal_offset', offset)
+        conn.commit()
+        return applied
+
+    def _apply_journal(self, conn, path, offset, now):
+        """Apply the complete lines of ``path`` after ``offset``; returns (new offset, applied)"""
+        with open(path, 'rb') as fh:
+            fh.seek(offset)
+            data = fh.read()
+        end = data.rfind(b'\n') + 1
+        applied = 0
+        for line in data[:end].decode('utf-8', 'replace').splitlines():
+            action, _, key = line.partition(' ')
+            if not key or key.startswith('.'):
+                continue
+            if action == 'saved':
+                try:
+                    stat = os.stat(os.path.join(self.root, key))
+                except FileNotFoundError:
+                    conn.execute('DELETE FROM files WHERE key = ?', (key,))
+                else:
+                    conn.execute(
+                        'INSERT INTO files (key, size, mtime, first_seen) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (key) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, '
+                        'checked_at = NULL',
+                        (key, stat.st_size, stat.st_mtime, now))
+            elif action == 'deleted':
+                conn.execute('DELETE FROM files WHERE key = ?', (key,))
+            elif action == 'check':
+                conn.execute('UPDATE files SET checked_at = NULL WHERE key = ?', (key,))
+            applied += 1
+        return offset + end, applied
+
+    # Sweeping
+
+    def maybe_sweep(self):
+        """Start a background sweep when the interval has elapsed"""
+        if not self.interval or time.monotonic() < self._next_run:
+            return
+        self._next_run = time.monotonic() + self.interval
+        threading.Thread(target=self._background_sweep, name='upload-gc', daemon=True).start()
+
+    def _background_sweep(self):
+        try:
+            with self.app.app_context():
+                self.sweep()
+        except Exception:
+            logger.exception('Upload sweep failed')
+
+    def sweep(self, full=False, max_batches=None):
+        """Run one incremental sweep; returns counters, or None if another sweep holds the lock.
+
+        Needs an application context. ``full`` lists the directory, which also
+        indexes files written outside the storage backend, and reconciles every
+        indexed file.
+        """
+        with self._exclusive() as acquired:
+            if not acquired:
+                return None
+            now = time.time()
+            stats = {'journaled': 0, 'listed': False, 'checked': 0, 'orphaned': 0, 'removed': 0, 'quarantine_purged': 0}
+            conn = self._connect()
+            try:
+                stats['journaled'] = self._drain_journal(conn, now)
+                stats['listed'] = self._refresh_listing(conn, now, force=full)
+                if full:
+                    conn.execute('UPDATE files SET checked_at = NULL')
+                batches = None if full else (max_batches or self.max_batches)
+                stats['checked'], stats['orphaned'] = self._reconcile(conn, now, batches)
+                stats['removed'] = self._collect(conn, now)
+                stats['quarantine_purged'] = self._purge_quarantine(now)
+                self._set_meta(conn, 'last_sweep', now)
+                conn.commit()
+            finally:
+                conn.close()
+            logger.info('Upload sweep finished', extra=stats)
+            return stats
+
+    def _refresh_listing(self, conn, now, force=False):
+        """Sync the index with the directory when forced or never listed; returns whether it was listed"""
+        if not force and self._get_meta(conn, 'listed_at') is not None:
+            return False
+
+        on_disk = {}
+        try:
+            entries = os.scandir(self.root)
+        except FileNotFoundError:
+            return False
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.') or entry.name.endswith('.tmp') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                on_disk[entry.name] = (stat.st_size, stat.st_mtime)
+
+        indexed = {key for key, in conn.execute('SELECT key FROM files')}
+        conn.executemany(
+            'INSERT INTO files (key, size, mtime, first_seen) VALUES (?, ?, ?, ?)',
+            ((key, size, mtime, now) for key, (size, mtime) in on_disk.items() if key not in indexed)
+        )
+        conn.executemany('DELETE FROM files WHERE key = ?', ((key,) for key in indexed - on_disk.keys()))
+        self._set_meta(conn, 'listed_at', now)
+        conn.commit()
+        return True
+
+    def _reconcile(self, conn, now, max_batches):
+        """Mark unchecked or stale entries as referenced or orphaned; returns (checked, newly orphaned)"""
+        checked = orphaned = batches = 0
+        while max_batches is None or batches < max_batches:
+            keys = [key for key, in conn.execute(
+                'SELECT key FROM files WHERE checked_at IS NULL OR checked_at < ? ORDER BY checked_at LIMIT ?',
+                (now - self.recheck, self.batch_size)
+            )]
+            if not keys:
+                break
+            batches += 1
+            owners = self._owners(keys)
+
+            for key in keys:
+                try:
+                    stat = os.stat(os.path.join(self.root, key))
+                except FileNotFoundError:
+                    conn.execute('DELETE FROM files WHERE key = ?', (key,))
+                    continue
+                if key in owners:
+                    conn.execute(
+                        "UPDATE files SET status = 'referenced', boss_id = ?, orphan_since = NULL, "
+                        "size = ?, mtime = ?, checked_at = ? WHERE key = ?",
+                        (owners[key], stat.st_size, stat.st_mtime, now, key))
+                else:
+                    cursor = conn.execute(
+                        "UPDATE files SET status = 'orphan', boss_id = NULL, orphan_since = ?, "
+                        "size = ?, mtime = ?, checked_at = ? WHERE key = ? AND status != 'orphan'",
+                        (now, stat.st_size, stat.st_mtime, now, key))
+                    if cursor.rowcount:
+                        orphaned += 1
+                    else:
+                        conn.execute('UPDATE files SET checked_at = ? WHERE key = ?', (now, key))
+            checked += len(keys)
+            conn.commit()
+        return checked, orphaned
+
+    def _collect(self, conn, now):
+        """Quarantine or delete files orphaned for longer than the grace period"""
+        removed = 0
+        while True:
+            keys = [key for key, in conn.execute(
+                "SELECT key FROM files WHERE status = 'orphan' AND orphan_since <= ? LIMIT ?",
+                (now - self.grace, self.batch_size)
+            )]
+            if not keys:
+                break
+            # A presigned upload may have been confirmed since the last check
+            owners = self._owners(keys)
+            for key in keys:
+                if key in owners:
+                    conn.execute(
+                        "UPDATE files SET status = 'referenced', boss_id = ?, orphan_since = NULL, checked_at = ? "
+                        "WHERE key = ?", (owners[key], now, key))
+                    continue
+                self._dispose(key, now)
+                conn.execute('DELETE FROM files WHERE key = ?', (key,))
+                removed += 1
+            conn.commit()
+        return removed
+
+    def _dispose(self, key, now):
+        path = os.path.join(self.root, key)
+        try:
+            if self.quarantine:
+                os.makedirs(self.quarantine_dir, exist_ok=True)
+                os.replace(path, os.path.join(self.quarantine_dir, f'{int(now)}_{key}'))
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        logger.info('Removed orphaned upload %s', key, extra={'quarantined': self.quarantine})
+
+    def _purge_quarantine(self, now):
+        purged = 0
+        try:
+            entries = list(os.scandir(self.quarantine_dir))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            prefix = entry.name.split('_', 1)[0]
+            if prefix.isdigit() and now - int(prefix) > self.quarantine_ttl:
+                try:
+                    os.remove(entry.path)
+                    purged += 1
+                except OSError:
+                    pass
+        return purged
+
+    @staticmethod
+    def _owners(keys):
+        """Map of key -> boss_id for keys referenced by a staff row"""
+        rows = db.session.query(Staff.proof_of_id, Staff.boss_id).filter(Staff.proof_of_id.in_(keys)).all()
+        # Don't sit idle in a transaction while the index is updated
+        db.session.rollback()
+        return dict(rows)
+
+    @staticmethod
+    def _get_meta(conn, name):
+        row = conn.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _set_meta(conn, name, value):
+        conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, str(value)))
+
+    # Reporting
+
+    def _catch_up(self):
+        """Index and check files journaled since the last sweep, unless a sweep is running"""
+        with self._exclusive() as acquired:
+            if not acquired:
+                return
+            now = time.time()
+            conn = self._connect()
+            try:
+                # New entries have no checked_at, so one batch reaches them first
+                if self._drain_journal(conn, now):
+                    self._reconcile(conn, now, max_batches=1)
+            finally:
+                conn.close()
+
+    def usage(self, boss_id=None):
+        """Disk usage from the index: per boss, plus orphaned and quarantined totals"""
+        self._catch_up()
+        conn = self._connect()
+        try:
+            query = "SELECT boss_id, COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE status = 'referenced'"
+            params = ()
+            if boss_id is not None:
+                query += ' AND boss_id = ?'
+                params = (boss_id,)
+            per_boss = {
+                owner: {'files': files, 'bytes': size}
+                for owner, files, size in conn.execute(query + ' GROUP BY boss_id', params)
+            }
+            if boss_id is not None:
+                return per_boss.get(boss_id, {'files': 0, 'bytes': 0})
+
+            orphan_files, orphan_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE status = 'orphan'").fetchone()
+            unchecked_files, unchecked_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE status = 'unknown'").fetchone()
+            last_sweep = self._get_meta(conn, 'last_sweep')
+        finally:
+            conn.close()
+
+        quarantine_files = quarantine_bytes = 0
+        if os.path.isdir(self.quarantine_dir):
+            for entry in os.scandir(self.quarantine_dir):
+                quarantine_files += 1
+                quarantine_bytes += entry.stat().st_size
+
+        return {
+            'bosses': per_boss,
+            'orphaned': {'files': orphan_files, 'bytes': orphan_bytes},
+            'unchecked': {'files': unchecked_files, 'bytes': unchecked_bytes},
+            'quarantined': {'files': quarantine_files, 'bytes': quarantine_bytes},
+            'last_sweep': float(last_sweep) if last_sweep else None,
+        }
+
+
+def get_sweeper():
+    return current_app.extensions['upload_gc']
+
+
+@click.group('uploads', cls=AppGroup)
+def uploads_cli():
+    """Upload folder maintenance"""
+
+
+@uploads_cli.command('sweep')
+@click.option('--full', is_flag=True, help='re-list the folder and re-check every file')
+def sweep_command(full):
+    """Reconcile uploads with staff records and remove orphans past the grace period"""
+    stats = get_sweeper().sweep(full=full)
+    if stats is None:
+        raise click.ClickException('Another sweep is running')
+    click.echo(', '.join(f'{name}={value}' for name, value in stats.items()))
+
+
+@uploads_cli.command('usage')
+def usage_command():
+    """Show indexed disk usage per boss"""
+    usage = get_sweeper().usage()
+    for boss_id, entry in sorted(usage['bosses'].items()):
+        click.echo(f'boss {boss_id:<8} {entry["files"]:>8} files {entry["bytes"] / 1024 / 1024:>10.1f} MB')
+    for name in ('orphaned', 'unchecked', 'quarantined'):
+        entry = usage[name]
+        click.echo(f'{name:<13} {entry["files"]:>8} files {entry["bytes"] / 1024 / 1024:>10.1f} MB')
+
+
+def _after_request(response):
+    get_sweeper().maybe_sweep()
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('UPLOAD_GC_INTERVAL', int(os.environ.get('UPLOAD_GC_INTERVAL', 900)))
+    app.config.setdefault('UPLOAD_GC_GRACE', int(os.environ.get('UPLOAD_GC_GRACE', 24 * 3600)))
+    app.config.setdefault('UPLOAD_GC_QUARANTINE', os.environ.get('UPLOAD_GC_QUARANTINE', '1') != '0')
+    app.config.setdefault('UPLOAD_GC_QUARANTINE_TTL', int(os.environ.get('UPLOAD_GC_QUARANTINE_TTL', 7 * 24 * 3600)))
+    app.config.setdefault('UPLOAD_GC_BATCH', int(os.environ.get('UPLOAD_GC_BATCH', 500)))
+
+    sweeper = app.extensions['upload_gc'] = UploadSweeper(
+        app,
+        interval=app.config['UPLOAD_GC_INTERVAL'],
+        grace=app.config['UPLOAD_GC_GRACE'],
+        quarantine=app.config['UPLOAD_GC_QUARANTINE'],
+        quarantine_ttl=app.config['UPLOAD_GC_QUARANTINE_TTL'],
+        batch_size=app.config['UPLOAD_GC_BATCH'],
+    )
+    app.cli.add_command(uploads_cli)
+    # Object stores manage their own lifecycle; only the local disk needs sweeping
+    if app.config['STORAGE_BACKEND'] == 'local':
+        app.after_request(_after_request)
+        document_changed.connect(sweeper.on_document_changed, sender=app)
+        staff_changed.connect(sweeper.on_staff_changed, sender=app)
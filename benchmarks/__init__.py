@@ -0,0 +1 @@
+"""Reproducible benchmarks for the staff API (see benchmarks/run.py)."""
@@ -0,0 +1,43 @@
+"""Compare two benchmark result files.
+
+    python -m benchmarks.compare baseline.json candidate.json
+"""
+import sys
+import json
+import argparse
+
+METRICS = ('p50_ms', 'p90_ms', 'p99_ms', 'queries_per_request', 'round_trips_per_request', 'peak_memory_bytes')
+
+
+def compare(baseline, candidate):
+    """Yield (endpoint, metric, old, new, change %) for every shared measurement"""
+    for name, old in baseline['results'].items():
+        new = candidate['results'].get(name)
+        if new is None:
+            continue
+        for metric in METRICS:
+            a, b = old.get(metric), new.get(metric)
+            if a is None or b is None:
+                continue
+            change = ((b - a) / a * 100.0) if a else None
+            yield name, metric, a, b, change
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark JSON files')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    with open(args.candidate) as fh:
+        candidate = json.load(fh)
+
+    for name, metric, a, b, change in compare(baseline, candidate):
+        change_text = f'{change:+.1f}%' if change is not None else 'n/a'
+        print(f'{name:24s} {metric:22s} {a:>14} -> {b:<14} {change_text}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Seeded synthetic tenant data for benchmarks.
+
+Creates ``bosses`` companies with ``staff_per_boss`` staff each. Field values
+follow rough real-world distributions so that search selectivity, dashboard
+breakdowns and export sizes look like production data.
+"""
+import os
+import random
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import insert
+
+from backend import db
+from backend.models import Boss, Staff
+
+FIRST_NAMES = [
+    'James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+    'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen',
+    'Mohammed', 'Aisha', 'Oliver', 'Amelia', 'Chinedu', 'Ngozi', 'Adebayo', 'Funmilayo', 'Priya', 'Arjun',
+    'Wei', 'Mei', 'Kwame', 'Ama', 'Luca', 'Sofia', 'Mateusz', 'Zofia', 'Dennis', 'Ashley',
+]
+LAST_NAMES = [
+    'Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies', 'Patel', 'Robinson',
+    'Wright', 'Thompson', 'Evans', 'Walker', 'White', 'Roberts', 'Green', 'Hall', 'Wood', 'Jackson',
+    'Okafor', 'Adeyemi', 'Khan', 'Singh', 'Chen', 'Nowak', 'Mensah', 'Rossi', 'Ali', 'Clarke',
+]
+STREETS = ['High Street', 'Station Road', 'Church Lane', 'Victoria Road', 'Green Lane', 'Park Avenue', 'Mill Road']
+TOWNS = ['London', 'Manchester', 'Birmingham', 'Leeds', 'Glasgow', 'Bristol', 'Liverpool', 'Cardiff']
+
+# (value, weight)
+EMPLOYMENT_STATUSES = [('Full-time', 55), ('Part-time', 25), ('Contract', 15), ('Intern', 5)]
+SEXES = [('Female', 49), ('Male', 49), ('Other', 2)]
+IMMIGRATION_STATUSES = [
+    ('British Citizen', 60), ('Settled Status', 15), ('Pre-settled Status', 8),
+    ('Skilled Worker Visa', 10), ('Student Visa', 5), ('Graduate Visa', 2),
+]
+VISA_TYPES = {
+    'British Citizen': 'None',
+    'Settled Status': 'EUSS',
+    'Pre-settled Status': 'EUSS',
+    'Skilled Worker Visa': 'Skilled Worker',
+    'Student Visa': 'Student',
+    'Graduate Visa': 'Graduate',
+}
+ID_EXTENSIONS = [('jpg', 60), ('png', 25), ('pdf', 15)]
+# Share of staff that already have a proof of ID uploaded
+UPLOADED_ID_RATIO = 0.8
+# A few bytes is enough: the benchmark measures handling, not disk throughput
+DUMMY_FILE_BYTES = b'\xff\xd8\xff\xe0' + b'\0' * 2044
+
+
+def _weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights=weights, k=1)[0]
+
+
+def _ni_number(rng, serial):
+    """Unique, valid-looking National Insurance number"""
+    prefix = rng.choice('ABCEGHJKLMNPRSTWXYZ') + rng.choice('ABCEGHJKLMNPRSTWXYZ')
+    return f'{prefix}{serial:06d}{rng.choice("ABCD")}'
+
+
+def generate_staff_row(rng, boss_id, serial, today=None):
+    """Build one staff row as a dict of column values"""
+    today = today or date.today()
+    immigration_status = _weighted(rng, IMMIGRATION_STATUSES)
+    # Working-age population, skewed towards 25-45
+    age = min(max(int(rng.gauss(36, 11)), 18), 67)
+    date_of_birth = today - timedelta(days=age * 365 + rng.randint(0, 364))
+    created_at = datetime.utcnow() - timedelta(days=rng.randint(0, 3 * 365), seconds=rng.randint(0, 86399))
+
+    return {
+        'boss_id': boss_id,
+        'firstname': rng.choice(FIRST_NAMES),
+        'lastname': rng.choice(LAST_NAMES),
+        'national_insurance_number': _ni_number(rng, serial),
+        'home_address': f'{rng.randint(1, 250)} {rng.choice(STREETS)}, {rng.choice(TOWNS)}',
+        'telephone_number': f'07{rng.randint(100000000, 999999999)}',
+        'employment_status': _weighted(rng, EMPLOYMENT_STATUSES),
+        'immigration_status': immigration_status,
+        'visa_type': VISA_TYPES[immigration_status],
+        'visa_sharecode': ''.join(rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ23456789') for _ in range(9)),
+        'sex': _weighted(rng, SEXES),
+        'date_of_birth': date_of_birth,
+        'proof_of_id': 'pending_upload',
+        'created_at': created_at,
+    }
+
+
+def seed_database(bosses, staff_per_boss, seed=42, upload_folder=None, batch_size=5000):
+    """Populate the current app's database and return the created boss ids.
+
+    Must be called inside an application context. When ``upload_folder`` is
+    given, dummy ID files are written for the staff that have one.
+    """
+    rng = random.Random(seed)
+    boss_ids = []
+
+    for i in range(bosses):
+        boss = Boss(
+            email=f'boss{i}@bench.example.com',
+            company_name=f'Bench Company {i}',
+            firstname=rng.choice(FIRST_NAMES),
+            lastname=rng.choice(LAST_NAMES),
+        )
+        # Hashing is slow and irrelevant to the endpoints under test
+        boss.password_hash = 'benchmark'
+        db.session.add(boss)
+        db.session.flush()
+        boss_ids.append(boss.id)
+    db.session.commit()
+
+    serial = 0
+    today = date.today()
+    for boss_id in boss_ids:
+        rows = []
+        for _ in range(staff_per_boss):
+            serial += 1
+            rows.append(generate_staff_row(rng, boss_id, serial, today))
+            if len(rows) >= batch_size:
+                db.session.execute(insert(Staff), rows)
+                rows = []
+        if rows:
+            db.session.execute(insert(Staff), rows)
+    db.session.commit()
+
+    if upload_folder:
+        _attach_dummy_files(rng, upload_folder, boss_ids)
+
+    return boss_ids
+
+
+def _attach_dummy_files(rng, upload_folder, boss_ids):
+    """Write dummy ID files and point proof_of_id at them"""
+    os.makedirs(upload_folder, exist_ok=True)
+    updates = []
+    staff_rows = db.session.query(Staff.id, Staff.boss_id, Staff.firstname).filter(
+        Staff.boss_id.in_(boss_ids)
+    ).order_by(Staff.id)
+
+    for staff_id, boss_id, firstname in staff_rows:
+        if rng.random() >= UPLOADED_ID_RATIO:
+            continue
+        filename = f'staff_{staff_id}_{firstname.lower()}_id.{_weighted(rng, ID_EXTENSIONS)}'
+        with open(os.path.join(upload_folder, filename), 'wb') as fh:
+            fh.write(DUMMY_FILE_BYTES)
+        updates.append({'id': staff_id, 'boss_id': boss_id, 'proof_of_id': filename})
+
+    if updates:
+        db.session.bulk_update_mappings(Staff, updates)
+        db.session.commit()
@@ -0,0 +1,301 @@
+"""Concurrent load test: sync (gunicorn) vs async (uvicorn) deployments.
+
+Seeds a database, starts ``create_app`` under gunicorn and ``create_asgi_app``
+under uvicorn against it, then drives both with the same number of
+keep-alive HTTP/1.1 connections and reports requests/sec and latency
+percentiles per path as JSON.
+
+    python -m benchmarks.loadtest --concurrency 64 --duration 15 --output load.json
+
+Already-running servers can be measured instead of spawned ones:
+
+    python -m benchmarks.loadtest --target sync=http://127.0.0.1:5000 \\
+        --target async=http://127.0.0.1:8000 --token <jwt>
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+from benchmarks.run import build_app, git_revision, summarise
+
+# Must match build_app so tokens minted while seeding verify on the servers
+JWT_SECRET_KEY = 'benchmark-secret-key-that-is-long-enough'
+
+DEFAULT_PATHS = [
+    '/api/staff',
+    '/api/staff/search?q={q}',
+    '/api/dashboard',
+]
+
+
+# Server factories, loaded by gunicorn / uvicorn in the spawned processes
+
+def _configured_app():
+    from backend import create_app
+
+    app = create_app()
+    app.config['UPLOAD_FOLDER'] = os.environ['BENCH_UPLOAD_FOLDER']
+    app.config['JWT_SECRET_KEY'] = JWT_SECRET_KEY
+    return app
+
+
+def sync_app():
+    return _configured_app()
+
+
+def async_app():
+    from backend.asgi import create_asgi_app
+    return create_asgi_app(_configured_app())
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_servers(database_url, upload_folder, workers, threads):
+    """Start gunicorn (gthread) and uvicorn on free ports; returns {name: (url, process)}"""
+    env = dict(os.environ, DATABASE_URL=database_url, BENCH_UPLOAD_FOLDER=upload_folder, LOG_LEVEL='ERROR')
+    servers = {}
+
+    port = _free_port()
+    servers['sync'] = (f'http://127.0.0.1:{port}', subprocess.Popen([
+        sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+        '--threads', str(threads), '--worker-class', 'gthread', '--log-level', 'warning',
+        'benchmarks.loadtest:sync_app()',
+    ], env=env))
+
+    port = _free_port()
+    servers['async'] = (f'http://127.0.0.1:{port}', subprocess.Popen([
+        sys.executable, '-m', 'uvicorn', '--factory', 'benchmarks.loadtest:async_app',
+        '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers),
+        '--log-level', 'warning', '--no-access-log',
+    ], env=env))
+
+    for url, process in servers.values():
+        _wait_for_port(url, process)
+    return servers
+
+
+def _wait_for_port(url, process, timeout=30):
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server for {url} exited with {process.returncode}')
+        try:
+            with socket.create_connection((parts.hostname, parts.port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server for {url} did not start within {timeout}s')
+
+
+async def _read_response(reader):
+    """Read one HTTP/1.1 response; returns (status, keep_alive, X-Single-Flight outcome or None)"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    else:
+        await reader.read()
+        return status, False, headers.get('x-single-flight')
+    return status, headers.get('connection', '').lower() != 'close', headers.get('x-single-flight')
+
+
+async def _connection_worker(base_url, paths, tokens, search_terms, deadline, rng, samples):
+    parts = urlsplit(base_url)
+    reader = writer = None
+    try:
+        while time.monotonic() < deadline:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(parts.hostname, parts.port)
+            template = rng.choice(paths)
+            path = template.format(q=rng.choice(search_terms))
+            request = (
+                f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n'
+                f'Authorization: Bearer {rng.choice(tokens)}\r\nConnection: keep-alive\r\n\r\n'
+            ).encode('latin-1')
+            start = time.perf_counter()
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, keep_alive, outcome = await _read_response(reader)
+            except (OSError, asyncio.IncompleteReadError):
+                samples.append((template, None, time.perf_counter() - start, None))
+                writer.close()
+                writer = None
+                continue
+            samples.append((template, status, time.perf_counter() - start, outcome))
+            if not keep_alive:
+                writer.close()
+                writer = None
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def load(base_url, paths, tokens, search_terms, concurrency, duration, seed):
+    """Hold ``concurrency`` connections busy for ``duration`` seconds; returns (samples, elapsed)"""
+    samples = []
+    start = time.monotonic()
+    deadline = start + duration
+    await asyncio.gather(*(
+        _connection_worker(base_url, paths, tokens, search_terms, deadline, random.Random(seed + i), samples)
+        for i in range(concurrency)
+    ))
+    return samples, time.monotonic() - start
+
+
+def report_target(samples, elapsed, paths):
+    """Per-template and overall throughput and latency for one target"""
+    result = {}
+    groups = {'all': samples}
+    for template in paths:
+        groups[template] = [sample for sample in samples if sample[0] == template]
+
+    for name, group in groups.items():
+        ok = [latency for _, status, latency, _ in group if status is not None and status < 400]
+        statuses, outcomes = {}, {}
+        for _, status, _, outcome in group:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if outcome is not None:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        entry = summarise(ok)
+        entry['requests_per_second'] = round(len(ok) / elapsed, 1) if elapsed else None
+        entry['status_codes'] = statuses
+        if outcomes:
+            # Requests answered with a copy of a concurrent identical request's response
+            entry['single_flight'] = outcomes
+        result[name] = entry
+    return result
+
+
+def seed(args, workdir):
+    """Seed a fresh database and return (database_url, upload_folder, tokens)"""
+    from flask_jwt_extended import create_access_token
+    from benchmarks.datagen import seed_database
+
+    database_url = args.database_url or f'sqlite:///{os.path.join(workdir, "bench.db")}'
+    upload_folder = os.path.join(workdir, 'uploads')
+    app = build_app(database_url, upload_folder)
+    with app.app_context():
+        boss_ids = seed_database(args.bosses, args.staff, seed=args.seed, upload_folder=upload_folder)
+        tokens = [create_access_token(identity=str(boss_id)) for boss_id in boss_ids]
+    return database_url, upload_folder, tokens
+
+
+def run(args):
+    from benchmarks.datagen import FIRST_NAMES
+
+    workdir = tempfile.mkdtemp(prefix='marynola-load-')
+    processes = []
+    try:
+        if args.target:
+            targets = dict(target.split('=', 1) for target in args.target)
+            tokens = args.token
+            database_url = None
+            if not tokens:
+                raise SystemExit('--token is required with --target')
+        else:
+            database_url, upload_folder, tokens = seed(args, workdir)
+            servers = spawn_servers(database_url, upload_folder, args.workers, args.threads)
+            processes = [process for _, process in servers.values()]
+            targets = {name: url for name, (url, _) in servers.items()}
+
+        search_terms = [name[:3] for name in FIRST_NAMES[:10]] + ['Smith', '07', 'zzz']
+        results = {}
+        for name, url in targets.items():
+            # Warm connection pools and caches before measuring
+            asyncio.run(load(url, args.paths, tokens, search_terms, args.concurrency, args.warmup, args.seed))
+            samples, elapsed = asyncio.run(
+                load(url, args.paths, tokens, search_terms, args.concurrency, args.duration, args.seed))
+            results[name] = report_target(samples, elapsed, args.paths)
+            overall = results[name]['all']
+            print(f'{name:8s} {overall["requests_per_second"]} req/s p50={overall["p50_ms"]}ms '
+                  f'p99={overall["p99_ms"]}ms', file=sys.stderr)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': database_url.split(':', 1)[0] if database_url else None,
+            'bosses': args.bosses,
+            'staff_per_boss': args.staff,
+            'workers': args.workers,
+            'threads': args.threads,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'paths': args.paths,
+        },
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Compare sync and async deployments under concurrent load')
+    parser.add_argument('--bosses', type=int, default=5, help='number of tenants to generate')
+    parser.add_argument('--staff', type=int, default=500, help='staff per tenant')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database-url', help='defaults to a throwaway SQLite file; '
+                                               'a Postgres database given here is dropped and recreated')
+    parser.add_argument('--workers', type=int, default=2, help='server processes per deployment')
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker')
+    parser.add_argument('--concurrency', type=int, default=32, help='open client connections')
+    parser.add_argument('--duration', type=float, default=10.0, help='measured seconds per target')
+    parser.add_argument('--warmup', type=float, default=2.0, help='unmeasured seconds per target')
+    parser.add_argument('--paths', nargs='*', default=DEFAULT_PATHS,
+                        help='GET paths to mix; {q} is replaced with a search term')
+    parser.add_argument('--target', action='append',
+                        help='name=url of an already running server (repeatable); skips seeding and spawning')
+    parser.add_argument('--token', action='append', help='bearer token(s) to use with --target')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(payload + '\n')
+    else:
+        print(payload)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Per-request cost of the access token revocation check.
+
+Fills a scratch SQLite database with ``--revoked`` revoked tokens, then times
+``RevocationList.is_revoked`` for valid tokens (the common case, answered by
+the Bloom filter alone) and for revoked ones (filter hit plus a primary-key
+lookup), against querying revoked_token on every check. Prints microseconds
+per check as JSON.
+
+    python -m benchmarks.revocation --revoked 50000 --checks 20000
+"""
+import os
+import sys
+import json
+import uuid
+import argparse
+import platform
+import tempfile
+import timeit
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.run import git_revision
+
+
+def measure(func, items, repeat):
+    """Best-of-``repeat`` microseconds per item"""
+    best = min(timeit.repeat(lambda: [func(item) for item in items], number=1, repeat=repeat))
+    return round(best / len(items) * 1e6, 3)
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='revocation-bench-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+
+    from sqlalchemy import insert, select
+    from backend import create_app, db
+    from backend.models import RevokedToken
+
+    app = create_app()
+    table = RevokedToken.__table__
+    expires_at = datetime.utcnow() + timedelta(hours=24)
+    revoked = [str(uuid.uuid4()) for _ in range(args.revoked)]
+
+    with app.app_context():
+        db.metadata.create_all(db.engine, tables=[table])
+        with db.engine.begin() as conn:
+            conn.execute(insert(table), [
+                {'jti': jti, 'boss_id': index % 100 + 1, 'revoked_at': datetime.utcnow(), 'expires_at': expires_at}
+                for index, jti in enumerate(revoked)
+            ])
+
+        revocations = app.extensions['revocation']
+        revocations.sync_interval = 3600
+        revocations.sync()
+
+        iat = datetime.now(timezone.utc).timestamp()
+        valid = [{'sub': str(index % 100 + 1), 'jti': str(uuid.uuid4()), 'iat': iat} for index in range(args.checks)]
+        hits = [{'sub': '1', 'jti': jti, 'iat': iat} for jti in revoked[:min(args.checks, len(revoked))]]
+
+        def query_every_time(payload):
+            with db.engine.connect() as conn:
+                return conn.execute(select(table.c.id).where(table.c.jti == payload['jti'])).first() is not None
+
+        results = {
+            'db_lookup_valid_us': measure(query_every_time, valid, args.repeat),
+            'filter_valid_us': measure(revocations.is_revoked, valid, args.repeat),
+            'filter_revoked_us': measure(revocations.is_revoked, hits, args.repeat),
+        }
+        assert not any(revocations.is_revoked(payload) for payload in valid[:1000])
+        assert all(revocations.is_revoked(payload) for payload in hits[:1000])
+
+        bloom = revocations.filter
+        results['false_positive_rate'] = round(sum(payload['jti'] in bloom for payload in valid) / len(valid), 6)
+        results['filter'] = {'bits': bloom.size, 'hashes': bloom.hashes, 'bytes': len(bloom.bits), 'keys': bloom.count}
+
+    for name in ('db_lookup_valid_us', 'filter_valid_us', 'filter_revoked_us'):
+        print(f'{name:20s} {results[name]:8.3f} us/check', file=sys.stderr)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'revoked': args.revoked,
+            'checks': args.checks,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--revoked', type=int, default=50000)
+    parser.add_argument('--checks', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output')
+    args = parser.parse_args(argv)
+
+    payload = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(payload + '\n')
+    else:
+        print(payload)
+
+
+if __name__ == '__main__':
+    main()
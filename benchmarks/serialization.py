@@ -0,0 +1,183 @@
+"""CPU cost of staff validation, coercion and serialization.
+
+Times the functions in ``backend.staff_schema`` against the
+hand-written per-field code they replaced (kept below as ``legacy_*``), on
+synthetic rows and without a database, and prints microseconds per row as
+JSON.
+
+    python -m benchmarks.serialization --rows 20000 --repeat 5
+"""
+import sys
+import json
+import random
+import argparse
+import platform
+import timeit
+from datetime import datetime, timezone
+
+from benchmarks.datagen import generate_staff_row
+from benchmarks.run import git_revision
+
+
+# The implementations staff_schema replaced, for comparison
+
+def legacy_validate(data):
+    required_fields = [
+        'firstname', 'lastname', 'national_insurance_number',
+        'home_address', 'telephone_number', 'employment_status',
+        'immigration_status', 'visa_type', 'visa_sharecode', 'sex', 'date_of_birth'
+    ]
+    errors = []
+    for field in required_fields:
+        if field not in data or not data[field]:
+            errors.append(f'{field} is required')
+    if 'sex' in data and data['sex'] not in ['Male', 'Female', 'Other']:
+        errors.append('Invalid sex value')
+    if 'employment_status' in data and data['employment_status'] not in ['Full-time', 'Part-time', 'Contract',
+                                                                         'Intern']:
+        errors.append('Invalid employment status')
+    return errors if errors else None
+
+
+def legacy_coerce(data):
+    return dict(
+        firstname=data['firstname'].strip(),
+        lastname=data['lastname'].strip(),
+        national_insurance_number=data['national_insurance_number'].upper(),
+        home_address=data['home_address'].strip(),
+        telephone_number=data['telephone_number'].strip(),
+        employment_status=data['employment_status'],
+        immigration_status=data['immigration_status'].strip(),
+        visa_type=data['visa_type'].strip(),
+        visa_sharecode=data['visa_sharecode'].strip(),
+        sex=data['sex'],
+        date_of_birth=datetime.strptime(data['date_of_birth'], '%Y-%m-%d').date(),
+    )
+
+
+def legacy_to_dict(staff):
+    return {
+        'id': staff.id,
+        'firstname': staff.firstname,
+        'lastname': staff.lastname,
+        'national_insurance_number': staff.national_insurance_number,
+        'home_address': staff.home_address,
+        'telephone_number': staff.telephone_number,
+        'employment_status': staff.employment_status,
+        'immigration_status': staff.immigration_status,
+        'visa_type': staff.visa_type,
+        'visa_sharecode': staff.visa_sharecode,
+        'sex': staff.sex,
+        'date_of_birth': staff.date_of_birth.isoformat() if staff.date_of_birth else None,
+        'proof_of_id': staff.proof_of_id
+    }
+
+
+def legacy_to_row(staff):
+    row = legacy_to_dict(staff)
+    row['date_of_birth'] = staff.date_of_birth.strftime('%Y-%m-%d') if staff.date_of_birth else ''
+    return row
+
+
+def legacy_excel_records(rows):
+    return [{
+        'First Name': staff.get('firstname', ''),
+        'Last Name': staff.get('lastname', ''),
+        'National Insurance Number': staff.get('national_insurance_number', ''),
+        'Home Address': staff.get('home_address', ''),
+        'Telephone Number': staff.get('telephone_number', ''),
+        'Employment Status': staff.get('employment_status', ''),
+        'Immigration Status': staff.get('immigration_status', ''),
+        'Visa Type': staff.get('visa_type', ''),
+        'Visa Sharecode': staff.get('visa_sharecode', ''),
+        'Sex': staff.get('sex', ''),
+        'Date of Birth': staff.get('date_of_birth', ''),
+        'Proof of ID': staff.get('proof_of_id', '')
+    } for staff in rows]
+
+
+class Row:
+    """Attribute access like a loaded Staff instance, without the ORM"""
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+def make_rows(count, seed):
+    rng = random.Random(seed)
+    rows = []
+    for serial in range(count):
+        values = generate_staff_row(rng, 1, serial)
+        values['id'] = serial + 1
+        rows.append(values)
+    return rows
+
+
+def measure(func, items, repeat):
+    """Best-of-``repeat`` microseconds per item"""
+    best = min(timeit.repeat(lambda: [func(item) for item in items], number=1, repeat=repeat))
+    return round(best / len(items) * 1e6, 3)
+
+
+def run(args):
+    from backend import staff_schema
+
+    rows = make_rows(args.rows, args.seed)
+    submissions = [
+        {name: (value.isoformat() if name == 'date_of_birth' else value) for name, value in row.items()
+         if name in staff_schema.INPUT_FIELDS}
+        for row in rows
+    ]
+    objects = [Row(row) for row in rows]
+    dicts = [staff_schema.to_dict(obj) for obj in objects]
+
+    cases = {
+        'validate': (legacy_validate, staff_schema.validate, submissions),
+        'coerce': (legacy_coerce, staff_schema.coerce, submissions),
+        'to_dict': (legacy_to_dict, staff_schema.to_dict, objects),
+        'to_row': (legacy_to_row, staff_schema.to_row, objects),
+        'excel_records': (lambda row: legacy_excel_records([row]), lambda row: staff_schema.excel_records([row]), dicts),
+    }
+
+    results = {}
+    for name, (legacy, schema, items) in cases.items():
+        before = measure(legacy, items, args.repeat)
+        after = measure(schema, items, args.repeat)
+        results[name] = {
+            'legacy_us_per_row': before,
+            'schema_us_per_row': after,
+            'speedup': round(before / after, 2) if after else None,
+        }
+        print(f'{name:14s} {before:8.3f} -> {after:8.3f} us/row', file=sys.stderr)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'rows': args.rows,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output')
+    args = parser.parse_args(argv)
+
+    payload = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(payload + '\n')
+    else:
+        print(payload)
+
+
+if __name__ == '__main__':
+    main()
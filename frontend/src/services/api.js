@@ -63,6 +63,16 @@ class ApiService {
     }
   }
 
+  // Run several API calls in one round trip.
+  // requests: [{ id, method, path, body }] -> [{ id, status, body }]
+  static async batch(requests) {
+    const response = await this.request('/api/batch', {
+      method: 'POST',
+      body: JSON.stringify({ requests }),
+    });
+    return response.responses;
+  }
+
   static async getStaffList() {
     try {
       const response = await this.request('/api/staff');
@@ -234,11 +244,9 @@ class ApiService {
   }
 
   static async downloadStaffId(id) {
-    const response = await fetch(`${API_BASE_URL}/api/staff/${id}/download-id`, {
-      headers: {
-        'Authorization': `Bearer ${localStorage.getItem('token')}`
-      }
-    });
+    // Fetch a short-lived signed URL, then download straight from storage
+    const { url } = await this.request(`/api/staff/${id}/download-url`);
+    const response = await fetch(url);
 
     if (!response.ok) {
       throw new Error('Failed to download ID');
@@ -247,6 +255,41 @@ class ApiService {
     return response.blob();
   }
 
+  // Backfill proofs of ID: filesByStaffId maps staff id -> File, and/or a zip archive
+  // of <staff_id>.<ext> files. Resolves to { uploaded, failed, results: [{ file, staff_id, status, ... }] }
+  static async uploadStaffIds(filesByStaffId = {}, archive = null) {
+    const form = new FormData();
+    Object.entries(filesByStaffId).forEach(([id, file]) => form.append(`proof_of_id_${id}`, file));
+    if (archive) form.append('archive', archive);
+
+    return this.request('/api/staff/upload-ids', {
+      method: 'POST',
+      body: form,
+    });
+  }
+
+  // Upload a proof of ID straight to storage, then attach it to the staff member
+  static async uploadStaffIdDirect(id, file) {
+    const { upload, upload_id } = await this.request(`/api/staff/${id}/upload-url`, {
+      method: 'POST',
+      body: JSON.stringify({ filename: file.name }),
+    });
+
+    const form = new FormData();
+    Object.entries(upload.fields).forEach(([name, value]) => form.append(name, value));
+    form.append('file', file);
+
+    const response = await fetch(upload.url, { method: upload.method, body: form });
+    if (!response.ok) {
+      throw new Error('Failed to upload ID');
+    }
+
+    return this.request(`/api/staff/${id}/upload-confirm`, {
+      method: 'POST',
+      body: JSON.stringify({ upload_id }),
+    });
+  }
+
   static async deleteStaff(id) {
     const options = {
       method: 'DELETE',
@@ -258,10 +301,17 @@ class ApiService {
     return this.request(`/api/staff/${id}`, options);
   }
 
-  static async searchStaff(query, employmentStatus = '') {
+  // options: { filters: { visa_type: ['Skilled Worker', ...], ... }, facets, limit, offset }
+  static async searchStaff(query, employmentStatus = '', options = {}) {
     const params = new URLSearchParams();
     if (query) params.append('q', query);
     if (employmentStatus) params.append('employment_status', employmentStatus);
+    Object.entries(options.filters || {}).forEach(([field, values]) => {
+      values.forEach(value => params.append(field, value));
+    });
+    if (options.facets) params.append('facets', '1');
+    if (options.limit) params.append('limit', options.limit);
+    if (options.offset) params.append('offset', options.offset);
 
     const response = await fetch(`${API_BASE_URL}/api/staff/search?${params}`, {
       method: 'GET',
@@ -278,6 +328,23 @@ class ApiService {
     return response.json();
   }
 
+  // Lightweight typeahead: [{ id, firstname, lastname }]
+  static async suggestStaff(query, limit = 10) {
+    const params = new URLSearchParams({ q: query, limit });
+    const response = await this.request(`/api/staff/suggest?${params}`);
+    return response.suggestions;
+  }
+
+  // Live staff changes: onEvent({ action, id, dashboard }) per write, onResync() when
+  // events were missed and the list should be refetched. Call .close() on the result to stop.
+  static subscribeStaffEvents(onEvent, onResync = () => {}) {
+    const params = new URLSearchParams({ jwt: localStorage.getItem('token') || '' });
+    const source = new EventSource(`${API_BASE_URL}/api/staff/events?${params}`);
+    source.addEventListener('staff', (e) => onEvent(JSON.parse(e.data)));
+    source.addEventListener('resync', () => onResync());
+    return source;
+  }
+
   static async downloadStaffExcel() {
     const response = await fetch(`${API_BASE_URL}/api/staff/download`, {
       method: 'GET',
@@ -1,4 +1,5 @@
 from backend import create_app, db
+from backend.schema import create_schema
 import os
 # Create the Flask application instance
 app = create_app()
@@ -17,7 +18,7 @@ with app.app_context():
     try:
         # Drop all tables and recreate them with proper relationships
         #db.drop_all()
-        db.create_all()
+        create_schema(app.config['STAFF_PARTITIONS'])
         print("Database tables recreated successfully with proper relationships!")
     except Exception as e:
         print(f"Error creating database: {e}")